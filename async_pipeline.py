@@ -0,0 +1,450 @@
+import os
+import time
+import asyncio
+import traceback
+import imaplib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from commons import load_history, save_history, already_processed
+from email_library import connect_imap, select_mailbox, message_summary, fetch_with_retry, _fetch_literal
+from email_library import stream_message, is_pdf_part, find_messages
+from imap_filter import DownloadStats, report_download_share
+from mime_stream import StreamingMimeParser
+from attachment_store import AttachmentStore, default_store_root, STATE_PENDING, STATE_PROCESSED
+from invoice_data import extract_invoice_data, probe_invoice_number, set_ocr_page_workers
+from mysql_connector import get_db_connection, insert_and_commit
+from invoice_export import open_export
+from pdf_library import settle_result, quarantine_document, save_invoice_artifacts, report_split, count_template, report_templates
+from pdf_library import load_processed_pdfs, save_processed_pdfs
+from scheduler import IsolatedPool, AdaptiveWorkers, adaptive_settings, classify_pdf, default_workers, ocr_page_budget
+from scheduler import PROBE_LANE, probe_timeout, PoisonDocumentError
+from scheduler import FAST_LANE, OCR_LANE
+
+# --------------------------- PIPELINE ASÍNCRONO ---------------------------------------
+# En main() cada etapa espera a la anterior: primero se descarga todo el correo
+# (FETCH, escritura de adjuntos, STORE) y después se extrae e inserta, así que
+# mientras se espera a la red la CPU no hace nada y viceversa. Aquí un event loop
+# coordina las etapas a la vez:
+#
+#   correo (N sesiones IMAP) -> almacén -> carriles texto/OCR -> MySQL -> almacén
+#
+# Todo lo bloqueante corre fuera del loop. Cada sesión IMAP, el almacén (SQLite) y
+# la conexión MySQL tienen su propio hilo porque ninguno se puede compartir entre
+# hilos. La sonda del encabezado y la separación de adjuntos van a un pool de
+# procesos; la clasificación por carril y la extracción, a los mismos IsolatedPool de
+# run_two_lanes, con el mismo presupuesto por documento.
+#
+# Se activa con "async_pipeline": true en config.json (ver main.py).
+
+SEEN_BATCH = 50  # correos por STORE +FLAGS \Seen
+
+class AsyncLanes:
+    """
+    Los dos carriles de IsolatedPool atendidos desde el event loop: extract() entrega
+    el documento a su carril y espera su resultado sin bloquear a las demás etapas.
+    classify() hace lo mismo con la sonda de carril (PROBE_LANE).
+    """
+
+    def __init__(self, worker_fn, fast_workers, ocr_workers, ocr_page_workers=None,
+                 timeout=None, memory_limit_mb=None, adaptive=None):
+        if ocr_page_workers is None:
+            ocr_page_workers = ocr_page_budget(fast_workers, ocr_workers)
+        self.pools = {
+            FAST_LANE: IsolatedPool(worker_fn, fast_workers, set_ocr_page_workers, (1,), timeout, memory_limit_mb),
+            OCR_LANE: IsolatedPool(worker_fn, ocr_workers, set_ocr_page_workers, (ocr_page_workers,), timeout, memory_limit_mb),
+        }
+        self.controller = AdaptiveWorkers(self.pools, **adaptive) if adaptive else None
+        self.probe = IsolatedPool(classify_pdf, fast_workers, timeout=probe_timeout(timeout),
+                                  memory_limit_mb=memory_limit_mb)
+        self.waiting = {}
+        self.poller = None
+
+    def start(self):
+        self.poller = asyncio.create_task(self._poll_loop())
+
+    async def extract(self, pdf_path, lane):
+        """Devuelve (result, error) como los entrega IsolatedPool.poll."""
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[pdf_path] = future
+        self.pools[lane].submit(pdf_path)
+        return await future
+
+    async def classify(self, pdf_path):
+        """Carril del documento: (lane, error) de classify_pdf con su presupuesto."""
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[pdf_path] = future
+        self.probe.submit(pdf_path)
+        return await future
+
+    async def _poll_loop(self):
+        while True:
+            activos = False
+            for pool in [self.probe, *self.pools.values()]:
+                if not pool.pending():
+                    continue
+                activos = True
+                # timeout=0: solo recoge lo que ya terminó, el loop nunca se bloquea aquí
+                for pdf_path, result, error in pool.poll(timeout=0):
+                    future = self.waiting.pop(pdf_path, None)
+                    if future is not None and not future.done():
+                        future.set_result((result, error))
+            if self.controller is not None:
+                self.controller.tick()
+            await asyncio.sleep(0.02 if activos else 0.05)
+
+    async def close(self):
+        if self.poller is not None:
+            self.poller.cancel()
+            try:
+                await self.poller
+            except asyncio.CancelledError:
+                pass
+        if self.controller is not None:
+            self.controller.report()
+        self.probe.shutdown()
+        for pool in self.pools.values():
+            pool.shutdown()
+
+class MailSession:
+    """Una sesión IMAP con su propio hilo; imaplib no admite comandos desde varios hilos."""
+
+    def __init__(self, connect_mail, cfg):
+        self.connect_mail = connect_mail
+        self.cfg = cfg
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="imap")
+        self.imap = None
+        self.seen = []
+
+    async def call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def open(self):
+        def abrir():
+            self.imap = self.connect_mail(self.cfg)
+            select_mailbox(self.imap, self.cfg)
+        await self.call(abrir)
+
+    async def mark_seen(self, num, flush=False):
+        if num is not None:
+            self.seen.append(num.decode() if isinstance(num, bytes) else str(num))
+        if self.seen and (flush or len(self.seen) >= SEEN_BATCH):
+            # Un solo STORE por lote de correos en lugar de un viaje por correo
+            message_set, self.seen = ",".join(self.seen), []
+            await self.call(self.imap.store, message_set, '+FLAGS', '\\Seen')
+
+    async def close(self):
+        def cerrar():
+            try:
+                self.imap.close()
+            except Exception:
+                pass
+            self.imap.logout()
+        try:
+            if self.imap is not None:
+                await self.mark_seen(None, flush=True)
+                await self.call(cerrar)
+        finally:
+            self.executor.shutdown(wait=True)
+
+class AsyncPipeline:
+    """
+    Descarga, extrae e inserta a la vez. connect_mail(cfg) y connect_db() se pueden
+    reemplazar (benchmark.py pipeline usa un buzón y una base simulados).
+    """
+
+    def __init__(self, cfg, connect_mail=connect_imap, connect_db=get_db_connection, worker_fn=extract_invoice_data):
+        self.cfg = cfg
+        self.connect_mail = connect_mail
+        self.connect_db = connect_db
+        self.worker_fn = worker_fn
+        self.stats = {"correos": 0, "pdfs_nuevos": 0, "extraidos": 0, "insertados": 0,
+                      "duplicados": 0, "split_pages": 0, "split_seconds": 0.0, "plantillas": {}}
+
+    # ---------- ejecutores ----------
+    async def _store(self, fn, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.store_io, lambda: fn(*args, **kwargs))
+
+    async def _db(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.db_io, fn, *args)
+
+    async def _cpu(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.cpu, fn, *args)
+
+    # ---------- corrida ----------
+    async def run(self):
+        cfg = self.cfg
+        inicio = time.perf_counter()
+        default_fast, default_ocr = default_workers()
+        fast_workers = cfg.get("fast_lane_workers") or default_fast
+        ocr_workers = cfg.get("ocr_lane_workers") or default_ocr
+        sesiones = max(1, cfg.get("async_imap_connections") or 1)
+
+        self.store_io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="store")
+        self.db_io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+        self.cpu = ProcessPoolExecutor(max_workers=cfg.get("async_cpu_workers") or max(1, (os.cpu_count() or 1) // 4))
+        self.lanes = AsyncLanes(self.worker_fn, fast_workers, ocr_workers, cfg.get("ocr_page_workers"),
+                                cfg.get("doc_timeout_seconds"), cfg.get("doc_memory_mb"), adaptive_settings(cfg))
+        self.store = None
+        self.conn = None
+        self.export = open_export(cfg)
+        self.mail_stats = DownloadStats()
+        self.sizes = {}
+        try:
+            folder = cfg["download_folder"]
+            self.store = await self._store(AttachmentStore, default_store_root(folder, cfg.get("storage_folder")))
+            self.conn = await self._db(self.connect_db)
+            self.processed_hashes = await self._store(load_processed_pdfs)
+
+            # Pendientes de corridas anteriores y PDFs sueltos entran primero a la cola
+            nuevos, _ = await self._store(self.store.ingest_folder, folder)
+            pendientes = await self._store(self.store.by_state, STATE_PENDING)
+            print(f"⚡ Pipeline asíncrono: {sesiones} sesión(es) IMAP, carriles {fast_workers}+{ocr_workers}, "
+                  f"{len(pendientes)} pendiente(s) del almacén ({nuevos} sueltos ingresados)")
+
+            documents = asyncio.Queue()
+            for row in pendientes:
+                documents.put_nowait((row["sha256"], row["original_name"]))
+
+            self.lanes.start()
+            extractores = [asyncio.create_task(self._extract_loop(documents))
+                           for _ in range(2 * (fast_workers + ocr_workers))]
+
+            await self._mail_stage(documents, sesiones)
+
+            await documents.join()
+            for tarea in extractores:
+                tarea.cancel()
+            await asyncio.gather(*extractores, return_exceptions=True)
+
+            await self._store(save_processed_pdfs, set(self.processed_hashes))
+            await self._store(report_download_share, self.mail_stats, self.store)
+        finally:
+            await self.lanes.close()
+            if self.conn is not None:
+                await self._db(self.conn.close)
+            if self.store is not None:
+                await self._store(self.store.close)
+            if self.export is not None:
+                await self._db(self.export.close)
+            self.cpu.shutdown()
+            self.db_io.shutdown()
+            self.store_io.shutdown()
+
+        self.stats["seconds"] = time.perf_counter() - inicio
+        report_split(self.stats["split_pages"], self.stats["split_seconds"])
+        report_templates(self.stats["plantillas"])
+        print(f"📊 {self.stats['correos']} correo(s), {self.stats['pdfs_nuevos']} PDF(s) nuevos, "
+              f"{self.stats['extraidos']} extraído(s), {self.stats['insertados']} factura(s) insertadas, "
+              f"{self.stats['duplicados']} duplicada(s) en {self.stats['seconds']:.1f} s")
+        return self.stats
+
+    # ---------- etapa de correo ----------
+    async def _mail_stage(self, documents, sesiones):
+        cfg = self.cfg
+        self.history = await self._store(load_history, cfg["history_file"])
+        # Hashes de adjuntos descargados antes de que existiera el almacén
+        self.known_hashes = {h for entry in self.history.values() for h in entry.get("sha256", [])}
+
+        principal = MailSession(self.connect_mail, cfg)
+        abiertas = [principal]
+        try:
+            await principal.open()
+            # SEARCH + prefiltro por BODYSTRUCTURE, igual que process_mailbox
+            found = await principal.call(find_messages, principal.imap, cfg, self.mail_stats)
+            if found is None:
+                return
+            msg_nums, self.sizes = found
+
+            numeros = asyncio.Queue()
+            for num in msg_nums:
+                numeros.put_nowait(num)
+
+            # Las demás sesiones se abren en paralelo; una que no conecte no detiene a las otras
+            extra = [MailSession(self.connect_mail, cfg) for _ in range(min(sesiones, len(msg_nums)) - 1)]
+            abiertas.extend(extra)
+            for resultado in await asyncio.gather(*(s.open() for s in extra), return_exceptions=True):
+                if isinstance(resultado, Exception):
+                    print(f"⚠️ No se pudo abrir una sesión IMAP adicional: {resultado}")
+
+            activas = [s for s in abiertas if s.imap is not None]
+            await asyncio.gather(*(self._mail_loop(s, numeros, documents) for s in activas))
+        finally:
+            for sesion in abiertas:
+                try:
+                    await sesion.close()
+                except Exception as e:
+                    print(f"⚠️ Error al cerrar la sesión IMAP: {e}")
+
+    async def _mail_loop(self, sesion, numeros, documents):
+        while not numeros.empty():
+            num = numeros.get_nowait()
+            try:
+                await self._download_message(sesion, num, documents)
+            except imaplib.IMAP4.abort as e:
+                print(f"🚨 Error grave IMAP durante el procesamiento: {e}")
+                try:
+                    await sesion.call(sesion.imap.noop)
+                except Exception:
+                    print("⚠️ La sesión IMAP parece haber expirado; sus correos restantes quedan para las demás.")
+                    return
+            except Exception as e:
+                print(f"❌ Error procesando correo: {e}")
+                traceback.print_exc()
+
+    async def _download_message(self, sesion, num, documents):
+        cfg = self.cfg
+        raw_headers = await sesion.call(lambda: _fetch_literal(fetch_with_retry(sesion.imap, num, "(BODY.PEEK[HEADER])")))
+        if raw_headers is None:
+            print(f"❌ No se pudo obtener el correo #{num}. Se omite.")
+            return
+        self.mail_stats.bytes_downloaded += len(raw_headers)
+
+        msg_id, subject, from_, date_ = message_summary(raw_headers, num)
+        if already_processed(self.history, msg_id):
+            print(f"⏭️ Correo ya procesado ({msg_id}), se omite.")
+            return
+        print(f"\n📧 Procesando: {subject} | De: {from_} | Fecha: {date_}")
+
+        parser = StreamingMimeParser(self.store.incoming_folder, is_pdf_part)
+        try:
+            body_bytes = await sesion.call(stream_message, sesion.imap, num, parser,
+                                           cfg.get("mime_fetch_chunk", 1024 * 1024), self.sizes.get(num))
+        except Exception:
+            parser.abort()
+            raise
+        self.mail_stats.add_message(body_bytes)
+
+        downloaded_pdfs = []
+        downloaded_hashes = []
+        for part in parser.saved:
+            filename = part["filename"]
+            try:
+                if part["sha256"] in self.known_hashes or await self._store(self.store.contains, part["sha256"]):
+                    os.remove(part["tmp_path"])
+                    print(f"  ⏭️ PDF '{filename}' ya descargado antes (mismo SHA-256), se omite.")
+                    continue
+
+                invoice_number = await self._cpu(
+                    probe_invoice_number, part["tmp_path"], cfg.get("header_probe_budget", 2.0)
+                )
+                prefix = f"{invoice_number}_" if invoice_number else ""
+                new_filename = prefix + filename
+
+                # put_file corre en el hilo del almacén: si otra sesión guardó el mismo
+                # contenido mientras tanto, nuevo es False y el PDF no se encola dos veces
+                saved_path, nuevo = await self._store(
+                    self.store.put_file, part["tmp_path"], original_name=new_filename,
+                    sha256=part["sha256"], invoice_no=invoice_number, msg_id=msg_id
+                )
+                self.known_hashes.add(part["sha256"])
+                if not nuevo:
+                    continue
+                print(f"  ✅ PDF guardado: {new_filename} -> {saved_path} ({part['size'] / 1024:.0f} KB)")
+                downloaded_pdfs.append(new_filename)
+                downloaded_hashes.append(part["sha256"])
+                self.stats["pdfs_nuevos"] += 1
+                self.mail_stats.pdf_bytes += part["size"]
+                self.mail_stats.msg_ids.add(msg_id)
+                documents.put_nowait((part["sha256"], new_filename))
+
+            except Exception as e:
+                print(f"  ❌ ERROR al procesar o guardar el PDF '{filename}': {e}")
+                traceback.print_exc()
+                if os.path.exists(part["tmp_path"]):
+                    os.remove(part["tmp_path"])
+
+        if not downloaded_pdfs:
+            print("   ⚠️ No se encontraron PDFs en este correo.")
+
+        self.history[msg_id] = {
+            "subject": subject,
+            "from": from_,
+            "date": date_,
+            "pdf_found": bool(downloaded_pdfs),
+            "downloaded_files": downloaded_pdfs,
+            "sha256": downloaded_hashes
+        }
+        # Copia: el hilo del almacén serializa mientras el loop sigue agregando correos
+        await self._store(save_history, dict(self.history), cfg["history_file"])
+        self.stats["correos"] += 1
+
+        if cfg.get("mark_as_seen"):
+            await sesion.mark_seen(num)
+
+    # ---------- etapas de extracción e inserción ----------
+    def _is_duplicate(self, sha256, identity):
+        if identity in self.processed_hashes:
+            return True
+        self.processed_hashes.add(identity)
+        return False
+
+    async def _extract_loop(self, documents):
+        while True:
+            sha256, pdf_filename = await documents.get()
+            try:
+                await self._extract_one(sha256, pdf_filename)
+            except Exception as e:
+                print(f"❌ Error en el pipeline con {pdf_filename}: {e}")
+                traceback.print_exc()
+            finally:
+                documents.task_done()
+
+    async def _extract_one(self, sha256, pdf_filename):
+        pdf_path = self.store.origin_path(sha256)
+        lane, error = await self.lanes.classify(pdf_path)
+        if isinstance(error, PoisonDocumentError):
+            lane, result = PROBE_LANE, None
+        else:
+            if error is not None:
+                # La sonda falló sin exceder su presupuesto: el carril OCR sirve para todo
+                lane = OCR_LANE
+            result, error = await self.lanes.extract(pdf_path, lane)
+
+        invoice = await self._store(
+            settle_result, self.store, sha256, pdf_filename, lane, result, error,
+            self.store.set_state, self._is_duplicate
+        )
+        if invoice is None:
+            if error is None:
+                self.stats["duplicados"] += 1
+            return
+        self.stats["extraidos"] += 1
+        print(f"Procesando ({lane}): Invoice No: {invoice.invoice_no} | Invoice Date: {invoice.invoice_date} | {invoice.file}")
+
+        # El worker recibe su propia copia; el texto de páginas ya no hace falta aquí
+        count_template(self.stats["plantillas"], invoice)
+        try:
+            split = await self._cpu(save_invoice_artifacts, invoice)
+        except Exception as e:
+            # Igual que extract_documents: cuarentena para ese documento y la identidad se libera
+            self.processed_hashes.discard(invoice.identity)
+            await self._store(quarantine_document, self.store, sha256, pdf_filename, lane,
+                              f"separación de adjuntos: {e}", self.store.set_state, identity=None)
+            return
+        invoice.source_text = None
+        self.stats["split_pages"] += split["pages"]
+        self.stats["split_seconds"] += split["seconds"]
+
+        # Mismo orden que extract_documents: primero la base, después el almacén
+        try:
+            result = await self._db(insert_and_commit, self.conn, invoice)
+        except Exception as e:
+            result = {"status": "error", "num": invoice.invoice_no, "error": str(e)}
+        if result["status"] == "error":
+            # No quedó en la base: se libera la identidad y el PDF vuelve a pendiente
+            # (si no, el reintento lo descartaría como duplicado de sí mismo)
+            print(f"❌ No se pudo guardar {invoice.file}: {result.get('error')}")
+            self.processed_hashes.discard(invoice.identity)
+            await self._store(self.store.set_state, sha256, STATE_PENDING, identity=None,
+                              reason=f"carril {lane}: la factura {invoice.invoice_no} no se pudo guardar")
+            return
+        if result["status"] == "ok":
+            self.stats["insertados"] += 1
+            if self.export is not None:
+                # Mismo hilo que la base: el sink no necesita candado
+                await self._db(self.export.add, invoice)
+        await self._store(self.store.set_state, sha256, STATE_PROCESSED, original_name=invoice.file,
+                          invoice_no=invoice.invoice_no, identity=invoice.identity)
+
+def run_async_pipeline(cfg, connect_mail=connect_imap, connect_db=get_db_connection, worker_fn=extract_invoice_data):
+    """Punto de entrada síncrono (main.py): corre el pipeline en un event loop propio."""
+    return asyncio.run(AsyncPipeline(cfg, connect_mail, connect_db, worker_fn).run())
@@ -0,0 +1,253 @@
+import os
+import sys
+import hashlib
+import sqlite3
+import datetime
+from pathlib import Path
+
+# --------------------------- ALMACÉN DE ADJUNTOS --------------------------------------
+# Los PDFs se guardan direccionados por contenido: el nombre del archivo es su SHA-256
+# y vive en subcarpetas de dos niveles (ab/cd/abcd...pdf), así ninguna carpeta crece
+# más allá de unos cientos de archivos aunque el archivo histórico llegue a cientos de
+# miles. Los metadatos (nombre original, Invoice No, estado, correo de origen) van en
+# un índice SQLite junto a los archivos, de modo que saber si un PDF ya existe o qué
+# documentos faltan por procesar es una consulta por llave, sin recorrer carpetas.
+#
+#   <raíz>/objects/ab/cd/<sha256>.pdf       original tal como llegó (antes origin/)
+#   <raíz>/objects/ab/cd/<sha256>.pdf.text.json   texto de páginas para el backfill
+#   <raíz>/attachments/ab/cd/<sha256>.pdf   copia sin la página de factura (antes attachment/)
+#   <raíz>/incoming/                        temporales de descarga (mismo disco, os.replace)
+#   <raíz>/quarantine/<nombre>.pdf          enlace/copia de los documentos en cuarentena
+#   <raíz>/quarantine/<nombre>.reason.txt   motivo, carril y SHA-256 para revisarlos a mano
+#   <raíz>/index.sqlite                     índice de metadatos
+
+STATE_PENDING = "pendiente"  # descargado, falta extraer
+STATE_QUEUED = "en_cola"  # enviado a la cola compartida (work_queue); su estado vive en parse_jobs
+STATE_PROCESSED = "procesado"  # extraído e insertado
+STATE_DUPLICATE = "duplicado"  # la factura ya se había extraído de otro PDF
+STATE_QUARANTINE = "cuarentena"  # excedió su presupuesto o tumbó al worker
+STATES = (STATE_PENDING, STATE_QUEUED, STATE_PROCESSED, STATE_DUPLICATE, STATE_QUARANTINE)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    sha256 TEXT PRIMARY KEY,
+    original_name TEXT NOT NULL,
+    invoice_no TEXT,
+    state TEXT NOT NULL,
+    size INTEGER,
+    msg_id TEXT,
+    identity TEXT,
+    reason TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_documents_state ON documents (state);
+CREATE INDEX IF NOT EXISTS idx_documents_invoice_no ON documents (invoice_no);
+"""
+
+UPDATABLE_FIELDS = ("original_name", "invoice_no", "state", "msg_id", "identity", "reason")
+
+def default_store_root(download_folder, storage_folder=None):
+    """Raíz del almacén: storage_folder del config o <download_folder>/store."""
+    return storage_folder or os.path.join(download_folder, "store")
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def _now():
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+class StoreLayout:
+    """
+    Solo las rutas del almacén, sin abrir el índice. Lo usan los nodos de la cola
+    compartida (work_queue), que ven el almacén por una carpeta de red y llevan el
+    estado en la tabla de trabajos en lugar del índice SQLite.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.objects_folder = os.path.join(root, "objects")
+        self.attachments_folder = os.path.join(root, "attachments")
+        self.incoming_folder = os.path.join(root, "incoming")
+        self.quarantine_folder = os.path.join(root, "quarantine")
+        for folder in (self.objects_folder, self.attachments_folder, self.incoming_folder, self.quarantine_folder):
+            os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def _shard(folder, sha256):
+        return os.path.join(folder, sha256[:2], sha256[2:4], f"{sha256}.pdf")
+
+    def origin_path(self, sha256):
+        return self._shard(self.objects_folder, sha256)
+
+    def attachment_path(self, sha256):
+        """Ruta de la copia sin página de factura; crea su subcarpeta."""
+        path = self._shard(self.attachments_folder, sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    @staticmethod
+    def sha_from_path(path):
+        """El SHA-256 sale del nombre del archivo; no hace falta leerlo ni consultar el índice."""
+        return Path(path).stem
+
+class AttachmentStore(StoreLayout):
+    """
+    Almacén de PDFs por SHA-256 con índice de metadatos.
+
+    Uso:
+        store = AttachmentStore(default_store_root(cfg["download_folder"]))
+        path, nuevo = store.put_file(tmp_path, original_name="factura.pdf")
+        for doc in store.by_state(STATE_PENDING): ...
+        store.close()
+    """
+
+    def __init__(self, root):
+        super().__init__(root)
+        self.conn = sqlite3.connect(os.path.join(root, "index.sqlite"))
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    # ---------- índice ----------
+    def get(self, sha256):
+        """Metadatos del documento (sqlite3.Row) o None."""
+        return self.conn.execute("SELECT * FROM documents WHERE sha256 = ?", (sha256,)).fetchone()
+
+    def contains(self, sha256):
+        return self.conn.execute("SELECT 1 FROM documents WHERE sha256 = ?", (sha256,)).fetchone() is not None
+
+    def by_state(self, state):
+        return self.conn.execute(
+            "SELECT * FROM documents WHERE state = ? ORDER BY created_at", (state,)
+        ).fetchall()
+
+    def by_invoice_no(self, invoice_no):
+        return self.conn.execute("SELECT * FROM documents WHERE invoice_no = ?", (invoice_no,)).fetchall()
+
+    def counts(self):
+        return dict(self.conn.execute("SELECT state, COUNT(*) FROM documents GROUP BY state").fetchall())
+
+    def bytes_by_msg_ids(self, msg_ids, batch_size=500):
+        """Suma de size por estado de los documentos que llegaron en esos correos."""
+        totales = {}
+        msg_ids = list(msg_ids)
+        for i in range(0, len(msg_ids), batch_size):
+            lote = msg_ids[i:i + batch_size]
+            for state, total in self.conn.execute(
+                f"SELECT state, SUM(size) FROM documents WHERE msg_id IN ({', '.join('?' * len(lote))}) "
+                f"GROUP BY state", lote
+            ):
+                totales[state] = totales.get(state, 0) + (total or 0)
+        return totales
+
+    def update(self, sha256, **fields):
+        """Actualiza metadatos (state, invoice_no, identity, reason, ...) de un documento."""
+        unknown = set(fields) - set(UPDATABLE_FIELDS)
+        if unknown:
+            raise ValueError(f"Campos no válidos para el índice: {sorted(unknown)}")
+        columnas = sorted(fields)
+        self.conn.execute(
+            f"UPDATE documents SET {', '.join(f'{c} = ?' for c in columnas)}, updated_at = ? WHERE sha256 = ?",
+            [fields[c] for c in columnas] + [_now(), sha256]
+        )
+        self.conn.commit()
+
+    def set_state(self, sha256, state, **fields):
+        self.update(sha256, state=state, **fields)
+
+    def set_states(self, sha256_list, state):
+        """Mismo estado para muchos documentos en una sola transacción."""
+        now = _now()
+        self.conn.executemany(
+            "UPDATE documents SET state = ?, updated_at = ? WHERE sha256 = ?",
+            [(state, now, sha256) for sha256 in sha256_list]
+        )
+        self.conn.commit()
+
+    # ---------- altas ----------
+    def put_file(self, tmp_path, original_name, sha256=None, invoice_no=None, msg_id=None, state=STATE_PENDING):
+        """
+        Mueve un archivo ya escrito a su ruta por contenido y lo registra en el índice.
+        Si el contenido ya estaba guardado, borra tmp_path y no toca el índice.
+
+        Returns:
+            tuple: (ruta guardada, True si es nuevo / False si ya existía)
+        """
+        sha256 = sha256 or file_sha256(tmp_path)
+        destino = self.origin_path(sha256)
+
+        if self.contains(sha256):
+            os.remove(tmp_path)
+            return destino, False
+
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        os.replace(tmp_path, destino)
+        now = _now()
+        self.conn.execute(
+            "INSERT INTO documents (sha256, original_name, invoice_no, state, size, msg_id, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (sha256, original_name, invoice_no, state, os.path.getsize(destino), msg_id, now, now)
+        )
+        self.conn.commit()
+        return destino, True
+
+    def ingest_folder(self, folder, state=STATE_PENDING):
+        """
+        Mueve al almacén los PDFs sueltos de una carpeta (copiados a mano o de
+        versiones anteriores que descargaban directo a download_folder).
+
+        Returns:
+            tuple: (nuevos, repetidos)
+        """
+        nuevos = repetidos = 0
+        if not os.path.isdir(folder):
+            return nuevos, repetidos
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.lower().endswith(".pdf"):
+                    continue
+                _, nuevo = self.put_file(entry.path, original_name=entry.name, state=state)
+                if nuevo:
+                    nuevos += 1
+                else:
+                    repetidos += 1
+        return nuevos, repetidos
+
+def main():
+    """Consulta rápida del índice: python attachment_store.py <raíz> [estado | sha256 | Invoice No]"""
+    if len(sys.argv) < 2:
+        print(main.__doc__)
+        return
+    with AttachmentStore(sys.argv[1]) as store:
+        if len(sys.argv) == 2:
+            for state, total in sorted(store.counts().items()):
+                print(f"  {state:<12} {total}")
+            return
+        clave = sys.argv[2]
+        if clave in STATES:
+            rows = store.by_state(clave)
+        else:
+            row = store.get(clave)
+            rows = [row] if row else store.by_invoice_no(clave)
+        for row in rows:
+            print(f"{row['sha256']}  {row['state']:<10}  {row['invoice_no'] or '-':<10}  "
+                  f"{row['original_name']}  {row['reason'] or ''}")
+            print(f"    {store.origin_path(row['sha256'])}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import os
+import json
+import argparse
+import datetime
+import pytesseract
+from decimal import Decimal
+from concurrent.futures import ProcessPoolExecutor
+from commons import get_pdf_paths
+from attachment_store import AttachmentStore, default_store_root, STATE_PROCESSED
+from invoice_data import collect_invoice_text, extract_fields, refresh_invoice_page
+from pdf_library import invoice_text_path, load_invoice_text, save_invoice_text
+from mysql_connector import get_db_connection, invoice_columns, fetch_invoice_rows, bulk_update_invoices, BACKFILL_COLUMNS
+pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
+
+# --------------------------- BACKFILL / RE-EXTRACCIÓN --------------------------------
+# Cuando cambia un extractor de invoice_data, se vuelve a parsear el texto guardado
+# junto a cada PDF procesado (<archivo>.pdf.text.json) en todos los núcleos, sin
+# repetir el OCR, y se compara campo por campo contra la tabla 'invoices'.
+# Los PDFs salen del índice del almacén (estado procesado) más la carpeta origin/
+# de corridas anteriores al almacén, si existe.
+# Por defecto solo reporta; con --apply actualiza en bloque las filas que cambiaron.
+#
+# Uso: python backfill.py <carpeta de descargas> [--storage <almacén>] [--apply] [--fields lncotenn DueDate ...]
+
+def reparse_document(origin_pdf):
+    """
+    Worker: vuelve a armar el Invoice desde el texto guardado. La página de la
+    factura se vuelve a elegir con el texto guardado de cada página (por si cambió
+    el clasificador) y el S/O# o el railcar se buscan también en las otras páginas.
+    Para páginas con capa de texto que no resuelve una plantilla también se releen
+    las coordenadas del PDF (sin OCR).
+
+    Returns:
+        tuple: (origin_pdf, columnas nuevas o None, error o None)
+    """
+    try:
+        snapshot = load_invoice_text(origin_pdf)
+        refresh_invoice_page(snapshot, origin_pdf)
+        invoice = extract_fields(snapshot, origin_pdf, allow_full_text=False)
+        invoice.origin_path = origin_pdf
+        return origin_pdf, invoice_columns(invoice), None
+    except Exception as e:
+        return origin_pdf, None, f"{type(e).__name__}: {e}"
+
+def collect_missing_text(origin_pdf):
+    """Worker: genera el texto de páginas de un PDF procesado antes de que se guardara (hace OCR una vez)."""
+    try:
+        save_invoice_text(collect_invoice_text(origin_pdf), origin_pdf)
+        return origin_pdf, None
+    except Exception as e:
+        return origin_pdf, f"{type(e).__name__}: {e}"
+
+def comparable(value):
+    """Lleva el valor de la DB o del parser a una forma comparable (fechas ISO, números float)."""
+    if value is None:
+        return None
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.strftime("%Y-%m-%d")
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        return round(float(value), 4)
+    value = str(value).strip()
+    try:
+        return round(float(value.replace(",", "")), 4)
+    except ValueError:
+        return value
+
+def diff_row(db_row, new_columns, columns):
+    """Campos que cambian: {columna: (valor en DB, valor nuevo)}."""
+    return {
+        col: (db_row.get(col), new_columns.get(col))
+        for col in columns
+        if comparable(db_row.get(col)) != comparable(new_columns.get(col))
+    }
+
+def _json_value(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+def processed_pdf_paths(folder_pdfs, storage_folder=None):
+    """Rutas de los PDFs ya procesados: almacén por SHA-256 y origin/ heredado."""
+    with AttachmentStore(default_store_root(folder_pdfs, storage_folder)) as store:
+        paths = [store.origin_path(row["sha256"]) for row in store.by_state(STATE_PROCESSED)]
+
+    origin_folder = os.path.join(folder_pdfs, "origin")
+    if os.path.isdir(origin_folder):
+        paths += [info["ruta"] for info in get_pdf_paths(origin_folder)]
+    return paths
+
+def run_backfill(folder_pdfs, apply=False, columns=None, workers=None, collect_missing=False,
+                 report_path="temp/backfill_diff.json", storage_folder=None):
+    columns = columns or BACKFILL_COLUMNS
+    workers = workers or os.cpu_count() or 1
+
+    origin_pdfs = processed_pdf_paths(folder_pdfs, storage_folder)
+    sin_texto = [p for p in origin_pdfs if not os.path.exists(invoice_text_path(p))]
+    print(f"📚 PDFs procesados: {len(origin_pdfs)} | sin texto guardado: {len(sin_texto)}")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        if sin_texto and collect_missing:
+            print(f"🔎 Generando texto de {len(sin_texto)} PDF(s) antiguos (OCR una sola vez)...")
+            for origin_pdf, error in executor.map(collect_missing_text, sin_texto, chunksize=4):
+                if error:
+                    print(f"❌ {os.path.basename(origin_pdf)}: {error}")
+
+        con_texto = [p for p in origin_pdfs if os.path.exists(invoice_text_path(p))]
+        print(f"⚙️ Re-parseando {len(con_texto)} documento(s) con {workers} proceso(s)...")
+        reparsed = {}
+        for origin_pdf, new_columns, error in executor.map(reparse_document, con_texto, chunksize=16):
+            if error:
+                print(f"❌ {os.path.basename(origin_pdf)}: {error}")
+                continue
+            reparsed[origin_pdf] = new_columns
+
+    conn = get_db_connection()
+    try:
+        db_rows = fetch_invoice_rows(conn, list(reparsed))
+        print(f"🗄️ Filas encontradas en invoices: {len(db_rows)} de {len(reparsed)}")
+
+        cambios = []
+        por_columna = dict.fromkeys(columns, 0)
+        for origin_pdf, new_columns in reparsed.items():
+            db_row = db_rows.get(origin_pdf)
+            if db_row is None:
+                continue
+            diferencias = diff_row(db_row, new_columns, columns)
+            if diferencias:
+                cambios.append((origin_pdf, diferencias))
+                for col in diferencias:
+                    por_columna[col] += 1
+
+        print(f"📝 Filas con cambios: {len(cambios)}")
+        for col, cantidad in por_columna.items():
+            if cantidad:
+                print(f"  {col:<18} {cantidad}")
+
+        directory = os.path.dirname(report_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump([
+                {"origin": origin_pdf,
+                 "changes": {col: [_json_value(old), _json_value(new)] for col, (old, new) in diferencias.items()}}
+                for origin_pdf, diferencias in cambios
+            ], f, ensure_ascii=False, indent=2)
+        print(f"  Diff por campo guardado en {report_path}")
+
+        if apply and cambios:
+            actualizadas = bulk_update_invoices(conn, [
+                (origin_pdf, {col: new for col, (_, new) in diferencias.items()})
+                for origin_pdf, diferencias in cambios
+            ])
+            print(f"✅ {actualizadas} fila(s) actualizadas.")
+        elif cambios:
+            print("ℹ️ Modo revisión: usa --apply para escribir los cambios.")
+    finally:
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-extrae facturas desde el texto guardado y corrige la tabla invoices")
+    parser.add_argument("folder", help="Carpeta de descargas (la que contiene store/ u origin/)")
+    parser.add_argument("--storage", help="Raíz del almacén si no es <folder>/store (storage_folder del config)")
+    parser.add_argument("--apply", action="store_true", help="Escribir los cambios en la DB")
+    parser.add_argument("--fields", nargs="+", choices=BACKFILL_COLUMNS, help="Limitar el diff a estas columnas")
+    parser.add_argument("--workers", type=int, help="Procesos para re-parsear (por defecto todos los núcleos)")
+    parser.add_argument("--collect-missing", action="store_true",
+                        help="Generar el texto de PDFs procesados antes de que se guardara (hace OCR)")
+    parser.add_argument("--report", default="temp/backfill_diff.json")
+    args = parser.parse_args()
+
+    run_backfill(args.folder, apply=args.apply, columns=args.fields, workers=args.workers,
+                 collect_missing=args.collect_missing, report_path=args.report,
+                 storage_folder=args.storage)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1152 @@
+import argparse
+import json
+import os
+import re
+import time
+import random
+import hashlib
+import tracemalloc
+import io
+import shutil
+import tempfile
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+from string import Template
+from contextlib import redirect_stdout
+import email
+from email import policy
+from email.message import EmailMessage
+import pdfplumber
+import invoice_data
+from commons import get_pdf_paths, unique_path
+from attachment_store import AttachmentStore, STATE_PENDING, STATE_PROCESSED
+from invoice_data import classify_pages, extract_invoice_data, probe_pdf
+from invoice_data import scan_page_kinds, TEXT_PAGE, find_invoice_page, extract_layout_fields
+from invoice_data import extract_shipping_terms, extract_product_detail
+from invoice_data import extract_headers, extract_so_no, extract_shipto_billto, extract_raildcar_v1, extract_totals
+from invoice_record import Invoice, ProductLine
+from mime_stream import StreamingMimeParser
+from extraction_service import percentile
+from scheduler import IsolatedPool, AdaptiveWorkers, default_workers, FAST_LANE, OCR_LANE
+from pdf_library import crear_pdf_factura_desde_archivo, render_invoice_pdfs, link_callback, remove_invoice_page
+
+# --------------------------- BENCHMARKS ----------------------------------------------
+# Uso: python benchmark.py <nombre> [opciones]
+# Los datos sintéticos se arman a partir de texto_ocr.txt (una página de factura real
+# pasada por OCR) para no depender de PDFs del correo.
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_OCR_PATH = os.path.join(BASE_DIR, "texto_ocr.txt")
+
+FILLER_PAGE = (
+    "BILL OF LADING - SHORT FORM - NOT NEGOTIABLE\n"
+    "Shipper: Sterling International LLC  Carrier: UP  Car No. FPAX950147\n"
+    "Seal No. 1234567  Weight 193,600 LBS  High Density Polyethylene\n"
+    "Certificate of Analysis  Lot No. P25K123  Melt Index 0.43  Density 0.952\n"
+) * 6
+
+def load_sample_invoice_page():
+    """Texto de la página de factura de ejemplo (OCR)."""
+    with open(SAMPLE_OCR_PATH, "r", encoding="utf-8") as f:
+        return f.read()
+
+def build_document(num_pages, invoice_page):
+    """Documento sintético: páginas de relleno con la factura en invoice_page."""
+    invoice_text = load_sample_invoice_page()
+    return [invoice_text if i == invoice_page else FILLER_PAGE for i in range(num_pages)]
+
+def report(nombre, total_seconds, repeticiones, unidad="doc"):
+    per_unit = total_seconds / repeticiones
+    print(f"  {nombre:<40} {per_unit * 1000:9.3f} ms/{unidad} | {repeticiones / total_seconds:10.1f} {unidad}/s")
+
+# --------------------------- CLASIFICADOR DE PÁGINAS ---------------------------------
+
+def _legacy_two_pass(pages_text_list):
+    """
+    Los dos algoritmos que había antes del clasificador único (regex por página en
+    find_invoice_page_text + puntaje por palabras en find_invoice_page_index),
+    conservados aquí solo como línea base de comparación.
+    """
+    invoice_indicators = re.compile(r"(Invoice\s*No|Invoice\s*Date)", re.I)
+    address_indicators = re.compile(r"(Ship\s*To|Bill\s*To)", re.I)
+    for text in pages_text_list:
+        text_one_line = re.sub(r'[\r\n]+', ' ', text)
+        if invoice_indicators.search(text_one_line) and address_indicators.search(text_one_line):
+            break
+
+    keywords = ["invoice no", "invoice date", "invoice#", "inv no", "inv date",
+                "ship to", "bill to", "consignee", "customer", "sold to",
+                "subtotal", "total", "payment terms", "due date", "method of shipment", "incoterm"]
+    best_score, best_index = 0, None
+    for i, text in enumerate(pages_text_list):
+        text_lower = text.lower().replace("\n", " ")
+        score = sum(1 for k in keywords if k in text_lower)
+        if score > best_score:
+            best_score, best_index = score, i
+    return best_index
+
+def bench_pages(args):
+    pages = build_document(args.pages, invoice_page=args.pages - 3)
+    print(f"📄 Clasificador de páginas: documento de {args.pages} páginas, {args.repeat} repeticiones")
+
+    # Línea base: se ejecutaba una vez en correo, otra en parseo y otra en separación
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for _ in range(3):
+            _legacy_two_pass(pages)
+    report("legacy (3 etapas x 2 algoritmos)", time.perf_counter() - start, args.repeat)
+
+    # El clasificador corre una vez y el índice queda en el documento para las demás etapas
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        classify_pages(pages)
+    report("clasificador único (1 pasada)", time.perf_counter() - start, args.repeat)
+
+    result = classify_pages(pages)
+    print(f"  Página de factura detectada: {result['invoice_page']} (esperada {args.pages - 3})")
+
+# --------------------------- PRECISIÓN DE CAMPOS -------------------------------------
+
+COMPARE_FIELDS = [
+    "Invoice No", "Invoice Date", "S/O#", "Incotenn", "Payment Terms",
+    "Ship Date", "Due Date", "Method of Shipment", "Ship To", "Bill To",
+    "Subtotal", "Total",
+]
+
+def load_expected(path):
+    """Resultados esperados por archivo: {"archivo.pdf": {"Invoice No": ..., ...}}"""
+    if not path:
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def field_accuracy(invoices, reference):
+    """Fracción de campos que coinciden con la referencia (por nombre de archivo)."""
+    total = iguales = 0
+    for invoice in invoices:
+        esperado = reference.get(invoice["File"])
+        if not esperado:
+            continue
+        for campo in COMPARE_FIELDS:
+            if campo in esperado:
+                total += 1
+                iguales += invoice.get(campo) == esperado[campo]
+    return iguales / total if total else 0.0
+
+def run_corpus(pdf_paths):
+    """Extrae todas las facturas del corpus y devuelve (facturas, segundos)."""
+    start = time.perf_counter()
+    invoices = [extract_invoice_data(pdf_path).to_dict() for pdf_path in pdf_paths]
+    return invoices, time.perf_counter() - start
+
+# --------------------------- OCR ESCALONADO ------------------------------------------
+
+def bench_ocr(args):
+    pdf_paths = [info["ruta"] for info in get_pdf_paths(args.folder)]
+    pages = sum(probe_pdf(pdf_path)["pages"] for pdf_path in pdf_paths)
+    expected = load_expected(args.expected)
+    print(f"🔎 OCR escalonado vs 300 DPI fijo: {len(pdf_paths)} PDF(s), {pages} página(s)")
+
+    tiers = invoice_data.OCR_DPI_TIERS
+    resultados = {}
+    for nombre, niveles in (("300 DPI fijo", (300,)), (f"escalonado {tiers}", tiers)):
+        invoice_data.set_ocr_dpi_tiers(niveles)
+        invoice_data.renderizar_pagina.cache_clear()
+        invoices, elapsed = run_corpus(pdf_paths)
+        resultados[nombre] = invoices
+        report(nombre, elapsed, pages, "pág")
+
+    # Sin resultados esperados, la referencia es el comportamiento anterior (300 DPI)
+    referencia = expected or {inv["File"]: inv for inv in resultados["300 DPI fijo"]}
+    for nombre, invoices in resultados.items():
+        print(f"  Precisión de campos {nombre:<28} {field_accuracy(invoices, referencia) * 100:6.2f}%")
+
+# --------------------------- DETECCIÓN ESCANEADO / TEXTO -----------------------------
+
+def bench_scan(args):
+    pdf_paths = [info["ruta"] for info in get_pdf_paths(args.folder)]
+    print(f"🧾 Detección escaneado/texto: {len(pdf_paths)} PDF(s)")
+
+    start = time.perf_counter()
+    kinds_by_pdf = {pdf_path: scan_page_kinds(pdf_path) or [] for pdf_path in pdf_paths}
+    elapsed_probe = time.perf_counter() - start
+    pages = sum(len(kinds) for kinds in kinds_by_pdf.values())
+
+    # Línea base: extract_text de pdfplumber en cada página
+    start = time.perf_counter()
+    plumber_has_text = {}
+    for pdf_path in pdf_paths:
+        with pdfplumber.open(pdf_path) as pdf:
+            plumber_has_text[pdf_path] = [len((page.extract_text() or "").strip()) >= 50 for page in pdf.pages]
+    elapsed_plumber = time.perf_counter() - start
+
+    report("recursos (pypdf)", elapsed_probe, pages, "pág")
+    report("pdfplumber extract_text", elapsed_plumber, pages, "pág")
+
+    coinciden = sum(
+        (kind == TEXT_PAGE) == has_text
+        for pdf_path in pdf_paths
+        for kind, has_text in zip(kinds_by_pdf[pdf_path], plumber_has_text[pdf_path])
+    )
+    con_texto = sum(kinds.count(TEXT_PAGE) for kinds in kinds_by_pdf.values())
+    print(f"  Páginas: {pages} | con texto: {con_texto} | escaneadas: {pages - con_texto}")
+    print(f"  Coincidencia con pdfplumber (>= 50 caracteres): {coinciden / pages * 100 if pages else 0:.2f}%")
+
+# --------------------------- MOTOR DE TEXTO POR NIVELES ------------------------------
+
+def bench_engine(args):
+    pdf_paths = [info["ruta"] for info in get_pdf_paths(args.folder)]
+    print(f"⚙️ Motor de texto: pypdf para clasificar vs pdfplumber en todo: {len(pdf_paths)} PDF(s)")
+
+    resultados = {}
+    for nombre, rapido in (("pdfplumber en todas las páginas", False), ("pypdf + pdfplumber en factura", True)):
+        invoice_data.set_fast_text_engine(rapido)
+        invoices, elapsed = run_corpus(pdf_paths)
+        resultados[nombre] = invoices
+        report(nombre, elapsed, len(pdf_paths))
+
+    # La salida del motor rápido debe ser idéntica al parseo con pdfplumber
+    referencia = {inv["File"]: inv for inv in resultados["pdfplumber en todas las páginas"]}
+    distintos = [
+        inv["File"] for inv in resultados["pypdf + pdfplumber en factura"]
+        if any(inv.get(campo) != referencia[inv["File"]].get(campo) for campo in COMPARE_FIELDS)
+    ]
+    print(f"  Coincidencia de campos: {field_accuracy(resultados['pypdf + pdfplumber en factura'], referencia) * 100:.2f}%")
+    for nombre_archivo in distintos:
+        print(f"  ⚠️ Difiere: {nombre_archivo}")
+
+# --------------------------- EXTRACCIÓN POR COORDENADAS ------------------------------
+
+def bench_layout(args):
+    pdf_paths = [info["ruta"] for info in get_pdf_paths(args.folder)]
+    paginas = []
+    for pdf_path in pdf_paths:
+        page_index, page_text = find_invoice_page(pdf_path, allow_ocr=False)
+        if page_index is not None and page_text:
+            paginas.append((pdf_path, page_index, re.sub(r"[\r\n]+", " ", page_text)))
+    print(f"📐 Coordenadas vs regex (términos + producto): {len(paginas)} página(s) de factura con capa de texto")
+
+    start = time.perf_counter()
+    por_regex = [(extract_shipping_terms(texto), extract_product_detail(texto)) for _, _, texto in paginas]
+    report("regex sobre la página aplanada", time.perf_counter() - start, len(paginas))
+
+    start = time.perf_counter()
+    por_layout = [extract_layout_fields(pdf_path, page_index) for pdf_path, page_index, _ in paginas]
+    report("coordenadas (extract_words)", time.perf_counter() - start, len(paginas))
+
+    campos = iguales = sin_layout = 0
+    for (terms, product), layout in zip(por_regex, por_layout):
+        if not layout["terms"] or not layout["product"]:
+            sin_layout += 1
+        for esperado, obtenido in ((terms, layout["terms"]), (product, layout["product"])):
+            if not obtenido:
+                continue
+            for campo, valor in obtenido.items():
+                if campo == "Transport No.":
+                    continue
+                campos += 1
+                iguales += valor == esperado.get(campo)
+    print(f"  Coincidencia con regex: {iguales / campos * 100 if campos else 0:.2f}% de {campos} campos")
+    print(f"  Páginas que caen al regex (sin encabezados reconocibles): {sin_layout}")
+
+# --------------------------- SEPARACIÓN DE ADJUNTOS ----------------------------------
+
+def bench_split(args):
+    pdf_paths = [info["ruta"] for info in get_pdf_paths(args.folder)]
+    # El índice de la factura lo trae el Invoice de la extracción; aquí se calcula fuera del tiempo
+    indices = {pdf_path: find_invoice_page(pdf_path)[0] for pdf_path in pdf_paths}
+    print(f"✂️ Separación de adjuntos: {len(pdf_paths)} PDF(s)")
+
+    salida = tempfile.mkdtemp(prefix="split_bench_")
+    try:
+        for nombre, con_indice in (("re-detectar página (texto/OCR)", False), ("índice conocido", True)):
+            paginas = 0
+            modos = {}
+            start = time.perf_counter()
+            for i, pdf_path in enumerate(pdf_paths):
+                destino = os.path.join(salida, f"{i}.pdf")
+                split = remove_invoice_page(pdf_path, destino, indices[pdf_path] if con_indice else None)
+                paginas += split["pages"]
+                modos[split["mode"]] = modos.get(split["mode"], 0) + 1
+            elapsed = time.perf_counter() - start
+            report(nombre, elapsed, max(paginas, 1), "página")
+            print(f"  {'':<40} {modos}")
+    finally:
+        shutil.rmtree(salida, ignore_errors=True)
+
+# --------------------------- FUZZ DE LOS EXTRACTORES ---------------------------------
+# Texto tipo OCR ruidoso/truncado para medir el peor caso de los regex de cada extractor.
+
+FUZZ_EXTRACTORS = [
+    extract_headers, extract_so_no, extract_shipto_billto, extract_shipping_terms,
+    extract_product_detail, extract_raildcar_v1, extract_totals,
+]
+FUZZ_ANCHORS = ["Product No", "Subtotal", "TOTAL", "Bill To:", "Ship To:", "Incoterm"]
+FUZZ_CONFUSABLES = {"l": "I", "I": "l", "0": "O", "O": "0", "5": "S", "S": "5", "/": "|", ".": ","}
+
+def mutate_ocr_text(text, rng, max_len):
+    """Aplica de 1 a 3 daños típicos de OCR: cortes, caracteres perdidos o confundidos,
+    ruido insertado, fragmentos repetidos y anclas eliminadas."""
+    for _ in range(rng.randint(1, 3)):
+        kind = rng.choice(["truncate", "drop", "confuse", "garbage", "repeat", "no_anchor"])
+        if kind == "truncate" and text:
+            text = text[:rng.randint(0, len(text))]
+        elif kind == "drop":
+            text = "".join(c for c in text if rng.random() > 0.1)
+        elif kind == "confuse":
+            text = "".join(FUZZ_CONFUSABLES.get(c, c) if rng.random() < 0.2 else c for c in text)
+        elif kind == "garbage":
+            pos = rng.randint(0, len(text))
+            ruido = "".join(rng.choice("0123456789 ,./|-_:#lI") for _ in range(rng.randint(100, max_len // 4)))
+            text = text[:pos] + ruido + text[pos:]
+        elif kind == "repeat" and text:
+            a = rng.randint(0, len(text) - 1)
+            fragmento = text[a:a + rng.randint(10, 200)]
+            text = text + " " + fragmento * rng.randint(10, max_len // max(1, len(fragmento)))
+        elif kind == "no_anchor":
+            text = re.sub(re.escape(rng.choice(FUZZ_ANCHORS)), "", text, flags=re.I)
+    return text[:max_len]
+
+def bench_fuzz(args):
+    if args.budget is not None:
+        invoice_data.set_extractor_time_budget(args.budget)
+    rng = random.Random(args.seed)
+    base = load_sample_invoice_page()
+    variantes = [base] + [mutate_ocr_text(base, rng, args.max_len) for _ in range(args.cases)]
+    print(f"🧨 Fuzz de extractores: {len(variantes)} textos (≤{args.max_len} caracteres), "
+          f"presupuesto {invoice_data.EXTRACTOR_TIME_BUDGET or 'desactivado'}")
+
+    peores = []
+    for fn in FUZZ_EXTRACTORS:
+        tiempos = []
+        for texto in variantes:
+            start = time.perf_counter()
+            fn(texto)
+            tiempos.append((time.perf_counter() - start, texto))
+        tiempos.sort(key=lambda t: t[0])
+        p99 = tiempos[int(len(tiempos) * 0.99) - 1][0]
+        maximo, peor_texto = tiempos[-1]
+        print(f"  {fn.__name__:<25} p50 {tiempos[len(tiempos) // 2][0] * 1000:8.2f} ms | "
+              f"p99 {p99 * 1000:8.2f} ms | máx {maximo * 1000:9.2f} ms")
+        peores.append({"extractor": fn.__name__, "segundos": maximo, "texto": peor_texto})
+
+    if args.save_worst:
+        with open(args.save_worst, "w", encoding="utf-8") as f:
+            json.dump(peores, f, ensure_ascii=False, indent=2)
+        print(f"  Peores entradas guardadas en {args.save_worst}")
+
+# --------------------------- REGISTRO DE FACTURA -------------------------------------
+
+def _legacy_normalize_invoice(invoice):
+    """normalize_invoice de pdf_library antes del registro Invoice (línea base)."""
+    def normalize_value(v):
+        if isinstance(v, str):
+            v = re.sub(r'\s+', ' ', v.strip())
+        elif isinstance(v, list):
+            return [normalize_value(i) for i in v]
+        elif isinstance(v, dict):
+            return {k: normalize_value(vv) for k, vv in v.items()}
+        return v
+    return normalize_value(invoice)
+
+def _legacy_identity(invoice):
+    """Hash de duplicados como se armaba en read_pdfs_files (JSON reconstruido)."""
+    clave_unica = json.dumps({
+        'Invoice No': invoice.get('Invoice No'),
+        'Invoice Date': invoice.get('Invoice Date'),
+        'S/O#': invoice.get('S/O#'),
+        'Incotenn': invoice.get('Incotenn'),
+        'Payment Terms': invoice.get('Payment Terms'),
+        'Ship Date': invoice.get('Ship Date'),
+        'Due Date': invoice.get('Due Date'),
+        'Method of Shipment': invoice.get('Method of Shipment'),
+        'Subtotal': invoice.get('Subtotal'),
+        'Total': invoice.get('Total'),
+    }, sort_keys=True)
+    return hashlib.sha256(clave_unica.encode()).hexdigest()
+
+def sample_invoice_fields():
+    """Campos crudos (sin normalizar) de la factura de ejemplo, como salen de los extractores."""
+    texto = re.sub(r"[\r\n]+", " ", load_sample_invoice_page())
+    headers = extract_headers(texto)
+    terms = extract_shipping_terms(texto)
+    addresses = extract_shipto_billto(load_sample_invoice_page())
+    totals = extract_totals(texto)
+    return {
+        "File": "41735S_factura.pdf", "File_path": "C:/facturas/41735S_factura.pdf",
+        "Invoice No": headers["Invoice No"], "Invoice Date": headers["Invoice Date"],
+        "S/O#": extract_so_no(texto)["S/O NO"], "Incotenn": terms["Incoterm"],
+        "Payment Terms": terms["Payment Terms"], "Ship Date": terms["Ship Date"],
+        "Due Date": terms["Due Date"], "Method of Shipment": terms["Method of Shipment"],
+        "Ship To": addresses["Ship To"], "Bill To": addresses["Bill To"],
+        "Subtotal": totals["Subtotal"], "Total": totals["Total"], "Invoice Page": 0,
+        "Product Details": [extract_product_detail(texto)],
+    }
+
+def build_legacy(campos):
+    invoice = _legacy_normalize_invoice(dict(campos, **{"Product Details": [dict(p) for p in campos["Product Details"]]}))
+    return invoice, _legacy_identity(invoice)
+
+def build_record(campos):
+    return Invoice(
+        file=campos["File"], file_path=campos["File_path"], invoice_no=campos["Invoice No"],
+        invoice_date=campos["Invoice Date"], so_no=campos["S/O#"], incoterm=campos["Incotenn"],
+        payment_terms=campos["Payment Terms"], ship_date=campos["Ship Date"], due_date=campos["Due Date"],
+        method_of_shipment=campos["Method of Shipment"], ship_to=campos["Ship To"], bill_to=campos["Bill To"],
+        subtotal=campos["Subtotal"], total=campos["Total"], invoice_page=campos["Invoice Page"],
+        products=[ProductLine.from_fields(p) for p in campos["Product Details"]],
+    )
+
+def bytes_per_record(builder, campos, cantidad):
+    tracemalloc.start()
+    antes = tracemalloc.get_traced_memory()[0]
+    registros = [builder(campos) for _ in range(cantidad)]
+    despues = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del registros
+    return (despues - antes) / cantidad
+
+def bench_record(args):
+    campos = sample_invoice_fields()
+    print(f"🧱 Registro de factura: {args.repeat} construcciones (normalización + hash de identidad)")
+
+    legacy, legacy_hash = build_legacy(campos)
+    record = build_record(campos)
+    print(f"  Mismo hash de identidad que antes: {'sí' if record.identity == legacy_hash else 'NO'}")
+
+    for nombre, builder in (("dict + normalize_invoice + json/sha256", build_legacy),
+                            ("Invoice (slots, hash precalculado)", build_record)):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            builder(campos)
+        report(nombre, time.perf_counter() - start, args.repeat, "factura")
+        print(f"  {'':<40} {bytes_per_record(builder, campos, args.memory_records):9.0f} bytes/factura")
+
+# --------------------------- RENDER DE PDFs EN LOTE ----------------------------------
+
+DEFAULT_TEMPLATE_PATH = os.path.join(BASE_DIR, "Template", "invoice_design.html")
+
+def _legacy_crear_pdf(nombre_archivo_pdf, invoice_data, template_path):
+    """crear_pdf_factura_desde_archivo antes del caché de plantilla (línea base)."""
+    from xhtml2pdf import pisa
+    with open(template_path, 'r', encoding='utf-8') as f:
+        template = Template(f.read())
+    product_rows_html = ""
+    for item in invoice_data.get('Product Details', []):
+        product_rows_html += f"""
+        <tr>
+            <td>{item.get('Product No.', 'N/D')}</td>
+            <td>{item.get('Description', 'N/D')}</td>
+            <td class="align-right">{item.get('Item Qty', '0')} {item.get('U/M', '')}</td>
+            <td class="align-right">{item.get('Price Each', '0')}</td>
+            <td class="align-right">{item.get('Amount', '0')}</td>
+        </tr>
+        """
+    data_final = {k.replace(' ', '_'): v for k, v in invoice_data.items()}
+    data_final['Bill_To'] = invoice_data.get('Bill To', 'N/D').replace('\n', '<br>')
+    data_final['Ship_To'] = invoice_data.get('Ship To', 'N/D').replace('\n', '<br>')
+    first_product = invoice_data.get('Product Details', [{}])
+    data_final['Product_U/M'] = first_product[0].get('U/M', 'N/D') if first_product and first_product[0] else 'N/D'
+    data_final['Product_Rows'] = product_rows_html
+    print(data_final)
+    final_html = re.sub(r'\s+', ' ', template.safe_substitute(data_final)).strip()
+    with open(nombre_archivo_pdf, "w+b") as result_file:
+        pisa_status = pisa.CreatePDF(final_html, dest=result_file, link_callback=link_callback)
+    return not pisa_status.err
+
+def bench_render(args):
+    campos = sample_invoice_fields()
+    facturas = [dict(campos, **{"Invoice No": f"{campos['Invoice No']}-{i}"}) for i in range(args.count)]
+    salida = tempfile.mkdtemp(prefix="render_bench_")
+    print(f"🖨️ Render de PDFs: {args.count} factura(s), plantilla {args.template}")
+
+    try:
+        with redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            for factura in facturas:
+                _legacy_crear_pdf(os.path.join(salida, f"{factura['Invoice No']}.pdf"), factura, args.template)
+            legacy = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for factura in facturas:
+                crear_pdf_factura_desde_archivo(os.path.join(salida, f"{factura['Invoice No']}.pdf"), factura, args.template)
+            cacheado = time.perf_counter() - start
+
+            start = time.perf_counter()
+            escritos = sum(ok for _, ok in render_invoice_pdfs(facturas, args.template, salida, workers=args.workers))
+            lote = time.perf_counter() - start
+
+        report("por llamada (relee plantilla y CSS)", legacy, args.count)
+        report("plantilla/CSS en caché, secuencial", cacheado, args.count)
+        report(f"lote en pool ({args.workers or os.cpu_count()} procesos)", lote, args.count)
+        print(f"  PDFs escritos por el lote: {escritos}/{args.count}")
+    finally:
+        shutil.rmtree(salida, ignore_errors=True)
+
+# --------------------------- MIME EN STREAMING ---------------------------------------
+
+def build_mail_with_pdf(size_mb):
+    """Correo sintético con un PDF adjunto de size_mb MB (contenido aleatorio)."""
+    msg = EmailMessage()
+    msg["Subject"] = "Factura de prueba"
+    msg["Message-ID"] = "<benchmark@local>"
+    msg.set_content("Adjunto factura.")
+    pdf = b"%PDF-1.4\n" + os.urandom(int(size_mb * 1024 * 1024)) + b"\n%%EOF"
+    msg.add_attachment(pdf, maintype="application", subtype="pdf", filename="factura.pdf")
+    return msg.as_bytes()
+
+def bench_mime(args):
+    raw = build_mail_with_pdf(args.size_mb)
+    salida = tempfile.mkdtemp(prefix="mime_bench_")
+    print(f"📨 Correo de {len(raw) / 1024 / 1024:.1f} MB con un PDF de {args.size_mb} MB "
+          f"(pedazos de {args.chunk_kb} KB para el streaming)")
+
+    def completo():
+        msg = email.message_from_bytes(raw, policy=policy.default)
+        for part in msg.walk():
+            if part.get_filename():
+                with open(os.path.join(salida, "completo.pdf"), "wb") as f:
+                    f.write(part.get_payload(decode=True))
+
+    def streaming():
+        parser = StreamingMimeParser(salida, lambda filename, ctype: True)
+        chunk = args.chunk_kb * 1024
+        for i in range(0, len(raw), chunk):
+            parser.feed(raw[i:i + chunk])
+        parser.close()
+
+    try:
+        for nombre, fn in (("message_from_bytes + get_payload", completo), ("StreamingMimeParser", streaming)):
+            tracemalloc.start()
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+            pico = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            report(nombre, elapsed, 1, "correo")
+            print(f"  {'':<40} pico de memoria {pico / 1024 / 1024:8.2f} MB (sin contar el correo crudo)")
+    finally:
+        shutil.rmtree(salida, ignore_errors=True)
+
+# --------------------------- ALMACÉN DE ADJUNTOS --------------------------------------
+
+def bench_store(args):
+    """
+    Archivo histórico de args.docs PDFs (pocos bytes cada uno) con args.pending
+    pendientes: carpeta plana (get_pdf_paths + unique_path) vs almacén por SHA-256.
+    """
+    raiz = tempfile.mkdtemp(prefix="store_bench_")
+    plana = os.path.join(raiz, "plana")
+    os.makedirs(plana)
+    print(f"🗄️ {args.docs} PDFs en el histórico, {args.pending} pendientes, {args.collisions} con el mismo nombre")
+
+    try:
+        store = AttachmentStore(os.path.join(raiz, "store"))
+        start = time.perf_counter()
+        for i in range(args.docs):
+            contenido = f"%PDF-1.4 documento {i}".encode()
+            with open(os.path.join(plana, f"{i}_factura.pdf"), "wb") as f:
+                f.write(contenido)
+            tmp_path = os.path.join(store.incoming_folder, "tmp.part")
+            with open(tmp_path, "wb") as f:
+                f.write(contenido)
+            estado = STATE_PENDING if i >= args.docs - args.pending else STATE_PROCESSED
+            store.put_file(tmp_path, original_name=f"{i}_factura.pdf", state=estado)
+        print(f"  (armado en {time.perf_counter() - start:.1f} s)")
+
+        repeticiones = 20
+        start = time.perf_counter()
+        for _ in range(repeticiones):
+            pendientes_planos = get_pdf_paths(plana)
+        report("pendientes: recorrer carpeta plana", time.perf_counter() - start, repeticiones, "corrida")
+        start = time.perf_counter()
+        for _ in range(repeticiones):
+            pendientes = store.by_state(STATE_PENDING)
+        report("pendientes: índice por estado", time.perf_counter() - start, repeticiones, "corrida")
+        print(f"  {'':<40} {len(pendientes_planos)} archivos recorridos vs {len(pendientes)} filas leídas")
+
+        # Mismo nombre repetido: unique_path prueba os.path.exists hasta encontrar hueco
+        nombre = os.path.join(plana, "repetido.pdf")
+        start = time.perf_counter()
+        for i in range(args.collisions):
+            with open(unique_path(nombre), "wb") as f:
+                f.write(f"repetido {i}".encode())
+        report("guardar con nombre repetido (unique_path)", time.perf_counter() - start, args.collisions, "PDF")
+        start = time.perf_counter()
+        for i in range(args.collisions):
+            tmp_path = os.path.join(store.incoming_folder, "tmp.part")
+            with open(tmp_path, "wb") as f:
+                f.write(f"repetido {i}".encode())
+            store.put_file(tmp_path, original_name="repetido.pdf")
+        report("guardar en el almacén (put_file)", time.perf_counter() - start, args.collisions, "PDF")
+
+        sha256 = hashlib.sha256(f"%PDF-1.4 documento {args.docs // 2}".encode()).hexdigest()
+        start = time.perf_counter()
+        for _ in range(1000):
+            store.contains(sha256)
+        report("¿ya existe? (índice por SHA-256)", time.perf_counter() - start, 1000, "consulta")
+        store.close()
+    finally:
+        shutil.rmtree(raiz, ignore_errors=True)
+
+# --------------------------- SERVICIO HTTP (PRUEBA DE CARGA) -------------------------
+
+def post_pdf(url, pdf_bytes, name, timeout):
+    """Un POST /extract; devuelve (código HTTP, segundos)."""
+    request = urllib.request.Request(
+        f"{url}/extract?name={urllib.request.quote(name)}", data=pdf_bytes,
+        headers={"Content-Type": "application/pdf"}, method="POST"
+    )
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except (urllib.error.URLError, OSError):
+        status = 0  # sin respuesta (conexión rechazada/reseteada o tiempo agotado en el cliente)
+    return status, time.perf_counter() - start
+
+def bench_service(args):
+    pdfs = [(info["nombre_con_ext"], open(info["ruta"], "rb").read()) for info in get_pdf_paths(args.folder)]
+    if not pdfs:
+        print(f"❌ No hay PDFs en {args.folder}")
+        return
+    url = args.url.rstrip("/")
+    print(f"🌐 {args.requests} solicitud(es) a {url} con {args.concurrency} cliente(s) concurrentes "
+          f"({len(pdfs)} PDF(s) distintos)")
+
+    def one(i):
+        name, pdf_bytes = pdfs[i % len(pdfs)]
+        return post_pdf(url, pdf_bytes, name, args.timeout)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        resultados = list(executor.map(one, range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    por_codigo = {}
+    for status, _ in resultados:
+        por_codigo[status] = por_codigo.get(status, 0) + 1
+    ok = sorted(seconds for status, seconds in resultados if status == 200)
+    print(f"  Respuestas por código: {dict(sorted(por_codigo.items()))}")
+    print(f"  Rendimiento: {len(ok) / elapsed:.2f} facturas/s ({elapsed:.1f} s en total)")
+    if ok:
+        print(f"  Latencia cliente (200): p50 {percentile(ok, 50) * 1000:.0f} ms | "
+              f"p90 {percentile(ok, 90) * 1000:.0f} ms | p99 {percentile(ok, 99) * 1000:.0f} ms | "
+              f"max {ok[-1] * 1000:.0f} ms")
+
+    try:
+        with urllib.request.urlopen(f"{url}/metrics", timeout=10) as response:
+            metrics = json.load(response)
+        latency = metrics["latency_ms"]
+        print(f"  Latencia servidor: p50 {latency['p50']} ms | p99 {latency['p99']} ms "
+              f"(ventana {latency['window']}, workers {metrics['workers']})")
+    except (urllib.error.URLError, TimeoutError, KeyError) as e:
+        print(f"  ⚠️ No se pudo leer /metrics: {e}")
+
+# --------------------------- PIPELINE SERIAL VS ASÍNCRONO ----------------------------
+# Buzón y base de datos simulados con una latencia fija por comando (el viaje de red),
+# para comparar main() (correo, después extracción e inserción) con async_pipeline
+# sobre los mismos PDFs y la misma extracción real.
+
+def simulated_bodystructure(part):
+    """BODYSTRUCTURE (RFC 3501) de un EmailMessage, como lo respondería el servidor."""
+    if part.get_content_type() == "message/rfc822":
+        interno = part.get_payload(0)
+        sobre = "(" + " ".join(["NIL"] * 10) + ")"
+        return (f'("MESSAGE" "RFC822" NIL NIL NIL "7BIT" {len(interno.as_bytes())} {sobre} '
+                f'{simulated_bodystructure(interno)} 0 NIL NIL NIL)')
+    if part.is_multipart():
+        hijos = "".join(simulated_bodystructure(p) for p in part.iter_parts())
+        return f'({hijos} "{part.get_content_subtype().upper()}" ("BOUNDARY" "{part.get_boundary()}") NIL NIL)'
+    params = [(k, v) for k, v in part.get_params() or [] if v][1:]
+    params = "(" + " ".join(f'"{k.upper()}" "{v}"' for k, v in params) + ")" if params else "NIL"
+    cuerpo = part.get_payload()
+    cuerpo = cuerpo if isinstance(cuerpo, str) else ""
+    encoding = str(part.get("Content-Transfer-Encoding", "7BIT")).upper()
+    estructura = (f'("{part.get_content_maintype().upper()}" "{part.get_content_subtype().upper()}" {params} '
+                  f'NIL NIL "{encoding}" {len(cuerpo)}')
+    if part.get_content_maintype() == "text":
+        estructura += f" {cuerpo.count(chr(10))}"
+    disposicion = part.get_content_disposition()
+    if disposicion and part.get_filename():
+        estructura += f' NIL ("{disposicion.upper()}" ("FILENAME" "{part.get_filename()}")) NIL)'
+    else:
+        estructura += " NIL NIL NIL)"
+    return estructura
+
+class SimulatedIMAP:
+    """
+    Buzón en memoria: cada comando duerme `latency` segundos como un viaje al servidor.
+    Con raw_search=True anuncia X-GM-EXT-1 y X-GM-RAW solo devuelve correos con PDF.
+    """
+
+    def __init__(self, messages, latency, raw_search=False):
+        self.messages = messages
+        self.latency = latency
+        self.capabilities = ("IMAP4REV1", "X-GM-EXT-1") if raw_search else ("IMAP4REV1",)
+        self.bytes_sent = 0
+        time.sleep(latency * 2)  # conexión TLS + LOGIN
+
+    def _message(self, num):
+        return self.messages[int(num) - 1]
+
+    def _has_pdf(self, raw):
+        msg = email.message_from_bytes(raw, policy=policy.default)
+        return any(p.get_content_type() == "application/pdf" for p in msg.walk())
+
+    def select(self, mailbox):
+        time.sleep(self.latency)
+        return "OK", [str(len(self.messages)).encode()]
+
+    def search(self, charset, query):
+        time.sleep(self.latency)
+        numeros = range(1, len(self.messages) + 1)
+        if "X-GM-RAW" in query and "X-GM-EXT-1" in self.capabilities:
+            numeros = [n for n in numeros if self._has_pdf(self._message(n))]
+        return "OK", [b" ".join(str(n).encode() for n in numeros)]
+
+    def _reply(self, data):
+        self.bytes_sent += sum(len(d[0]) + len(d[1]) if isinstance(d, tuple) else len(d) for d in data)
+        return "OK", data
+
+    def fetch(self, num, query):
+        time.sleep(self.latency)
+        if "BODYSTRUCTURE" in query:
+            lineas = []
+            for n in str(num.decode() if isinstance(num, bytes) else num).split(","):
+                raw = self._message(n)
+                estructura = simulated_bodystructure(email.message_from_bytes(raw, policy=policy.default))
+                lineas.append(f"{n} (RFC822.SIZE {len(raw)} BODYSTRUCTURE {estructura})".encode())
+            return self._reply(lineas)
+        raw = self._message(num)
+        if "HEADER" in query:
+            headers = raw.split(b"\r\n\r\n", 1)[0] + b"\r\n\r\n"
+            return self._reply([(b"1 (BODY[HEADER] {%d}" % len(headers), headers), b")"])
+        if "RFC822.SIZE" in query:
+            return self._reply([b"%s (RFC822.SIZE %d)" % (str(int(num)).encode(), len(raw))])
+        inicio, largo = map(int, re.search(r"<(\d+)\.(\d+)>", query).groups())
+        chunk = raw[inicio:inicio + largo]
+        return self._reply([(b"1 (BODY[]<%d> {%d}" % (inicio, len(chunk)), chunk), b")"])
+
+    def store(self, message_set, command, flags):
+        time.sleep(self.latency)
+        return "OK", []
+
+    def noop(self):
+        time.sleep(self.latency)
+
+    def close(self):
+        time.sleep(self.latency)
+
+    def logout(self):
+        time.sleep(self.latency)
+
+class SimulatedCursor:
+    def __init__(self, db):
+        self.db = db
+        self.lastrowid = None
+
+    def execute(self, sql, params=None):
+        time.sleep(self.db.latency)
+        if sql.lstrip().upper().startswith("INSERT"):
+            self.db.rows += 1
+            self.lastrowid = self.db.rows
+
+    def fetchone(self):
+        return (0,)  # ningún duplicado en la base
+
+    def close(self):
+        pass
+
+class SimulatedDB:
+    """Conexión MySQL simulada: cada sentencia y cada COMMIT duermen `latency` segundos."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.rows = 0
+
+    def cursor(self):
+        return SimulatedCursor(self)
+
+    def commit(self):
+        time.sleep(self.latency)
+
+    def rollback(self):
+        time.sleep(self.latency)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def build_mailbox(pdf_paths, count):
+    """count correos con un PDF cada uno; se repiten los PDFs con bytes extra para que cada adjunto sea distinto."""
+    messages = []
+    for i in range(count):
+        info = pdf_paths[i % len(pdf_paths)]
+        with open(info["ruta"], "rb") as f:
+            pdf = f.read()
+        if i >= len(pdf_paths):
+            pdf += f"\n%bench {i}\n".encode()
+        msg = EmailMessage()
+        msg["Subject"] = f"Factura {i}"
+        msg["From"] = "facturacion@proveedor.com"
+        msg["Message-ID"] = f"<pipeline-{i}@benchmark>"
+        msg.set_content("Adjunto factura.")
+        msg.add_attachment(pdf, maintype="application", subtype="pdf", filename=info["nombre_con_ext"])
+        messages.append(msg.as_bytes(policy=policy.SMTP))
+    return messages
+
+def bench_pipeline(args):
+    from email_library import DEFAULT_CONFIG, process_mailbox
+    from mysql_connector import insert_and_commit
+    from pdf_library import read_pdfs_files
+    from async_pipeline import run_async_pipeline
+
+    pdf_paths = get_pdf_paths(args.folder)
+    if not pdf_paths:
+        print(f"❌ No hay PDFs en {args.folder}")
+        return
+    messages = build_mailbox(pdf_paths, args.messages)
+    print(f"📨 {len(messages)} correo(s) con {len(pdf_paths)} PDF(s) distintos | latencia IMAP "
+          f"{args.imap_ms:.0f} ms, MySQL {args.db_ms:.0f} ms por comando")
+
+    def serial(cfg):
+        # Mismo orden que main(): todo el correo, después extracción + inserción
+        imap = SimulatedIMAP(messages, args.imap_ms / 1000)
+        process_mailbox(imap, cfg)
+        imap.close()
+        imap.logout()
+        with SimulatedDB(args.db_ms / 1000) as conn:
+            invoices = read_pdfs_files(
+                cfg["download_folder"], on_invoice=lambda invoice: insert_and_commit(conn, invoice),
+                fast_workers=cfg["fast_lane_workers"], ocr_workers=cfg["ocr_lane_workers"],
+            )
+        return len(invoices)
+
+    def asincrono(cfg):
+        stats = run_async_pipeline(
+            cfg,
+            connect_mail=lambda cfg: SimulatedIMAP(messages, args.imap_ms / 1000),
+            connect_db=lambda: SimulatedDB(args.db_ms / 1000),
+        )
+        return stats["extraidos"]
+
+    cwd = os.getcwd()
+    for nombre, corrida in (("serial (main)", serial), ("asyncio (async_pipeline)", asincrono)):
+        raiz = tempfile.mkdtemp(prefix="pipeline_bench_")
+        cfg = dict(DEFAULT_CONFIG)
+        cfg.update({
+            "download_folder": os.path.join(raiz, "descargas"),
+            "history_file": os.path.join(raiz, "processed_emails.json"),
+            "search_by": None,
+            "fast_lane_workers": args.fast,
+            "ocr_lane_workers": args.ocr,
+            "async_imap_connections": args.connections,
+        })
+        os.makedirs(cfg["download_folder"])
+        try:
+            # processed_pdfs.json vive en ./temp: cada corrida parte de cero
+            os.chdir(raiz)
+            start = time.perf_counter()
+            with redirect_stdout(io.StringIO()):
+                facturas = corrida(cfg)
+            elapsed = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(raiz, ignore_errors=True)
+        print(f"  {nombre:<28} {elapsed:7.2f} s | {len(messages) / elapsed:6.2f} correos/s | "
+              f"{facturas} factura(s) nuevas")
+
+# --------------------------- FILTRO DE CORREOS EN EL SERVIDOR ------------------------
+
+def build_noise_mail(i, image_kb):
+    """Boletín o respuesta sin PDF, con una imagen en línea de image_kb KB."""
+    msg = EmailMessage()
+    msg["Subject"] = f"Boletín semanal {i}" if i % 2 else f"RE: Confirmación de embarque {i}"
+    msg["From"] = "noticias@proveedor.com"
+    msg["Message-ID"] = f"<ruido-{i}@benchmark>"
+    msg.set_content("Ver imagen.")
+    msg.add_alternative("<html><body><img src='cid:logo'></body></html>", subtype="html")
+    msg.get_payload()[1].add_related(os.urandom(image_kb * 1024), maintype="image", subtype="png", cid="<logo>")
+    return msg.as_bytes(policy=policy.SMTP)
+
+def bench_filter(args):
+    from email_library import DEFAULT_CONFIG, process_mailbox
+
+    pdf_paths = get_pdf_paths(args.folder)
+    if not pdf_paths:
+        print(f"❌ No hay PDFs en {args.folder}")
+        return
+    facturas = build_mailbox(pdf_paths, args.invoices)
+    ruido = [build_noise_mail(i, args.image_kb) for i in range(args.invoices * args.noise)]
+    # Los correos sin PDF quedan intercalados con las facturas
+    messages = [m for par in zip(facturas, *[ruido[i::args.noise] for i in range(args.noise)]) for m in par]
+    print(f"📨 {len(facturas)} correo(s) con factura + {len(ruido)} sin PDF (imagen de {args.image_kb} KB) | "
+          f"{sum(map(len, messages)) / 1024 / 1024:.1f} MB en el buzón, latencia {args.imap_ms:.0f} ms")
+
+    modos = (
+        ("sin filtro", {"search_raw": None, "bodystructure_prefilter": False}, False),
+        ("prefiltro BODYSTRUCTURE", {"search_raw": None, "bodystructure_prefilter": True}, False),
+        ("X-GM-RAW (Gmail)", {}, True),
+    )
+    for nombre, ajustes, raw_search in modos:
+        raiz = tempfile.mkdtemp(prefix="filter_bench_")
+        cfg = dict(DEFAULT_CONFIG)
+        cfg.update({
+            "download_folder": os.path.join(raiz, "descargas"),
+            "history_file": os.path.join(raiz, "processed_emails.json"),
+            "header_probe_budget": 0,
+        })
+        cfg.update(ajustes)
+        os.makedirs(cfg["download_folder"])
+        imap = SimulatedIMAP(messages, args.imap_ms / 1000, raw_search=raw_search)
+        try:
+            start = time.perf_counter()
+            with redirect_stdout(io.StringIO()):
+                stats = process_mailbox(imap, cfg)
+            elapsed = time.perf_counter() - start
+        finally:
+            shutil.rmtree(raiz, ignore_errors=True)
+        print(f"  {nombre:<26} {elapsed:6.2f} s | {stats.downloaded:4d} correo(s) descargados | "
+              f"{imap.bytes_sent / 1024 / 1024:7.2f} MB del servidor | PDFs {stats.pdf_bytes / 1024 / 1024:6.2f} MB "
+              f"({stats.pdf_bytes / max(1, imap.bytes_sent):.0%})")
+
+# --------------------------- PLANTILLAS POR HUELLA -----------------------------------
+# Sin carpeta se usa la página de ejemplo (plantilla Sterling) y una variante con otro
+# remitente que la huella no reconoce y debe ir por el camino genérico.
+
+UNKNOWN_SENDER = (("Sterling International", "Gulf Coast Resins"), ("18167 E. Petroleum Dr.", "4410 Harbor Blvd."),
+                  ("27-3183164", "74-5501982"))
+
+def synthetic_snapshots(docs, unknown_share):
+    sample = load_sample_invoice_page()
+    unknown = sample
+    for old, new in UNKNOWN_SENDER:
+        unknown = unknown.replace(old, new)
+    snapshots = []
+    for i in range(docs):
+        text = unknown if i < docs * unknown_share else sample
+        snapshots.append((f"sintetico_{i}.pdf", {"invoice_page": 0, "page_text": text, "regions": None,
+                                                  "text_layer": False, "full_text": text, "template": None}))
+    return snapshots
+
+def time_fields(snapshots, repeat):
+    """Campos y ms promedio por documento de extract_fields con el despacho actual."""
+    resultados = []
+    for pdf_path, snapshot in snapshots:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            copia = dict(snapshot)
+            invoice = invoice_data.extract_fields(copia, pdf_path)
+        resultados.append((copia["template"], invoice.to_dict(), (time.perf_counter() - start) / repeat))
+    return resultados
+
+def bench_templates(args):
+    if args.folder:
+        pdf_paths = [info["ruta"] for info in get_pdf_paths(args.folder)]
+        # El OCR / texto de páginas queda fuera del tiempo: se compara solo el parseo
+        snapshots = [(pdf_path, invoice_data.collect_invoice_text(pdf_path)) for pdf_path in pdf_paths]
+    else:
+        snapshots = synthetic_snapshots(args.docs, args.unknown)
+    print(f"🧩 Plantillas por huella vs cascada genérica: {len(snapshots)} documento(s), {args.repeat} repetición(es)")
+
+    # Calentamiento: la primera pasada compila y cachea los patrones de ambos caminos
+    time_fields(snapshots, 1)
+    invoice_data.set_template_dispatch(False)
+    time_fields(snapshots, 1)
+    generico = time_fields(snapshots, args.repeat)
+    invoice_data.set_template_dispatch(True)
+    con_plantilla = time_fields(snapshots, args.repeat)
+
+    por_plantilla = {}
+    for (_, esperado, t_gen), (template, obtenido, t_tpl) in zip(generico, con_plantilla):
+        fila = por_plantilla.setdefault(template, {"docs": 0, "generico": 0.0, "plantilla": 0.0, "campos": 0, "iguales": 0})
+        fila["docs"] += 1
+        fila["generico"] += t_gen
+        fila["plantilla"] += t_tpl
+        for campo in COMPARE_FIELDS:
+            fila["campos"] += 1
+            fila["iguales"] += obtenido.get(campo) == esperado.get(campo)
+
+    total = len(snapshots)
+    for template, fila in sorted(por_plantilla.items(), key=lambda kv: kv[0] is None):
+        docs = fila["docs"]
+        print(f"  {template or 'genérico (sin plantilla)':<26} {docs:5d} doc(s) ({docs / total:6.1%}) | "
+              f"cascada {fila['generico'] / docs * 1000:8.3f} ms | despacho {fila['plantilla'] / docs * 1000:8.3f} ms | "
+              f"x{fila['generico'] / max(fila['plantilla'], 1e-9):5.1f} | campos iguales {fila['iguales'] / fila['campos']:.1%}")
+
+    t_gen = sum(t for _, _, t in generico)
+    t_tpl = sum(t for _, _, t in con_plantilla)
+    print(f"  {'corrida completa':<26} {total:5d} doc(s)          | cascada {t_gen * 1000:8.1f} ms | "
+          f"despacho {t_tpl * 1000:8.1f} ms | x{t_gen / max(t_tpl, 1e-9):5.1f}")
+
+# --------------------------- WORKERS ADAPTATIVOS -------------------------------------
+# Documentos simulados (CPU y memoria por documento) en los dos carriles: tope fijo
+# (default_workers) contra AdaptiveWorkers sobre los mismos IsolatedPool.
+
+def simulated_document(task):
+    """Worker: 'carril:ms:mb' -> ocupa la CPU ms milisegundos con mb MB reservados."""
+    _, ms, mb = task.split(":")
+    memoria = bytearray(int(mb) * 1024 * 1024)
+    fin = time.perf_counter() + int(ms) / 1000
+    while time.perf_counter() < fin:
+        pass
+    return len(memoria)
+
+def run_simulated_lanes(tasks, fast_workers, ocr_workers, adaptive=None):
+    lanes = {
+        FAST_LANE: IsolatedPool(simulated_document, fast_workers),
+        OCR_LANE: IsolatedPool(simulated_document, ocr_workers),
+    }
+    controller = AdaptiveWorkers(lanes, **adaptive) if adaptive else None
+    start = time.perf_counter()
+    try:
+        for task in tasks:
+            lanes[task.split(":")[0]].submit(task)
+        while any(pool.pending() for pool in lanes.values()):
+            for pool in lanes.values():
+                if pool.pending():
+                    pool.poll(timeout=0.02)
+            if controller is not None:
+                controller.tick()
+        return time.perf_counter() - start, controller
+    finally:
+        for pool in lanes.values():
+            pool.shutdown()
+
+def bench_workers(args):
+    fast, ocr = default_workers()
+    tasks = [f"{FAST_LANE}:{args.text_ms}:5"] * args.text + [f"{OCR_LANE}:{args.ocr_ms}:{args.ocr_mb}"] * args.ocr
+    print(f"🎛️ Workers fijos vs adaptativos: {args.text} doc(s) de texto ({args.text_ms} ms), "
+          f"{args.ocr} de OCR ({args.ocr_ms} ms, {args.ocr_mb} MB) | {os.cpu_count()} CPU(s)")
+
+    elapsed, _ = run_simulated_lanes(tasks, fast, ocr)
+    report(f"fijo ({fast} texto + {ocr} OCR)", elapsed, len(tasks))
+
+    adaptive = {"min_workers": 1, "max_workers": args.max_workers, "interval": args.interval,
+                "memory_reserve_mb": args.reserve_mb}
+    with redirect_stdout(io.StringIO()):
+        elapsed, controller = run_simulated_lanes(tasks, fast, ocr, adaptive)
+    report(f"adaptativo (máx {controller.max_workers})", elapsed, len(tasks))
+    controller.report()
+
+# --------------------------- CLI -----------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks del lector de facturas")
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+
+    p = sub.add_parser("pages", help="Clasificador de páginas en documentos largos")
+    p.add_argument("--pages", type=int, default=50)
+    p.add_argument("--repeat", type=int, default=200)
+    p.set_defaults(func=bench_pages)
+
+    p = sub.add_parser("ocr", help="OCR escalonado por DPI/confianza vs 300 DPI fijo")
+    p.add_argument("folder", help="Carpeta con PDFs escaneados")
+    p.add_argument("--expected", help="JSON con los campos esperados por archivo")
+    p.set_defaults(func=bench_ocr)
+
+    p = sub.add_parser("scan", help="Detección escaneado/texto por recursos vs pdfplumber")
+    p.add_argument("folder", help="Carpeta con un corpus mixto de PDFs")
+    p.set_defaults(func=bench_scan)
+
+    p = sub.add_parser("engine", help="Motor de texto por niveles vs pdfplumber en todas las páginas")
+    p.add_argument("folder", help="Carpeta con el corpus de regresión")
+    p.set_defaults(func=bench_engine)
+
+    p = sub.add_parser("layout", help="Extracción por coordenadas vs regex en PDFs con capa de texto")
+    p.add_argument("folder", help="Carpeta con PDFs de capa de texto")
+    p.set_defaults(func=bench_layout)
+
+    p = sub.add_parser("split", help="Separación de adjuntos: re-detectar página vs índice conocido")
+    p.add_argument("folder", help="Carpeta con PDFs de facturas")
+    p.set_defaults(func=bench_split)
+
+    p = sub.add_parser("fuzz", help="Peor latencia de los extractores con texto OCR ruidoso")
+    p.add_argument("--cases", type=int, default=300)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--max-len", type=int, default=40000)
+    p.add_argument("--budget", type=float, help="Presupuesto por extractor en segundos (0 = desactivado)")
+    p.add_argument("--save-worst", help="JSON donde guardar la peor entrada de cada extractor")
+    p.set_defaults(func=bench_fuzz)
+
+    p = sub.add_parser("record", help="Costo y memoria del registro Invoice vs diccionario normalizado")
+    p.add_argument("--repeat", type=int, default=20000)
+    p.add_argument("--memory-records", type=int, default=5000)
+    p.set_defaults(func=bench_record)
+
+    p = sub.add_parser("render", help="PDFs por segundo: render por llamada vs lote con plantilla en caché")
+    p.add_argument("--count", type=int, default=100)
+    p.add_argument("--workers", type=int)
+    p.add_argument("--template", default=DEFAULT_TEMPLATE_PATH)
+    p.set_defaults(func=bench_render)
+
+    p = sub.add_parser("mime", help="Pico de memoria: parseo MIME completo vs streaming a disco")
+    p.add_argument("--size-mb", type=float, default=30)
+    p.add_argument("--chunk-kb", type=int, default=1024)
+    p.set_defaults(func=bench_mime)
+
+    p = sub.add_parser("store", help="Pendientes y nombres repetidos: carpeta plana vs almacén por SHA-256")
+    p.add_argument("--docs", type=int, default=20000)
+    p.add_argument("--pending", type=int, default=20)
+    p.add_argument("--collisions", type=int, default=500)
+    p.set_defaults(func=bench_store)
+
+    p = sub.add_parser("service", help="Prueba de carga del servicio HTTP: p50/p99 con clientes concurrentes")
+    p.add_argument("folder", help="Carpeta con los PDFs a enviar (se reparten en ronda)")
+    p.add_argument("--url", default="http://127.0.0.1:8085")
+    p.add_argument("--concurrency", type=int, default=8)
+    p.add_argument("--requests", type=int, default=200)
+    p.add_argument("--timeout", type=float, default=300)
+    p.set_defaults(func=bench_service)
+
+    p = sub.add_parser("pipeline", help="main() serial vs pipeline asíncrono con IMAP y MySQL simulados")
+    p.add_argument("folder", help="Carpeta con los PDFs que llegan como adjuntos")
+    p.add_argument("--messages", type=int, default=40)
+    p.add_argument("--imap-ms", type=float, default=40, help="Latencia por comando IMAP")
+    p.add_argument("--db-ms", type=float, default=10, help="Latencia por sentencia MySQL")
+    p.add_argument("--connections", type=int, default=2, help="Sesiones IMAP del pipeline asíncrono")
+    p.add_argument("--fast", type=int, default=2)
+    p.add_argument("--ocr", type=int, default=1)
+    p.set_defaults(func=bench_pipeline)
+
+    p = sub.add_parser("filter", help="Bytes descargados: sin filtro vs BODYSTRUCTURE vs X-GM-RAW")
+    p.add_argument("folder", help="Carpeta con los PDFs de las facturas")
+    p.add_argument("--invoices", type=int, default=20)
+    p.add_argument("--noise", type=int, default=3, help="Correos sin PDF por cada factura")
+    p.add_argument("--image-kb", type=int, default=400)
+    p.add_argument("--imap-ms", type=float, default=40)
+    p.set_defaults(func=bench_filter)
+
+    p = sub.add_parser("templates", help="Extractores por plantilla (huella) vs cascada genérica: aciertos y speedup")
+    p.add_argument("folder", nargs="?", help="Carpeta con PDFs; sin ella se usa la página de ejemplo")
+    p.add_argument("--docs", type=int, default=200)
+    p.add_argument("--unknown", type=float, default=0.25, help="Fracción de documentos de un remitente desconocido")
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_templates)
+
+    p = sub.add_parser("workers", help="Workers por carril: tope fijo vs controlador adaptativo (CPU, memoria, cola)")
+    p.add_argument("--text", type=int, default=60, help="Documentos de texto simulados")
+    p.add_argument("--text-ms", type=int, default=150)
+    p.add_argument("--ocr", type=int, default=6, help="Documentos de OCR simulados")
+    p.add_argument("--ocr-ms", type=int, default=1500)
+    p.add_argument("--ocr-mb", type=int, default=300)
+    p.add_argument("--max-workers", type=int, help="Tope total de ambos carriles (por defecto CPUs)")
+    p.add_argument("--interval", type=float, default=0.5)
+    p.add_argument("--reserve-mb", type=int, default=1024)
+    p.set_defaults(func=bench_workers)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -21,43 +21,45 @@ def get_pdf_paths(path):
             })
     return resultados
 
-def validateInvoiceData(invoice_data):
+def validateInvoiceData(invoice):
     """
-    Revisa el diccionario de datos extraídos para asegurarse de que no haya campos clave vacíos.
+    Revisa el registro Invoice extraído para asegurarse de que no haya campos clave vacíos.
     Devuelve una lista con los nombres de los campos que tienen datos faltantes.
     """
     campos_faltantes = []
 
-    # 1. Validar que el diccionario principal exista
-    if not invoice_data:
-        return ["Diccionario de datos vacío"]
+    # 1. Validar que el registro exista
+    if not invoice:
+        return ["Registro de factura vacío"]
 
     # 2. Definir y validar los campos clave
     # Puedes ajustar esta lista según qué campos consideres OBLIGATORIOS
-    campos_obligatorios = [
-        "Invoice No",
-        "Invoice Date",
-        "S/O#",
-        "Incotenn",
-        "Payment Terms",
-        "Bill To",
-        "Total"
-    ]
-
-    for campo in campos_obligatorios:
+    campos_obligatorios = {
+        "Invoice No": invoice.invoice_no,
+        "Invoice Date": invoice.invoice_date,
+        "S/O#": invoice.so_no,
+        "Incotenn": invoice.incoterm,
+        "Payment Terms": invoice.payment_terms,
+        "Bill To": invoice.bill_to,
+        "Total": invoice.total,
+    }
+
+    for campo, valor in campos_obligatorios.items():
         # Verifica si el valor es None o una cadena vacía ('' que también podría ser un valor "falsy")
-        if not invoice_data.get(campo):
+        if not valor:
             campos_faltantes.append(campo)
 
     # 3. Validar la lista de productos
-    if not invoice_data.get("Product Details"):
+    if not invoice.products:
         campos_faltantes.append("Product Details (lista vacía)")
+        return campos_faltantes
 
-    if not invoice_data.get("Product Details")[0].get('Product No.'):
+    producto = invoice.product
+    if not producto.product_no:
         campos_faltantes.append("Product No")
-    if not invoice_data.get("Product Details")[0].get('Item Qty'):
+    if not producto.item_qty:
         campos_faltantes.append("Item Qty")
-    if not invoice_data.get("Product Details")[0].get('U/M'):
+    if not producto.um:
         campos_faltantes.append("U/M")
 
     return campos_faltantes
@@ -103,7 +105,30 @@ def imap_date_format(date_str):
     dt = datetime.datetime.strptime(date_str, "%Y-%m-%d")
     return dt.strftime("%d-%b-%Y")
 
-def build_search_criteria(date_start, date_end=None, from_filter=None):
+def imap_quote(value):
+    """Cadena entre comillas para un criterio de SEARCH (escapa comillas y barras)."""
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def or_criteria(key, values):
+    """
+    Criterio KEY "valor" para cada valor separado por ';', combinados con OR:
+    (OR (OR KEY "a" KEY "b") KEY "c"). None si no hay valores.
+    """
+    items = [v.strip() for v in (values or "").split(";") if v.strip()]
+    if not items:
+        return None
+    query = f'{key} {imap_quote(items[0])}'
+    for item in items[1:]:
+        query = f'(OR {query} {key} {imap_quote(item)})'
+    return query
+
+def build_search_criteria(date_start, date_end=None, from_filter=None, subject_filter=None,
+                          min_size=None, max_size=None, raw_query=None):
+    """
+    Criterio de SEARCH. from_filter y subject_filter aceptan varios valores separados
+    por ';' (OR entre ellos); min_size/max_size son bytes (LARGER/SMALLER). raw_query
+    es una búsqueda nativa de Gmail (X-GM-RAW), solo si el servidor la soporta.
+    """
     start = imap_date_format(date_start)
     if date_end:
         end = imap_date_format(date_end)
@@ -112,23 +137,18 @@ def build_search_criteria(date_start, date_end=None, from_filter=None):
 
     criteria = [f'SINCE "{start}"', f'BEFORE "{end}"']
 
-    # 🔍 Soporta varios remitentes separados por ';'
-    if from_filter:
-        emails = [e.strip() for e in from_filter.split(";") if e.strip()]
-        if len(emails) == 1:
-            criteria.append(f'FROM "{emails[0]}"')
-        elif len(emails) > 1:
-            # Se van combinando correctamente usando OR
-            or_parts = []
-            for email_addr in emails:
-                or_parts.append(f'FROM "{email_addr}"')
-
-            # Construir la cadena tipo: (OR (OR FROM "a" FROM "b") FROM "c")
-            or_query = or_parts[0]
-            for next_part in or_parts[1:]:
-                or_query = f'(OR {or_query} {next_part})'
-
-            criteria.append(or_query)
+    # 🔍 Soporta varios remitentes / asuntos separados por ';'
+    for key, values in (("FROM", from_filter), ("SUBJECT", subject_filter)):
+        query = or_criteria(key, values)
+        if query:
+            criteria.append(query)
+
+    if min_size:
+        criteria.append(f"LARGER {int(min_size)}")
+    if max_size:
+        criteria.append(f"SMALLER {int(max_size)}")
+    if raw_query:
+        criteria.append(f"X-GM-RAW {imap_quote(raw_query)}")
 
     query = "(" + " ".join(criteria) + ")"
     return query
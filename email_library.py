@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 import json
 import re
@@ -5,9 +6,12 @@ import time
 import traceback
 import imaplib
 from email import policy
-from commons import build_search_criteria, load_history, save_history, already_processed, save_attachment, decode_mime_words
-import email
-from invoice_data import extract_headers, find_invoice_page_text, get_pdf_text_with_ocr_fallback
+from commons import build_search_criteria, load_history, save_history, already_processed, decode_mime_words
+from email.parser import BytesHeaderParser
+from invoice_data import probe_invoice_number
+from mime_stream import StreamingMimeParser
+from attachment_store import AttachmentStore, default_store_root
+from imap_filter import DownloadStats, supports_raw_search, prefilter_messages
 
 # ---------- DEFAULTS ----------
 DEFAULT_CONFIG = {
@@ -17,10 +21,51 @@ DEFAULT_CONFIG = {
     "password": "",
     "mailbox": "INBOX",
     "download_folder": str(Path.home() / "Downloads"),
+    "storage_folder": None,  # almacén por SHA-256; None = <download_folder>/store
     "date_start": "2025-10-01",
     "date_end": None,
+    "search_by": None,  # remitentes separados por ';'
+    "search_subject": None,  # palabras del asunto separadas por ';' (OR)
+    "search_min_size": None,  # bytes (LARGER); None = sin mínimo
+    "search_max_size": None,  # bytes (SMALLER)
+    "search_raw": "has:attachment filename:pdf",  # X-GM-RAW si el servidor lo soporta (Gmail); None = no usar
+    "bodystructure_prefilter": True,  # sin X-GM-RAW: omitir correos sin PDF antes de descargarlos
     "mark_as_seen": True,
-    "history_file": "processed_emails.json"
+    "history_file": "processed_emails.json",
+    "fast_lane_workers": None,  # None = reparto automático según CPUs
+    "ocr_lane_workers": None,
+    "ocr_page_workers": None,  # tope de OCR por página dentro de un documento
+    "header_probe_budget": 2.0,  # segundos máximos para nombrar un adjunto al descargarlo
+    "doc_timeout_seconds": 600,  # presupuesto por PDF antes de mandarlo a cuarentena
+    "doc_memory_mb": 2048,  # requiere psutil; None = sin límite de memoria
+    "mime_fetch_chunk": 1024 * 1024,  # bytes por FETCH parcial al descargar un correo
+    "work_queue": None,  # None = extracción local; "mysql" (base atc) o "sqlite" = cola compartida
+    "work_queue_sqlite": "temp/work_queue.sqlite",
+    "queue_lease_seconds": 120,  # el latido renueva cada tercio de este tiempo
+    "queue_max_attempts": 3,
+    "queue_batch": None,  # documentos por lote de un nodo; None = 2 x (carriles)
+    "service_host": "127.0.0.1",  # servicio HTTP de extracción (extraction_service.py)
+    "service_port": 8085,
+    "service_workers": None,  # None = mismos CPUs que los dos carriles
+    "service_max_inflight": None,  # None = 2 x workers; el resto espera un cupo o recibe 503
+    "service_queue_wait_seconds": 1.0,
+    "service_timeout_seconds": 120,
+    "service_max_upload_mb": 50,
+    "async_pipeline": False,  # True = correo, extracción e inserción a la vez (async_pipeline.py)
+    "async_imap_connections": 2,  # sesiones IMAP que descargan en paralelo
+    "async_cpu_workers": None,  # procesos para sonda/clasificación/separación; None = CPUs / 4
+    "export_folder": None,  # exportación columnar por corrida (invoice_export.py); None = desactivada
+    "export_format": "parquet",  # "parquet" (requiere pyarrow) o "csv" (.csv.gz)
+    "export_batch_rows": 5000,  # facturas por archivo de cada tabla
+    "adaptive_workers": False,  # True = ajustar los workers de cada carril durante la corrida (scheduler.AdaptiveWorkers)
+    "adaptive_min_workers": 1,  # por carril
+    "adaptive_max_workers": None,  # total de ambos carriles; None = CPUs
+    "adaptive_interval_seconds": 5,
+    "adaptive_cpu_high": 90,  # % de CPU (con carga > adaptive_overload x CPUs) para quitar un worker
+    "adaptive_cpu_low": 70,  # % de CPU bajo el cual se puede agregar uno si hay cola
+    "adaptive_overload": 1.5,  # procesos listos por CPU (load average) que cuentan como sobrecarga
+    "adaptive_memory_reserve_mb": 1024,  # memoria libre mínima; por debajo se quita un worker
+    "adaptive_idle_samples": 3  # revisiones seguidas sin cola antes de achicar un carril
 }
 # --------------------------------
 
@@ -43,7 +88,64 @@ def load_config(path=None):
         print(f"Info: no se encontró {config_path}, usando valores por defecto.")
     return cfg
 
-def process_mailbox(imap, cfg):
+def is_pdf_part(filename, ctype):
+    return ctype == "application/pdf" or filename.lower().endswith(".pdf")
+
+def fetch_with_retry(imap, num, query):
+    """FETCH con hasta 3 reintentos si la sesión IMAP se cae. Devuelve data o None."""
+    typ, data = None, None
+    for intento in range(3):
+        try:
+            typ, data = imap.fetch(num, query)
+            if typ == "OK":
+                break
+        except imaplib.IMAP4.abort as e:
+            print(f"⚠️ Error IMAP ({e}), reintentando {intento + 1}/3 ...")
+            time.sleep(2)
+            imap.noop()
+            if intento == 2:
+                raise  # después de 3 intentos fallidos, abortar
+    return data if typ == "OK" else None
+
+def _fetch_literal(data):
+    # La respuesta es [(b'1 (BODY[] {n}', b'...'), b')']: el contenido va en la tupla
+    for item in data or []:
+        if isinstance(item, tuple):
+            return item[1]
+    return None
+
+def fetch_message_size(imap, num):
+    data = fetch_with_retry(imap, num, "(RFC822.SIZE)")
+    match = re.search(rb"RFC822\.SIZE\s+(\d+)", data[0] if data else b"")
+    return int(match.group(1)) if match else None
+
+def stream_message(imap, num, parser, chunk_size, size=None):
+    """
+    Descarga el correo en FETCH parciales (BODY[]<inicio.largo>) y los pasa al
+    parser; nunca se tiene el mensaje completo en memoria. size (RFC822.SIZE) se
+    pide al servidor si no viene del prefiltro. Devuelve los bytes descargados.
+    """
+    size = size or fetch_message_size(imap, num)
+    if size is None:
+        raise RuntimeError(f"No se pudo obtener el tamaño del correo #{num}")
+
+    offset = 0
+    while offset < size:
+        chunk = _fetch_literal(fetch_with_retry(imap, num, f"(BODY[]<{offset}.{chunk_size}>)"))
+        if not chunk:
+            break
+        parser.feed(chunk)
+        offset += len(chunk)
+    parser.close()
+    return offset
+
+def connect_imap(cfg):
+    """Abre y autentica una sesión IMAP con los datos del config."""
+    imap = imaplib.IMAP4_SSL(cfg["imap_host"], cfg["imap_port"])
+    imap.login(cfg["username"], cfg["password"])
+    return imap
+
+def select_mailbox(imap, cfg):
     try:
         imap.select(cfg["mailbox"])
     except imaplib.IMAP4.abort as e:
@@ -52,87 +154,139 @@ def process_mailbox(imap, cfg):
         imap.noop()
         imap.select(cfg["mailbox"])
 
-    search_query = build_search_criteria(cfg["date_start"], cfg["date_end"], cfg["search_by"])
+def message_summary(raw_headers, num):
+    """(msg_id, subject, from, date) a partir de los encabezados crudos del correo."""
+    msg = BytesHeaderParser(policy=policy.default).parsebytes(raw_headers)
+    msg_id = msg.get("Message-ID", "").strip() or f"NOID-{num.decode() if isinstance(num, bytes) else num}"
+    return msg_id, decode_mime_words(msg.get("Subject", "")), decode_mime_words(msg.get("From", "")), msg.get("Date", "")
+
+def mark_seen(imap, msg_nums, batch=200):
+    """+FLAGS \\Seen a muchos correos con un STORE por lote."""
+    for i in range(0, len(msg_nums), batch):
+        lote = [n.decode() if isinstance(n, bytes) else str(n) for n in msg_nums[i:i + batch]]
+        imap.store(",".join(lote), '+FLAGS', '\\Seen')
+
+def find_messages(imap, cfg, stats):
+    """
+    SEARCH con los filtros del config (X-GM-RAW si el servidor lo soporta) y, si no
+    hubo búsqueda nativa, prefiltro por BODYSTRUCTURE para no bajar correos sin PDF.
+
+    Returns:
+        tuple: (números a descargar, {num: RFC822.SIZE}), o None si el SEARCH falló.
+    """
+    raw_query = cfg.get("search_raw") if supports_raw_search(imap) else None
+    search_query = build_search_criteria(
+        cfg["date_start"], cfg["date_end"], cfg["search_by"], cfg.get("search_subject"),
+        cfg.get("search_min_size"), cfg.get("search_max_size"), raw_query
+    )
     print(f"🔍 Buscando correos con criterio: {search_query}")
 
-    typ, data = imap.search(None, search_query)
+    if search_query.isascii():
+        typ, data = imap.search(None, search_query)
+    else:
+        typ, data = imap.search("UTF-8", search_query.encode("utf-8"))
     if typ != "OK":
         print("❌ Error buscando correos:", typ, data)
-        return
+        return None
 
     msg_nums = data[0].split()
+    stats.found = len(msg_nums)
     print(f"📬 Correos encontrados: {len(msg_nums)}")
 
+    sizes = {}
+    if raw_query is None and cfg.get("bodystructure_prefilter", True) and msg_nums:
+        msg_nums, sizes, descartados = prefilter_messages(imap, msg_nums, stats)
+        if descartados:
+            print(f"🧹 {len(descartados)} correo(s) sin PDF omitidos por BODYSTRUCTURE (no se descarga su cuerpo)")
+            if cfg.get("mark_as_seen"):
+                mark_seen(imap, descartados)
+    return msg_nums, sizes
+
+def process_mailbox(imap, cfg):
+    """Descarga los PDFs de los correos que cumplen el criterio. Devuelve DownloadStats."""
+    select_mailbox(imap, cfg)
+
+    stats = DownloadStats()
+    found = find_messages(imap, cfg, stats)
+    if found is None:
+        return stats
+    msg_nums, sizes = found
+
     history = load_history(cfg["history_file"])
 
+    # Hashes de adjuntos descargados antes de que existiera el almacén
+    known_hashes = {h for entry in history.values() for h in entry.get("sha256", [])}
+
+    store = AttachmentStore(default_store_root(cfg["download_folder"], cfg.get("storage_folder")))
+    try:
+        _process_messages(imap, cfg, msg_nums, history, known_hashes, store, sizes, stats)
+    finally:
+        store.close()
+    return stats
+
+def _process_messages(imap, cfg, msg_nums, history, known_hashes, store, sizes, stats):
     for num in msg_nums:
         downloaded_pdfs = []
+        downloaded_hashes = []
+        parser = None
         try:
-            # --- 🔁 Reintento robusto de fetch ---
-            for intento in range(3):
-                try:
-                    typ, msg_data = imap.fetch(num, "(RFC822)")
-                    if typ == "OK":
-                        break
-                except imaplib.IMAP4.abort as e:
-                    print(f"⚠️ Error IMAP ({e}), reintentando {intento + 1}/3 ...")
-                    time.sleep(2)
-                    imap.noop()
-                    if intento == 2:
-                        raise  # después de 3 intentos fallidos, abortar
-
-            if typ != "OK":
+            # Solo los encabezados: si el correo ya se procesó no se descarga el cuerpo
+            raw_headers = _fetch_literal(fetch_with_retry(imap, num, "(BODY.PEEK[HEADER])"))
+            if raw_headers is None:
                 print(f"❌ No se pudo obtener el correo #{num}. Se omite.")
                 continue
 
-            raw = msg_data[0][1]
-            msg = email.message_from_bytes(raw, policy=policy.default)
-
-            msg_id = msg.get("Message-ID", "").strip() or f"NOID-{num.decode() if isinstance(num, bytes) else num}"
+            stats.bytes_downloaded += len(raw_headers)
+            msg_id, subject, from_, date_ = message_summary(raw_headers, num)
 
             if already_processed(history, msg_id):
                 print(f"⏭️ Correo ya procesado ({msg_id}), se omite.")
                 continue
 
-            subject = decode_mime_words(msg.get("Subject", ""))
-            from_ = decode_mime_words(msg.get("From", ""))
-            date_ = msg.get("Date", "")
-
             print(f"\n📧 Procesando: {subject}")
             print(f"   De: {from_}")
             print(f"   Fecha: {date_}")
 
             found_any_pdf = False
 
-            if msg.is_multipart():
-                for part in msg.walk():
-                    try:
-                        filename = part.get_filename()
-                        if not filename:
-                            continue
-                        filename = decode_mime_words(filename)
-                        ctype = part.get_content_type()
-
-                        if ctype == "application/pdf" or filename.lower().endswith(".pdf"):
-                            payload = part.get_payload(decode=True)
-                            text, pages_text = get_pdf_text_with_ocr_fallback(payload)
-                            invoiceData = find_invoice_page_text(pages_text)
-                            invoice_norm = re.sub(r"\r", "\n", invoiceData)
-                            full_text_one = re.sub(r"[\r\n]+", " ", invoice_norm)
-                            headers = extract_headers(full_text_one)
-
-                            invoice_number = headers.get("Invoice No", "")
-                            prefix = f"{invoice_number}_" if invoice_number else ""
-                            new_filename = prefix + filename
-
-                            saved_path = save_attachment(payload, new_filename, cfg["download_folder"])
-                            print(f"  ✅ PDF guardado: {saved_path}")
-                            downloaded_pdfs.append(new_filename)
-                            found_any_pdf = True
-
-                    except Exception as e:
-                        print(f"  ❌ ERROR al procesar o guardar el PDF '{filename}': {e}")
-                        traceback.print_exc()
+            # Los PDFs se decodifican directo al almacén (incoming/) mientras llegan
+            parser = StreamingMimeParser(store.incoming_folder, is_pdf_part)
+            body_bytes = stream_message(imap, num, parser, cfg.get("mime_fetch_chunk", 1024 * 1024), sizes.get(num))
+            stats.add_message(body_bytes)
+
+            for part in parser.saved:
+                filename = part["filename"]
+                try:
+                    if part["sha256"] in known_hashes or store.contains(part["sha256"]):
+                        os.remove(part["tmp_path"])
+                        print(f"  ⏭️ PDF '{filename}' ya descargado antes (mismo SHA-256), se omite.")
+                        continue
+
+                    # Sonda solo del encabezado con tiempo acotado; si no responde,
+                    # el Invoice No se completa en el índice en la etapa de parseo.
+                    invoice_number = probe_invoice_number(
+                        part["tmp_path"], time_budget=cfg.get("header_probe_budget", 2.0)
+                    )
+                    prefix = f"{invoice_number}_" if invoice_number else ""
+                    new_filename = prefix + filename
+
+                    saved_path, _ = store.put_file(
+                        part["tmp_path"], original_name=new_filename, sha256=part["sha256"],
+                        invoice_no=invoice_number, msg_id=msg_id
+                    )
+                    print(f"  ✅ PDF guardado: {new_filename} -> {saved_path} ({part['size'] / 1024:.0f} KB)")
+                    downloaded_pdfs.append(new_filename)
+                    downloaded_hashes.append(part["sha256"])
+                    known_hashes.add(part["sha256"])
+                    stats.pdf_bytes += part["size"]
+                    stats.msg_ids.add(msg_id)
+                    found_any_pdf = True
+
+                except Exception as e:
+                    print(f"  ❌ ERROR al procesar o guardar el PDF '{filename}': {e}")
+                    traceback.print_exc()
+                    if os.path.exists(part["tmp_path"]):
+                        os.remove(part["tmp_path"])
 
             if not found_any_pdf:
                 print("   ⚠️ No se encontraron PDFs en este correo.")
@@ -142,7 +296,8 @@ def process_mailbox(imap, cfg):
                 "from": from_,
                 "date": date_,
                 "pdf_found": found_any_pdf,
-                "downloaded_files": downloaded_pdfs
+                "downloaded_files": downloaded_pdfs,
+                "sha256": downloaded_hashes
             }
             save_history(history, cfg["history_file"])
 
@@ -150,6 +305,8 @@ def process_mailbox(imap, cfg):
                 imap.store(num, '+FLAGS', '\\Seen')
 
         except imaplib.IMAP4.abort as e:
+            if parser is not None:
+                parser.abort()
             print(f"🚨 Error grave IMAP durante el procesamiento: {e}")
             time.sleep(3)
             try:
@@ -158,5 +315,7 @@ def process_mailbox(imap, cfg):
                 print("⚠️ La sesión IMAP parece haber expirado. Reconectando...")
                 # reconnect_imap(imap, cfg)  # puedes implementar esta helper si quieres reconectar
         except Exception as e:
+            if parser is not None:
+                parser.abort()
             print(f"❌ Error procesando correo: {e}")
             traceback.print_exc()
\ No newline at end of file
@@ -0,0 +1,328 @@
+import os
+import json
+import time
+import queue
+import tempfile
+import threading
+import pytesseract
+from collections import deque
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from commons import validateInvoiceData
+from invoice_data import extract_invoice_data, warm_up_worker
+from scheduler import IsolatedPool, PoisonDocumentError, default_workers
+pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
+
+# --------------------------- SERVICIO HTTP DE EXTRACCIÓN -----------------------------
+# Para que otros sistemas obtengan los campos de una factura al momento, sin pasar
+# por el correo ni por la carpeta de descargas:
+#
+#   POST /extract?name=factura.pdf   cuerpo = bytes del PDF  -> JSON del Invoice
+#   GET  /metrics                    latencias p50/p90/p99 y conteo por estado
+#   GET  /health                     workers vivos
+#
+# Los workers son procesos de larga vida ya calentados (cv2, pdfplumber, Tesseract)
+# con el mismo presupuesto de tiempo/memoria por documento que la corrida por lotes.
+# Por encima de service_max_inflight una solicitud espera a lo sumo
+# service_queue_wait_seconds por un cupo; si no lo obtiene recibe 503.
+#
+# Uso: python extraction_service.py [config.json]
+
+UPLOAD_CHUNK = 256 * 1024
+
+class ExtractionHTTPServer(ThreadingHTTPServer):
+    # La cola de listen por defecto (5) resetea conexiones en una ráfaga de clientes
+    request_queue_size = 128
+    daemon_threads = True
+
+def percentile(values, q):
+    """Percentil por rango más cercano (q entre 0 y 100) de una lista ya ordenada."""
+    if not values:
+        return None
+    rank = max(1, int(round(q / 100 * len(values))))
+    return values[min(rank, len(values)) - 1]
+
+class LatencyMetrics:
+    """Latencias de las últimas `window` solicitudes y conteo total por código HTTP."""
+
+    def __init__(self, window=1000):
+        self.latencies = deque(maxlen=window)
+        self.by_status = {}
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def record(self, status, seconds):
+        with self.lock:
+            self.total += 1
+            self.by_status[status] = self.by_status.get(status, 0) + 1
+            if status == 200:
+                self.latencies.append(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            ordenadas = sorted(self.latencies)
+            by_status = {str(k): v for k, v in sorted(self.by_status.items())}
+            total = self.total
+
+        def ms(value):
+            return round(value * 1000, 1) if value is not None else None
+
+        return {
+            "requests": total,
+            "by_status": by_status,
+            "latency_ms": {
+                "window": len(ordenadas),
+                "p50": ms(percentile(ordenadas, 50)),
+                "p90": ms(percentile(ordenadas, 90)),
+                "p99": ms(percentile(ordenadas, 99)),
+                "max": ms(ordenadas[-1] if ordenadas else None),
+            },
+        }
+
+class ExtractionService:
+    """
+    Pool caliente de workers aislados más un hilo despachador. Solo el despachador
+    toca el IsolatedPool; los hilos HTTP le pasan rutas por una cola y esperan un
+    Future con el resultado.
+    """
+
+    def __init__(self, workers, max_inflight, timeout, memory_limit_mb=None, upload_folder=None, queue_wait=1.0):
+        self.pool = IsolatedPool(extract_invoice_data, workers, warm_up_worker, (1,), timeout, memory_limit_mb)
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_inflight)
+        self.max_inflight = max_inflight
+        self.queue_wait = queue_wait
+        self.upload_folder = upload_folder or os.path.join(tempfile.gettempdir(), "invoice_service")
+        os.makedirs(self.upload_folder, exist_ok=True)
+
+        self.metrics = LatencyMetrics()
+        self.incoming = queue.Queue()
+        self.futures = {}
+        self.cancelled = set()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.dispatcher = threading.Thread(target=self._dispatch_loop, daemon=True)
+
+    def start(self):
+        inicio = time.perf_counter()
+        self.pool.start(wait=True)
+        self.dispatcher.start()
+        print(f"🔥 {len(self.pool.workers)} worker(s) listos y calentados en {time.perf_counter() - inicio:.1f} s")
+
+    def stop(self):
+        self.stopping.set()
+        self.dispatcher.join()
+        self.pool.shutdown()
+
+    def _dispatch_loop(self):
+        while not self.stopping.is_set():
+            try:
+                # Sin trabajo en curso se bloquea en la cola de entrada; con trabajo, solo la vacía
+                if self.pool.pending():
+                    pdf_path = self.incoming.get_nowait()
+                else:
+                    pdf_path = self.incoming.get(timeout=0.05)
+                self.pool.submit(pdf_path)
+                continue
+            except queue.Empty:
+                pass
+
+            with self.lock:
+                cancelled, self.cancelled = self.cancelled, set()
+            for pdf_path in cancelled:
+                self.pool.cancel(pdf_path)
+
+            if self.pool.pending():
+                for pdf_path, result, error in self.pool.poll(timeout=0.02):
+                    with self.lock:
+                        future = self.futures.pop(pdf_path, None)
+                    if future is None:
+                        continue
+                    if error is None:
+                        future.set_result(result)
+                    else:
+                        future.set_exception(error)
+
+            # Un worker que se mató por tiempo o memoria se reemplaza ya calentado
+            self.pool.start()
+
+    def acquire_slot(self):
+        """Cupo para una solicitud; espera a lo sumo queue_wait segundos antes de rechazarla."""
+        return self.slots.acquire(timeout=self.queue_wait)
+
+    def release_slot(self):
+        self.slots.release()
+
+    def extract(self, pdf_path):
+        """Envía el PDF al pool y espera el Invoice (o la excepción del worker)."""
+        future = Future()
+        with self.lock:
+            self.futures[pdf_path] = future
+        self.incoming.put(pdf_path)
+        try:
+            # El pool mata al worker a los `timeout` segundos; el margen cubre la espera en cola
+            return future.result(timeout=self.timeout * 2 if self.timeout else None)
+        except TimeoutError:
+            with self.lock:
+                self.futures.pop(pdf_path, None)
+                self.cancelled.add(pdf_path)
+            raise
+
+    def health(self):
+        vivos = sum(1 for w in list(self.pool.workers) if w["process"].is_alive())
+        return {"workers": vivos, "max_workers": self.pool.max_workers, "max_inflight": self.max_inflight}
+
+class ExtractionHandler(BaseHTTPRequestHandler):
+    service = None  # se asigna en make_server
+    max_upload_bytes = 50 * 1024 * 1024
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for nombre, valor in (headers or {}).items():
+            self.send_header(nombre, valor)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # las latencias quedan en /metrics
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/metrics":
+            payload = self.service.metrics.snapshot()
+            payload.update(self.service.health())
+            self._send_json(200, payload)
+        elif path == "/health":
+            self._send_json(200, self.service.health())
+        else:
+            self._send_json(404, {"error": "ruta no encontrada"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/extract":
+            self._send_json(404, {"error": "ruta no encontrada"})
+            return
+
+        inicio = time.perf_counter()
+        status, payload, headers = self._extract(url)
+        self._send_json(status, payload, headers)
+        self.service.metrics.record(status, time.perf_counter() - inicio)
+
+    def _extract(self, url):
+        length = self.headers.get("Content-Length")
+        if length is None:
+            return 411, {"error": "falta Content-Length"}, None
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            return 400, {"error": "Content-Length inválido"}, None
+        if length > self.max_upload_bytes:
+            return 413, {"error": f"PDF mayor a {self.max_upload_bytes // (1024 * 1024)} MB"}, None
+
+        if not self.service.acquire_slot():
+            # Se descarta el cuerpo para que el cliente reciba la respuesta sin error de conexión
+            self._discard_body(length)
+            return 503, {"error": "servicio ocupado, reintentar"}, {"Retry-After": "1"}
+
+        pdf_path = None
+        try:
+            pdf_path = self._save_upload(length)
+            if pdf_path is None:
+                return 415, {"error": "el cuerpo no es un PDF"}, None
+
+            inicio = time.perf_counter()
+            try:
+                invoice = self.service.extract(pdf_path)
+            except TimeoutError:
+                return 504, {"error": "tiempo de espera agotado"}, None
+            except PoisonDocumentError as e:
+                return 422, {"error": "documento rechazado", "reason": e.reason}, None
+            except Exception as e:
+                return 500, {"error": str(e).splitlines()[0] if str(e) else type(e).__name__}, None
+
+            nombre = parse_qs(url.query).get("name", [None])[0]
+            if nombre:
+                invoice.file = nombre
+            invoice.file_path = None
+            invoice.source_text = None
+            return 200, {
+                "invoice": invoice.to_dict(),
+                "missing_fields": validateInvoiceData(invoice),
+                "elapsed_ms": round((time.perf_counter() - inicio) * 1000, 1),
+            }, None
+        finally:
+            self.service.release_slot()
+            if pdf_path and os.path.exists(pdf_path):
+                os.remove(pdf_path)
+
+    def _save_upload(self, length):
+        """Escribe el cuerpo a un archivo temporal por pedazos. None si no empieza con %PDF."""
+        fd, pdf_path = tempfile.mkstemp(suffix=".pdf", dir=self.service.upload_folder)
+        with os.fdopen(fd, "wb") as f:
+            restante = length
+            primero = True
+            while restante > 0:
+                chunk = self.rfile.read(min(UPLOAD_CHUNK, restante))
+                if not chunk:
+                    break
+                if primero and not chunk.lstrip()[:5].startswith(b"%PDF"):
+                    self._discard_body(restante - len(chunk))
+                    f.close()
+                    os.remove(pdf_path)
+                    return None
+                primero = False
+                f.write(chunk)
+                restante -= len(chunk)
+        return pdf_path
+
+    def _discard_body(self, length):
+        while length > 0:
+            chunk = self.rfile.read(min(UPLOAD_CHUNK, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+
+def make_server(cfg):
+    fast, ocr = default_workers()
+    workers = cfg.get("service_workers") or fast + ocr
+    service = ExtractionService(
+        workers,
+        max_inflight=cfg.get("service_max_inflight") or workers * 2,
+        timeout=cfg.get("service_timeout_seconds") or cfg.get("doc_timeout_seconds"),
+        memory_limit_mb=cfg.get("doc_memory_mb"),
+        queue_wait=cfg.get("service_queue_wait_seconds", 1.0),
+    )
+
+    handler = type("ConfiguredHandler", (ExtractionHandler,), {
+        "service": service,
+        "max_upload_bytes": int(cfg.get("service_max_upload_mb", 50) * 1024 * 1024),
+    })
+    server = ExtractionHTTPServer((cfg.get("service_host", "127.0.0.1"), cfg.get("service_port", 8085)), handler)
+    return server, service
+
+def main():
+    import sys
+    from email_library import load_config
+
+    cfg = load_config(sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json"))
+    server, service = make_server(cfg)
+    service.start()
+    host, port = server.server_address[:2]
+    print(f"🌐 Servicio de extracción en http://{host}:{port} (POST /extract, GET /metrics)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nDeteniendo servicio...")
+    finally:
+        server.server_close()
+        service.stop()
+
+if __name__ == "__main__":
+    # Necesario para los workers (Windows arranca los procesos con 'spawn')
+    main()
@@ -0,0 +1,216 @@
+import re
+from email.utils import decode_params, collapse_rfc2231_value, unquote
+from commons import decode_mime_words
+
+# --------------------------- FILTRO DE CORREOS EN EL SERVIDOR ------------------------
+# El SEARCH por fecha y remitente también trae boletines y respuestas con imágenes
+# grandes que no tienen ningún PDF. Antes de bajar un solo cuerpo se descartan:
+#
+#   1. En el servidor, si soporta búsqueda extendida (Gmail, capacidad X-GM-EXT-1):
+#      X-GM-RAW "has:attachment filename:pdf" junto al resto del criterio.
+#   2. Si no, con un FETCH (RFC822.SIZE BODYSTRUCTURE) por lotes: solo la estructura
+#      MIME de cada correo (unos cientos de bytes), y se omiten los que no traen
+#      una parte PDF. El tamaño que viene en la misma respuesta le ahorra a
+#      stream_message su propio FETCH (RFC822.SIZE).
+#
+# DownloadStats cuenta los bytes descargados y report_download_share los compara
+# con los PDFs que terminaron como factura (columna size del índice del almacén).
+
+PREFILTER_BATCH = 200  # correos por FETCH de BODYSTRUCTURE
+RAW_SEARCH_CAPABILITY = "X-GM-EXT-1"
+
+class DownloadStats:
+    """Contadores de la descarga del correo para el reporte de bytes útiles."""
+
+    def __init__(self):
+        self.found = 0
+        self.filtered = 0
+        self.downloaded = 0
+        self.bytes_downloaded = 0
+        self.pdf_bytes = 0
+        self.msg_ids = set()
+
+    def add_message(self, nbytes):
+        self.downloaded += 1
+        self.bytes_downloaded += nbytes
+
+def supports_raw_search(imap):
+    """True si el servidor anuncia las extensiones de Gmail (X-GM-RAW)."""
+    return RAW_SEARCH_CAPABILITY in (getattr(imap, "capabilities", None) or ())
+
+# ---------- respuesta IMAP -> listas ----------
+TOKEN = re.compile(r'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))', re.S)
+
+def _quote_literal(literal):
+    texto = literal.decode("utf-8", "replace")
+    return '"' + texto.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def join_fetch_response(data):
+    """
+    Reconstruye una línea por correo a partir de la respuesta de imaplib.fetch. Los
+    literales ({n} seguido de los bytes, que imaplib entrega como tuplas) se vuelven
+    cadenas entre comillas para que parse_imap_list los lea como cualquier string.
+    """
+    lineas = []
+    en_literal = False
+    for item in data or []:
+        if isinstance(item, tuple):
+            meta, literal = item
+            texto = re.sub(r"\{\d+\}$", "", meta.decode("latin-1")) + _quote_literal(literal)
+            if en_literal and lineas:
+                lineas[-1] += texto
+            else:
+                lineas.append(texto)
+            en_literal = True
+        elif item is not None:
+            texto = item.decode("latin-1")
+            if en_literal and lineas:
+                lineas[-1] += texto
+            else:
+                lineas.append(texto)
+            en_literal = False
+    return lineas
+
+def parse_imap_list(text):
+    """'(a "b" (c NIL))' -> ['a', 'b', ['c', None]]. Los átomos quedan como str."""
+    pila = [[]]
+    for abre, cierra, cadena, atomo in TOKEN.findall(text):
+        if abre:
+            pila.append([])
+        elif cierra:
+            if len(pila) > 1:
+                terminada = pila.pop()
+                pila[-1].append(terminada)
+        elif atomo:
+            pila[-1].append(None if atomo.upper() == "NIL" else atomo)
+        else:
+            pila[-1].append(re.sub(r"\\(.)", r"\1", cadena))
+    while len(pila) > 1:  # respuesta truncada: se cierra lo que quedó abierto
+        terminada = pila.pop()
+        pila[-1].append(terminada)
+    return pila[0]
+
+def parse_fetch_line(line):
+    """'12 (RFC822.SIZE 3456 BODYSTRUCTURE (...))' -> ('12', {'RFC822.SIZE': '3456', 'BODYSTRUCTURE': [...]})"""
+    match = re.match(r"\s*(\d+)\s+", line)
+    if not match:
+        return None, {}
+    items = parse_imap_list(line[match.end():])
+    campos = items[0] if items and isinstance(items[0], list) else []
+    return match.group(1), {str(campos[i]).upper(): campos[i + 1] for i in range(0, len(campos) - 1, 2)}
+
+# ---------- BODYSTRUCTURE ----------
+def _decode_rfc2231(pares):
+    """
+    [(clave, valor)] con los parámetros de RFC 2231 ya armados: filename*=utf-8''...
+    y las continuaciones filename*0*, filename*1... quedan como un solo filename.
+    """
+    try:
+        decodificados = decode_params([("", "")] + pares)[1:]
+    except (TypeError, ValueError):
+        # Continuaciones mezcladas con el mismo parámetro sin número: se dejan tal cual
+        return pares
+    return [(clave, unquote(collapse_rfc2231_value(valor))) for clave, valor in decodificados]
+
+def _param_values(node):
+    """Valores de name/filename en las listas de parámetros de una parte (Content-Type y disposición)."""
+    valores = []
+    for elemento in node:
+        if not isinstance(elemento, list):
+            continue
+        planos = [e for e in elemento if not isinstance(e, list)]
+        pares = [(str(planos[i] or "").lower(), str(planos[i + 1] or "")) for i in range(0, len(planos) - 1, 2)]
+        for clave, valor in _decode_rfc2231(pares):
+            if clave in ("name", "filename"):
+                valores.append(decode_mime_words(valor))
+        # La disposición viene como ("attachment" ("filename" "x.pdf"))
+        valores.extend(_param_values(elemento))
+    return valores
+
+def bodystructure_has_pdf(node):
+    """
+    True si alguna parte de la estructura es un PDF con nombre, con la misma regla que
+    is_pdf_part en la descarga (application/pdf o nombre terminado en .pdf).
+    """
+    if not isinstance(node, list) or not node:
+        return False
+    if isinstance(node[0], list):
+        # multipart: las partes hijas van primero, después el subtipo y las extensiones
+        for hija in node:
+            if not isinstance(hija, list):
+                break
+            if bodystructure_has_pdf(hija):
+                return True
+        return False
+
+    tipo = f"{node[0]}/{node[1] if len(node) > 1 else ''}".lower()
+    if tipo == "message/rfc822" and len(node) > 8:
+        # Correo reenviado: su estructura va anidada después del sobre; el sobre, el
+        # cuerpo y el conteo de líneas no son parámetros de esta parte
+        if bodystructure_has_pdf(node[8]):
+            return True
+        node = node[:7] + node[10:]
+    nombres = [n for n in _param_values(node) if n]
+    return bool(nombres) and (tipo == "application/pdf" or any(n.lower().endswith(".pdf") for n in nombres))
+
+def prefilter_messages(imap, msg_nums, stats=None, batch=PREFILTER_BATCH):
+    """
+    Pide RFC822.SIZE y BODYSTRUCTURE por lotes y separa los correos con PDF de los que
+    no tienen ninguno. Si un correo no se puede interpretar se conserva (se descarga).
+
+    Returns:
+        tuple: (candidatos en el orden original, {num: tamaño}, descartados)
+    """
+    def clave(num):
+        return num.decode() if isinstance(num, bytes) else str(num)
+
+    sizes = {}
+    con_pdf = set()
+    vistos = set()
+    for i in range(0, len(msg_nums), batch):
+        lote = [clave(n) for n in msg_nums[i:i + batch]]
+        typ, data = imap.fetch(",".join(lote), "(RFC822.SIZE BODYSTRUCTURE)")
+        if typ != "OK":
+            continue
+        for linea in join_fetch_response(data):
+            if stats is not None:
+                stats.bytes_downloaded += len(linea)
+            num, campos = parse_fetch_line(linea)
+            if num is None or "BODYSTRUCTURE" not in campos:
+                continue
+            vistos.add(num)
+            if str(campos.get("RFC822.SIZE") or "").isdigit():
+                sizes[num] = int(campos["RFC822.SIZE"])
+            if bodystructure_has_pdf(campos["BODYSTRUCTURE"]):
+                con_pdf.add(num)
+
+    candidatos = []
+    descartados = []
+    for n in msg_nums:
+        if clave(n) in con_pdf or clave(n) not in vistos:
+            candidatos.append(n)
+        else:
+            descartados.append(n)
+    if stats is not None:
+        stats.filtered += len(descartados)
+    return candidatos, {n: sizes[clave(n)] for n in candidatos if clave(n) in sizes}, descartados
+
+# ---------- reporte ----------
+def _mb(nbytes):
+    return nbytes / (1024 * 1024)
+
+def report_download_share(stats, store):
+    """
+    Resume cuánto de lo descargado terminó como factura: bytes de los PDFs en estado
+    procesado (decodificados) contra todo lo bajado del servidor (encabezados,
+    BODYSTRUCTURE y cuerpos en base64, que ya de por sí pesa 4/3 del PDF).
+    """
+    por_estado = store.bytes_by_msg_ids(stats.msg_ids)
+    factura = por_estado.get("procesado", 0)
+    print(f"📦 Correos: {stats.found} encontrados, {stats.filtered} omitidos sin descargar el cuerpo, "
+          f"{stats.downloaded} descargados ({_mb(stats.bytes_downloaded):.1f} MB)")
+    if stats.bytes_downloaded:
+        detalle = ", ".join(f"{estado} {_mb(total):.1f} MB" for estado, total in sorted(por_estado.items()))
+        print(f"📦 Bytes que terminaron como factura: {_mb(factura):.1f} MB "
+              f"({factura / stats.bytes_downloaded:.0%} de lo descargado) | PDFs por estado: {detalle or '-'}")
+    return factura
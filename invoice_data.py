@@ -7,25 +7,49 @@ import pdfplumber
 import pdfplumber
 from pdf2image import convert_from_path
 import pytesseract
+from pypdf import PdfReader
 import tempfile
 import io
+import time
+import signal
+import threading
+from functools import lru_cache, wraps
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from invoice_record import Invoice, ProductLine
 
 # Se asume que pdfplumber, convert_from_path, y pytesseract están importados.
 # Estas funciones se mantienen como referencia, pero la implementación
 # se enfocará en la nueva estructura de retorno.
 
-# convertir una imagen a texto
-def extraer_texto_ocr(pdf_path, page_number=1):
+# ----------------------- OCR ESCALONADO POR DPI Y CONFIANZA -----------------------
+# Primero se hace OCR a baja resolución; solo si la confianza promedio por palabra
+# que reporta Tesseract queda bajo OCR_MIN_CONFIDENCE se vuelve a renderizar la
+# página (o región) al siguiente DPI. Con OCR_DPI_TIERS = (300,) se obtiene el
+# comportamiento anterior (300 DPI fijo). El texto siempre sale de image_to_string
+# (conserva el orden y los espacios de la página); image_to_data solo se usa para
+# medir la confianza en los niveles que todavía pueden escalar.
+OCR_DPI_TIERS = (200, 300)
+OCR_MIN_CONFIDENCE = 75
+# (confianza, dpi) del intento aceptado de cada OCR hecho en este proceso (confianza
+# None si no se midió); collect_invoice_text lo vacía al empezar un documento y lo
+# resume en la metadata de la extracción
+OCR_TRACE = []
+# Guarda la imagen binarizada de la página 1 en debug_imagen.png para revisarla a mano
+OCR_DEBUG_IMAGE = False
+
+def set_ocr_dpi_tiers(tiers, min_confidence=None):
+    """Cambia los niveles de DPI (y opcionalmente el umbral de confianza) en este proceso."""
+    global OCR_DPI_TIERS, OCR_MIN_CONFIDENCE
+    OCR_DPI_TIERS = tuple(tiers)
+    if min_confidence is not None:
+        OCR_MIN_CONFIDENCE = min_confidence
+
+def preprocesar_imagen(imagen_pil):
     """
-    Convierte la primera página de un PDF en texto mediante OCR.
-    Usa preprocesamiento con OpenCV para mejorar la precisión.
+    Preprocesamiento con OpenCV para mejorar la precisión del OCR:
+    escala de grises, filtro de ruido y binarización.
     """
-    # ✅ No necesitamos poppler_path porque ya está en el PATH del sistema
-    imagenes = convert_from_path(pdf_path, dpi=300, first_page=page_number, last_page=page_number)
-
-    # Tomar la primera página
-    imagen_pil = imagenes[0]
-
     # Convertir a formato OpenCV
     imagen_cv = cv2.cvtColor(np.array(imagen_pil), cv2.COLOR_RGB2BGR)
 
@@ -36,96 +60,325 @@ def extraer_texto_ocr(pdf_path, page_number=1):
     # Binarizar (blanco y negro puro)
     _, binaria = cv2.threshold(gris, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
     # binaria = cv2.adaptiveThreshold(gris, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
+    return binaria
+
+def confianza_ocr(binaria, config, timeout=0):
+    """Confianza promedio por palabra (0-100) que reporta Tesseract para la imagen."""
+    datos = pytesseract.image_to_data(
+        binaria, lang='eng', config=config, output_type=pytesseract.Output.DICT, timeout=timeout
+    )
+    confianzas = [
+        float(conf) for palabra, conf in zip(datos["text"], datos["conf"])
+        if float(conf) >= 0 and palabra.strip()
+    ]
+    return sum(confianzas) / len(confianzas) if confianzas else 0.0
 
-    # (Opcional) guardar para verificar visualmente
-    if page_number == 1:
-        cv2.imwrite("debug_imagen.png", binaria)
+@lru_cache(maxsize=2)
+def renderizar_pagina(pdf_path, page_number, dpi, mtime=None, timeout=0):
+    """
+    Renderiza una página a imagen. Se guarda en caché la última página para que
+    el OCR por regiones no vuelva a renderizar la misma página por cada región
+    (mtime forma parte de la clave por si el archivo cambia).
+    """
+    # ✅ No necesitamos poppler_path porque ya está en el PATH del sistema
+    imagenes = convert_from_path(
+        pdf_path, dpi=dpi, first_page=page_number, last_page=page_number, timeout=timeout or None
+    )
+    return imagenes[0]
 
-    # OCR con configuración flexible para texto multicolumna
-    config = "--psm 4"
-    texto = pytesseract.image_to_string(binaria, lang='eng', config=config)
+def recortar_region(imagen_pil, box):
+    """Recorta la región box (fracciones izquierda, arriba, derecha, abajo) de la imagen."""
+    ancho, alto = imagen_pil.size
+    left, top, right, bottom = box
+    return imagen_pil.crop((int(left * ancho), int(top * alto), int(right * ancho), int(bottom * alto)))
 
-    # Guardar el texto detectado (para depuración)
-    # with open("texto_ocr.txt", "w", encoding="utf-8") as f:
-    #     f.write(texto)
+def ocr_escalonado(pdf_path, page_number, config, box=None, dpi=None, timeout=0):
+    """
+    Renderiza la página (o la región box) y hace OCR subiendo de DPI solo mientras
+    la confianza quede bajo el umbral. En cada nivel que aún puede escalar se mide
+    la confianza con image_to_data y, si alcanza, se lee el texto con image_to_string;
+    el último nivel lee el texto directamente. Si se pasa dpi, se usa solo ese nivel.
 
+    Returns:
+        tuple: (texto, confianza, dpi_usado); confianza es None si no se midió.
+    """
+    niveles = (dpi,) if dpi else OCR_DPI_TIERS
+
+    for n, nivel in enumerate(niveles):
+        imagen_pil = renderizar_pagina(pdf_path, page_number, nivel, os.path.getmtime(pdf_path), timeout)
+
+        if box:
+            imagen_pil = recortar_region(imagen_pil, box)
+
+        binaria = preprocesar_imagen(imagen_pil)
+
+        # (Opcional) guardar para verificar visualmente
+        if OCR_DEBUG_IMAGE and page_number == 1 and not box:
+            cv2.imwrite("debug_imagen.png", binaria)
+
+        confianza = None
+        if n < len(niveles) - 1:
+            confianza = confianza_ocr(binaria, config, timeout)
+            if confianza < OCR_MIN_CONFIDENCE:
+                continue
+
+        texto = pytesseract.image_to_string(binaria, lang='eng', config=config, timeout=timeout)
+        OCR_TRACE.append((confianza, nivel))
+        return texto, confianza, nivel
+
+# convertir una imagen a texto
+def extraer_texto_ocr(pdf_path, page_number=1):
+    """
+    Convierte una página de un PDF en texto mediante OCR escalonado por DPI.
+    Usa preprocesamiento con OpenCV para mejorar la precisión.
+    """
+    # OCR con configuración flexible para texto multicolumna
+    texto, _, _ = ocr_escalonado(pdf_path, page_number, "--psm 4")
     return texto
 
-# de las hojas extraidas y convertidas a texto cual es la que tiene la informacion de la factura.
-def find_invoice_page_text(pages_text_list):
+def extraer_texto_ocr_region(pdf_path, page_number=1, box=(0.0, 0.0, 1.0, 1.0), dpi=None, psm=6, timeout=0):
     """
-    Busca en la lista de páginas la única que contenga los indicadores clave 
-    de una factura (Invoice No/Date Y Ship To/Bill To).
-    
-    Args:
-        pages_text_list (list): Lista de strings, donde cada string es el texto de una página.
+    OCR de una sola región de la página. box son fracciones de la página
+    (izquierda, arriba, derecha, abajo), así la región no depende del DPI.
+    Sin dpi se usa el OCR escalonado; timeout (segundos, 0 = sin límite) se
+    pasa a pdf2image y a Tesseract.
+    """
+    texto, _, _ = ocr_escalonado(pdf_path, page_number, f"--psm {psm}", box=box, dpi=dpi, timeout=timeout)
+    return texto
+
+# Tope de procesos para el OCR por página dentro de un mismo documento.
+# Por defecto 1 (secuencial); el planificador lo ajusta en cada worker para que
+# el paralelismo por documento y por página no sature los CPUs.
+OCR_PAGE_WORKERS = 1
+
+def set_ocr_page_workers(max_workers):
+    """Fija el tope de procesos para el OCR por página en este proceso."""
+    global OCR_PAGE_WORKERS
+    OCR_PAGE_WORKERS = max(1, int(max_workers or 1))
+
+def warm_up_worker(ocr_page_workers=1):
+    """
+    Initializer para workers de larga vida (servicio HTTP): fija el tope de OCR por
+    página y paga por adelantado lo que si no pagaría la primera factura, es decir
+    las rutinas nativas de OpenCV y el arranque de Tesseract con los datos de 'eng'
+    (queda en la caché del sistema). Los módulos pesados (cv2, pdfplumber, pypdf)
+    ya se cargaron al importar este archivo.
+    """
+    set_ocr_page_workers(ocr_page_workers)
+    try:
+        blanco = np.full((64, 256), 255, dtype=np.uint8)
+        _, binaria = cv2.threshold(cv2.medianBlur(blanco, 3), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        pytesseract.image_to_string(binaria, lang='eng', config="--psm 6", timeout=10)
+    except Exception as e:
+        print(f"⚠️ Calentamiento del worker incompleto ({type(e).__name__}: {e}); la primera factura será más lenta.")
+
+def ocr_pages(pdf_path, page_numbers):
+    """
+    Aplica OCR a varias páginas del PDF. Si hay más de una página y el tope lo
+    permite, reparte las páginas entre procesos.
 
     Returns:
-        str: El texto de la página identificada como la principal de la factura.
-    """
-    # Indicadores de que es la página principal de la factura
-    # Debe tener el encabezado (Invoice No o Invoice Date)
-    invoice_indicators = re.compile(r"(Invoice\s*No|Invoice\s*Date)", re.I)
-    # Y debe tener las direcciones
-    address_indicators = re.compile(r"(Ship\s*To|Bill\s*To)", re.I)
-
-    for text in pages_text_list:
-        # Normalizamos el texto de la página a una sola línea para que la búsqueda sea robusta
-        text_one_line = re.sub(r'[\r\n]+', ' ', text)
-        
-        # Condición: La página DEBE contener ambos conjuntos de indicadores
-        if invoice_indicators.search(text_one_line) and address_indicators.search(text_one_line):
-            # ¡Página de la factura encontrada!
-            return text
-    
-    # Fallback: Si ninguna página cumple la condición, devolvemos la primera como mejor suposición.
-    if pages_text_list:
-        # print("⚠️ No se identificó la página de la factura con claridad. Usando la primera página.")
-        return pages_text_list[0]
-        
-    return ""
+        dict: {page_number: texto_ocr}
+    """
+    page_numbers = list(page_numbers)
+    workers = min(OCR_PAGE_WORKERS, len(page_numbers))
+
+    if workers <= 1:
+        return {n: extraer_texto_ocr(pdf_path, n) for n in page_numbers}
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        textos = pool.map(extraer_texto_ocr, [pdf_path] * len(page_numbers), page_numbers)
+        return dict(zip(page_numbers, textos))
+
+# ----------------------- CLASIFICADOR DE PÁGINAS (UNA SOLA PASADA) -----------------------
+# Cada página se normaliza una sola vez (minúsculas y sin espacios, lo que además
+# tolera los espacios que se pierden con OCR: "ShipTo") y se buscan todas las
+# palabras clave sobre ese texto. Cada palabra clave puede tener variantes de OCR.
+PAGE_KEYWORDS = {
+    "invoice": [("invoiceno",), ("invoicedate",), ("invoice#",), ("invno",), ("invdate",)],
+    "address": [("shipto",), ("billto",), ("consignee",), ("customer",), ("soldto",)],
+    "financial": [("subtotal",), ("total",), ("paymentterms",), ("duedate",),
+                  ("methodofshipment",), ("incoterm", "lncoterm", "lncotenn")],
+}
+# Puntaje a partir del cual una página es claramente la de la factura:
+# encabezado + dirección (bonus de 2) y al menos dos datos financieros.
+INVOICE_PAGE_THRESHOLD = 6
+
+def score_invoice_page(text):
+    """
+    Puntaje de una página: +1 por cada palabra clave de factura, dirección o datos
+    financieros, y +2 si tiene tanto encabezado de factura como dirección.
+    """
+    compact = "".join(text.lower().split())
+    found = {
+        group: sum(1 for variants in keywords if any(v in compact for v in variants))
+        for group, keywords in PAGE_KEYWORDS.items()
+    }
+
+    score = sum(found.values())
+
+    # Bonus si hay tanto invoice como address info
+    if found["invoice"] and found["address"]:
+        score += 2
+
+    return score
+
+def pick_invoice_page(scores, threshold=INVOICE_PAGE_THRESHOLD):
+    """
+    Regla única para elegir la página de la factura a partir de {page_index: puntaje}:
+    la primera página (en orden del documento) que alcanza el umbral; si ninguna lo
+    alcanza, la de mayor puntaje (en empate, la anterior). None si no hay páginas.
+    """
+    if not scores:
+        return None
+    indices = sorted(scores)
+    for i in indices:
+        if scores[i] >= threshold:
+            return i
+    return max(indices, key=lambda i: (scores[i], -i))
+
+def classify_pages(pages_text_list):
+    """
+    Clasificador de una lista de textos de página (índice = página): puntúa todas
+    en una sola pasada y aplica pick_invoice_page, la misma regla que usa
+    find_invoice_page al extraer.
+
+    Returns:
+        dict: {"invoice_page": int | None, "scores": tuple}
+    """
+    scores = tuple(score_invoice_page(text) for text in pages_text_list)
+    return {"invoice_page": pick_invoice_page(dict(enumerate(scores))), "scores": scores}
+
+# ----------------------- DETECCIÓN ESCANEADO / TEXTO POR RECURSOS -----------------------
+# Se revisan solo los recursos de cada página (diccionarios /Font y /XObject) con
+# pypdf, sin interpretar el contenido ni hacer análisis de layout. Una página sin
+# fuentes no tiene capa de texto: se manda directo a OCR sin llamar a extract_text.
+# Una página con fuentes e imágenes (escaneo con un sello, folio o capa de OCR
+# parcial) se cuenta además por caracteres: con menos de SCAN_MIN_TEXT_LENGTH
+# también es candidata a OCR.
+TEXT_PAGE = "texto"
+SCANNED_PAGE = "escaneada"
+SCAN_MIN_TEXT_LENGTH = 50
+
+def resource_summary(resources, depth=0):
+    """
+    Indica si un diccionario de recursos tiene fuentes y/o imágenes, incluyendo
+    los Form XObjects anidados (hasta 3 niveles).
 
-def find_invoice_page_index(pages_text_list):
+    Returns:
+        tuple: (tiene_fuentes, tiene_imagenes)
+    """
+    if resources is None:
+        return False, False
+    resources = resources.get_object()
+
+    has_fonts = bool(resources.get("/Font"))
+    has_images = False
+
+    xobjects = resources.get("/XObject")
+    if xobjects:
+        for ref in xobjects.get_object().values():
+            xobject = ref.get_object()
+            subtype = xobject.get("/Subtype")
+            if subtype == "/Image":
+                has_images = True
+            elif subtype == "/Form" and depth < 3:
+                fonts, images = resource_summary(xobject.get("/Resources"), depth + 1)
+                has_fonts = has_fonts or fonts
+                has_images = has_images or images
+
+    return has_fonts, has_images
+
+def page_kind(page, min_text_length=SCAN_MIN_TEXT_LENGTH):
     """
-    Devuelve el índice de la página más probable que contenga los datos principales del invoice.
-    Usa un sistema de puntuación basado en indicadores.
+    SCANNED_PAGE si la página de pypdf no tiene fuentes en sus recursos, o si tiene
+    fuentes e imágenes pero menos de min_text_length caracteres de texto; si no TEXT_PAGE.
+    Las páginas solo con fuentes no se cuentan (no hay imagen que leer con OCR).
     """
+    has_fonts, has_images = resource_summary(page.get("/Resources"))
+    if not has_fonts:
+        return SCANNED_PAGE
+    if has_images:
+        try:
+            text = page.extract_text() or ""
+        except Exception:
+            text = ""
+        if len(text.strip()) < min_text_length:
+            return SCANNED_PAGE
+    return TEXT_PAGE
+
+def scan_page_kinds(pdf_path, min_text_length=SCAN_MIN_TEXT_LENGTH):
+    """
+    Clasifica cada página como TEXT_PAGE o SCANNED_PAGE según sus recursos (y el
+    conteo de caracteres de las que mezclan fuentes e imágenes, ver page_kind).
 
-    if not pages_text_list:
+    Returns:
+        list | None: un tipo por página, o None si pypdf no pudo leer el PDF
+        (en ese caso se debe tratar todas las páginas como de texto).
+    """
+    try:
+        reader = PdfReader(pdf_path)
+        return [page_kind(page, min_text_length) for page in reader.pages]
+    except Exception as e:
+        print(f"⚠️ No se pudieron leer los recursos del PDF {pdf_path}: {e}")
         return None
 
-    invoice_keywords = [
-        "invoice no", "invoice date", "invoice#", "inv no", "inv date"
-    ]
-    address_keywords = [
-        "ship to", "bill to", "consignee", "customer", "sold to"
-    ]
-    financial_keywords = [
-        "subtotal", "total", "payment terms", "due date", "method of shipment", "incoterm"
-    ]
+def probe_pdf(pdf_path):
+    """
+    Sonda barata para clasificar un PDF antes de la extracción completa.
+    Cuenta las páginas y cuántas tienen capa de texto revisando solo sus
+    recursos (scan_page_kinds), sin abrir el modelo de objetos de pdfplumber.
 
-    best_score = 0
-    best_index = None
+    Returns:
+        dict: {"pages": int, "text_pages": int, "needs_ocr": bool}
+    """
+    kinds = scan_page_kinds(pdf_path)
+    if kinds is None:
+        # Si no se puede sondear, se asume el peor caso (OCR)
+        return {"pages": 0, "text_pages": 0, "needs_ocr": True}
 
-    for i, text in enumerate(pages_text_list):
-        text_lower = text.lower().replace("\n", " ")
-        score = 0
+    text_pages = kinds.count(TEXT_PAGE)
+    return {
+        "pages": len(kinds),
+        "text_pages": text_pages,
+        "needs_ocr": text_pages < len(kinds)
+    }
 
-        # Suma puntos según palabras clave encontradas
-        score += sum(1 for k in invoice_keywords if k in text_lower)
-        score += sum(1 for k in address_keywords if k in text_lower)
-        score += sum(1 for k in financial_keywords if k in text_lower)
+@contextmanager
+def open_pdf_source(pdf_source):
+    """
+    Prepara la fuente del PDF (ruta o bytes) para pdfplumber y para el OCR.
+    El OCR necesita una ruta, así que los bytes se vuelcan a un archivo temporal
+    que se elimina al salir del contexto.
 
-        # Bonus si hay tanto invoice como address info
-        if any(k in text_lower for k in invoice_keywords) and any(k in text_lower for k in address_keywords):
-            score += 2
+    Yields:
+        tuple: (fuente_para_pdfplumber, ruta_para_ocr)
+    """
+    temp_file_path = None # Variable para guardar la ruta temporal del archivo
 
-        if score > best_score:
-            best_score = score
-            best_index = i
+    if isinstance(pdf_source, bytes):
+        # Es bytes: Creamos un archivo temporal para que las funciones basadas en ruta funcionen.
+        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
+        temp_file.write(pdf_source)
+        temp_file.close()
+        temp_file_path = temp_file.name
+        # Preparamos el stream de bytes para pdfplumber
+        source = (io.BytesIO(pdf_source), temp_file_path)
+    elif isinstance(pdf_source, str):
+        # Es una ruta: Usamos la ruta directamente para pdfplumber y OCR.
+        source = (pdf_source, pdf_source)
+    else:
+        raise TypeError("pdf_source debe ser str (ruta) o bytes (contenido del PDF).")
 
-    # Si nada fue detectado, usa la primera página como fallback
-    return best_index if best_index is not None else 0
+    try:
+        yield source
+    finally:
+        # Limpieza: Eliminar el archivo temporal si fue creado
+        if temp_file_path and os.path.exists(temp_file_path):
+            try:
+                os.remove(temp_file_path)
+            except OSError as e:
+                print(f"Advertencia: No se pudo eliminar el archivo temporal {temp_file_path}: {e}")
 
 def get_pdf_text_with_ocr_fallback(pdf_source, min_text_length=50, max_pages_to_read=None):
     """
@@ -140,86 +393,409 @@ def get_pdf_text_with_ocr_fallback(pdf_source, min_text_length=50, max_pages_to_
              pages_text_list es una lista con el texto de cada página.
     """
     pages_text_list = []
-    temp_file_path = None # Variable para guardar la ruta temporal del archivo
-    
-    # 1. Determinar si es bytes o ruta, y preparar pdfplumber y la ruta para OCR
-    try:
-        if isinstance(pdf_source, bytes):
-            # Es bytes: Creamos un archivo temporal para que las funciones basadas en ruta funcionen.
-            # Nota: Si el OCR (extraer_texto_ocr) pudiera aceptar bytes, ¡sería mejor!
-            # Creamos el archivo temporal en un contexto 'with' para asegurar su cierre.
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-            temp_file.write(pdf_source)
-            temp_file.close()
-            temp_file_path = temp_file.name
-            
-            # Preparamos el stream de bytes para pdfplumber
-            pdf_plumber_source = io.BytesIO(pdf_source)
-            pdf_path_for_ocr = temp_file_path
-            
-        elif isinstance(pdf_source, str):
-            # Es una ruta: Usamos la ruta directamente para pdfplumber y OCR.
-            pdf_plumber_source = pdf_source
-            pdf_path_for_ocr = pdf_source
-            
-        else:
-            raise TypeError("pdf_source debe ser str (ruta) o bytes (contenido del PDF).")
-            
-    except Exception as e:
-        print(f"❌ Error al preparar la fuente del PDF: {e}")
-        return "", []
 
     try:
-        # 2. Abre el PDF con pdfplumber (desde la ruta o el stream de bytes)
-        with pdfplumber.open(pdf_plumber_source) as pdf:
-            
-            num_pages = len(pdf.pages)
-            pages_to_read = num_pages if max_pages_to_read is None else min(max_pages_to_read, num_pages)
-            
-            for i in range(pages_to_read):
-                page_num = i + 1
-                page = pdf.pages[i]
+        # 1. Determinar si es bytes o ruta, y preparar pdfplumber y la ruta para OCR
+        with open_pdf_source(pdf_source) as (pdf_plumber_source, pdf_path_for_ocr):
+            # 2. Abre el PDF con pdfplumber (desde la ruta o el stream de bytes)
+            with pdfplumber.open(pdf_plumber_source) as pdf:
                 
-                # --- Intento 1: Extracción de texto plano (pdfplumber) ---
-                page_content = page.extract_text() or ""
+                num_pages = len(pdf.pages)
+                pages_to_read = num_pages if max_pages_to_read is None else min(max_pages_to_read, num_pages)
                 
-                if len(page_content.strip()) < min_text_length:
-                    # print(f"Página {page_num}: Texto plano insuficiente. Recurriendo a OCR...")
-                    # --- Intento 2: OCR solo en esta página usando la ruta temporal ---
-                    # USAMOS la ruta del archivo (original o temporal) para el OCR
-                    # print("ruta" + pdf_path_for_ocr )
-                    ocr_content = extraer_texto_ocr(pdf_path_for_ocr, page_num)
-                    
+                # Las páginas escaneadas (sin fuentes) van directo a OCR
+                kinds = scan_page_kinds(pdf_path_for_ocr) or [TEXT_PAGE] * num_pages
+
+                # --- Intento 1: Extracción de texto plano (pdfplumber) ---
+                plain_texts = []
+                low_text_pages = []
+                for i in range(pages_to_read):
+                    page_content = (pdf.pages[i].extract_text() or "") if kinds[i] == TEXT_PAGE else ""
+                    plain_texts.append(page_content)
+                    if len(page_content.strip()) < min_text_length:
+                        low_text_pages.append(i + 1)
+
+                # --- Intento 2: OCR solo en las páginas con texto insuficiente ---
+                # USAMOS la ruta del archivo (original o temporal) para el OCR.
+                # Las páginas se reparten entre procesos y se reensamblan en orden.
+                ocr_texts = ocr_pages(pdf_path_for_ocr, low_text_pages) if low_text_pages else {}
+
+                for i, page_content in enumerate(plain_texts):
+                    ocr_content = ocr_texts.get(i + 1)
+
                     # Si el OCR proporciona un texto significativamente mejor
-                    if len(ocr_content.strip()) > len(page_content.strip()):
+                    if ocr_content and len(ocr_content.strip()) > len(page_content.strip()):
                         page_content = ocr_content
-                        # print(f"Página {page_num}: Éxito con OCR.")
-                    # else:
-                        # print(f"Página {page_num}: El OCR no mejoró el resultado o fue nulo.")
 
-                if page_content:
-                    pages_text_list.append(page_content)
-                
-            full_text = "\n".join(pages_text_list)
-            return full_text, pages_text_list
+                    if page_content:
+                        pages_text_list.append(page_content)
+                    
+                full_text = "\n".join(pages_text_list)
+                return full_text, pages_text_list
             
     except Exception as e:
         print(f"❌ Error crítico al procesar el PDF: {e}")
         return "", []
-        
-    finally:
-        # 3. Limpieza: Eliminar el archivo temporal si fue creado
-        if temp_file_path and os.path.exists(temp_file_path):
+
+# ----------------------- MOTOR DE EXTRACCIÓN POR NIVELES -----------------------
+# Para clasificar páginas basta el texto crudo de pypdf (rápido, sin análisis de
+# layout por carácter). El extract_text de pdfplumber, que preserva el layout que
+# esperan los regex de los extractores, solo se ejecuta en la página elegida.
+FAST_TEXT_ENGINE = True
+
+def set_fast_text_engine(enabled):
+    """Activa/desactiva el texto rápido (pypdf) para clasificar páginas en este proceso."""
+    global FAST_TEXT_ENGINE
+    FAST_TEXT_ENGINE = bool(enabled)
+
+def fast_page_texts(pdf_path):
+    """
+    Texto de cada página para clasificación. Usa pypdf (y omite las páginas
+    escaneadas); si el motor rápido está apagado o pypdf no puede leer el PDF,
+    usa pdfplumber.
+
+    Yields:
+        tuple: (page_index, texto)
+    """
+    reader = None
+    if FAST_TEXT_ENGINE:
+        try:
+            reader = PdfReader(pdf_path)
+            num_pages = len(reader.pages)
+        except Exception as e:
+            print(f"⚠️ pypdf no pudo leer {pdf_path} ({e}); se usa pdfplumber.")
+            reader = None
+
+    if reader is not None:
+        for i in range(num_pages):
+            page = reader.pages[i]
+            # Las páginas sin fuentes van directo a OCR; las que tienen poco texto
+            # las manda a OCR quien consume el texto (min_text_length)
+            has_fonts, _ = resource_summary(page.get("/Resources"))
+            if not has_fonts:
+                yield i, ""
+                continue
             try:
-                os.remove(temp_file_path)
-                # print(f"Archivo temporal eliminado: {temp_file_path}")
-            except OSError as e:
-                print(f"Advertencia: No se pudo eliminar el archivo temporal {temp_file_path}: {e}")
+                yield i, page.extract_text() or ""
+            except Exception:
+                yield i, ""
+        return
+
+    with pdfplumber.open(pdf_path) as pdf:
+        kinds = scan_page_kinds(pdf_path) or [TEXT_PAGE] * len(pdf.pages)
+        for i, page in enumerate(pdf.pages):
+            yield i, (page.extract_text() or "") if kinds[i] == TEXT_PAGE else ""
+
+def extract_page_layout_text(pdf_path, page_index):
+    """Texto con layout (pdfplumber) de una sola página, para los extractores de campos."""
+    with pdfplumber.open(pdf_path) as pdf:
+        return pdf.pages[page_index].extract_text() or ""
+
+# Origen del texto de cada página en snapshot["pages"]
+PAGE_SOURCE_TEXT = "texto"          # capa de texto (texto rápido de fast_page_texts)
+PAGE_SOURCE_OCR = "ocr"             # OCR de página completa
+PAGE_SOURCE_REGIONS = "regiones"    # solo las regiones OCR del perfil (página de la factura)
+PAGE_SOURCE_PENDING = "pendiente"   # texto insuficiente, todavía sin OCR
+
+def iter_page_batches(pdf_source, min_text_length=50, allow_ocr=True, pages=None):
+    """
+    Iterador perezoso de páginas por lotes: el primero trae las páginas con capa de
+    texto (baratas, con el texto rápido de fast_page_texts) y los siguientes las
+    páginas con texto insuficiente, con OCR en lotes de OCR_PAGE_WORKERS páginas que
+    ocr_pages reparte entre procesos. Quien consume el iterador decide después de
+    cada lote si ya encontró lo que busca: el lote siguiente nunca se procesa. Con
+    allow_ocr=False solo se entrega el lote de capa de texto.
+    Si se pasa pages (dict), se anota {page_index: {"text", "source"}} de cada página
+    leída; las de texto insuficiente quedan como PAGE_SOURCE_PENDING hasta su OCR.
+
+    Yields:
+        list: [(page_index, texto, used_ocr), ...], con page_index base 0 en el PDF.
+    """
+    pages = {} if pages is None else pages
+    with open_pdf_source(pdf_source) as (_, pdf_path):
+        text_pages = []
+        low_text_pages = []
+        for i, page_content in fast_page_texts(pdf_path):
+            if len(page_content.strip()) < min_text_length:
+                low_text_pages.append((i, page_content))
+                if pages.get(i, {}).get("source") != PAGE_SOURCE_OCR:
+                    pages[i] = {"text": page_content, "source": PAGE_SOURCE_PENDING}
+            else:
+                text_pages.append((i, page_content, False))
+                pages[i] = {"text": page_content, "source": PAGE_SOURCE_TEXT}
+        yield text_pages
+
+        if not allow_ocr:
+            return
+
+        for start in range(0, len(low_text_pages), OCR_PAGE_WORKERS):
+            lote = low_text_pages[start:start + OCR_PAGE_WORKERS]
+            ocr_texts = ocr_pages(pdf_path, [i + 1 for i, _ in lote])
+            batch = []
+            for i, page_content in lote:
+                ocr_content = ocr_texts.get(i + 1) or ""
+                if len(ocr_content.strip()) > len(page_content.strip()):
+                    batch.append((i, ocr_content, True))
+                    pages[i] = {"text": ocr_content, "source": PAGE_SOURCE_OCR}
+                else:
+                    pages[i] = {"text": page_content, "source": PAGE_SOURCE_OCR}
+                    if page_content:
+                        batch.append((i, page_content, False))
+            yield batch
+
+def find_invoice_page(pdf_source, min_text_length=50, threshold=INVOICE_PAGE_THRESHOLD, allow_ocr=True, pages=None):
+    """
+    Página de la factura según pick_invoice_page (la misma regla de classify_pages),
+    con salida temprana: después de cada lote de iter_page_batches se aplica la regla
+    a las páginas vistas y, si la elegida ya alcanza el umbral, no se lee ni se hace
+    OCR del resto. Si ninguna lo alcanza, la de mejor puntaje entre todas.
+
+    La clasificación usa el texto rápido; si la página elegida es de capa de
+    texto, se vuelve a extraer solo esa página con pdfplumber. El índice queda
+    en el documento (Invoice.invoice_page y el texto guardado junto al PDF), así
+    el separador de adjuntos no vuelve a clasificar. pages se pasa a
+    iter_page_batches para conservar el texto de todas las páginas leídas.
+
+    Returns:
+        tuple: (page_index, page_text). (None, "") si el PDF no tiene texto.
+    """
+    scores = {}
+    seen = {}
+    invoice_page = None
+    page_text = ""
+
+    try:
+        with open_pdf_source(pdf_source) as (_, pdf_path):
+            for batch in iter_page_batches(pdf_path, min_text_length, allow_ocr, pages):
+                for i, text, used_ocr in batch:
+                    scores[i] = score_invoice_page(text)
+                    seen[i] = (text, used_ocr)
+                invoice_page = pick_invoice_page(scores, threshold)
+                if invoice_page is not None and scores[invoice_page] >= threshold:
+                    break
+
+            if invoice_page is not None:
+                page_text, used_ocr = seen[invoice_page]
+                if not used_ocr and FAST_TEXT_ENGINE:
+                    page_text = extract_page_layout_text(pdf_path, invoice_page)
+    except Exception as e:
+        print(f"❌ Error crítico al procesar el PDF: {e}")
+
+    return invoice_page, page_text
+
+# Región del encabezado (Invoice No / Invoice Date / S/O#): mitad derecha superior
+HEADER_REGION = (0.45, 0.0, 1.0, 0.25)
+INVOICE_NO_PATTERN = re.compile(r"Invoice\s*No[:\s]*([A-Za-z0-9\-]+)", re.I)
+
+def probe_invoice_number(pdf_source, time_budget=2.0, allow_ocr=True):
+    """
+    Sonda rápida para nombrar el adjunto: busca el Invoice No solo en la capa de
+    texto de la primera página y, si no aparece y queda tiempo, en un OCR de la
+    región del encabezado a baja resolución. time_budget (segundos) acota el OCR:
+    antes de renderizar y antes de Tesseract se descuenta lo ya gastado y, si queda
+    menos de medio segundo, la sonda se rinde. La lectura de la capa de texto no se
+    puede interrumpir (es una sola página y suele tardar milisegundos), así que en
+    un PDF patológico la sonda puede pasarse del presupuesto.
+
+    Returns:
+        str | None: el número de factura, o None si la sonda no pudo responder
+        (el nombre se resuelve después, en la etapa de parseo).
+    """
+    inicio = time.monotonic()
+
+    try:
+        with open_pdf_source(pdf_source) as (pdf_plumber_source, pdf_path_for_ocr):
+            with pdfplumber.open(pdf_plumber_source) as pdf:
+                if not pdf.pages:
+                    return None
+                first_page_text = pdf.pages[0].extract_text() or ""
+
+            m_inv = INVOICE_NO_PATTERN.search(re.sub(r"[\r\n]+", " ", first_page_text))
+            if m_inv:
+                return m_inv.group(1).strip()
+
+            restante = time_budget - (time.monotonic() - inicio)
+            if not allow_ocr or restante < 0.5:
+                return None
+            imagen = renderizar_pagina(pdf_path_for_ocr, 1, 200, os.path.getmtime(pdf_path_for_ocr), restante)
+
+            # Tesseract solo recibe lo que dejó el renderizado
+            restante = time_budget - (time.monotonic() - inicio)
+            if restante < 0.5:
+                return None
+            binaria = preprocesar_imagen(recortar_region(imagen, HEADER_REGION))
+            header_text = pytesseract.image_to_string(binaria, lang='eng', config="--psm 6", timeout=restante)
+            m_inv = INVOICE_NO_PATTERN.search(re.sub(r"[\r\n]+", " ", header_text))
+            return m_inv.group(1).strip() if m_inv else None
+
+    except Exception as e:
+        # RuntimeError de pytesseract/pdf2image por timeout, PDF dañado, etc.
+        print(f"⚠️ La sonda de encabezado no respondió ({e}); el nombre se resolverá al parsear.")
+        return None
+
+# ----------------------- OCR POR REGIONES (LAYOUT CONOCIDO) -----------------------
+# Zonas de la factura por plantilla, en fracciones de la página (izq, arriba, der, abajo),
+# con el modo de segmentación de Tesseract adecuado para cada zona. Solo se hace OCR
+# de estas zonas en lugar de la página completa a 300 DPI.
+#
+# Las cajas solo sirven para el formato de su remitente: antes de recortar el resto de
+# la página se hace OCR de la zona del membrete ("sender") y el perfil se usa solo si
+# aparece una de sus palabras clave (minúsculas y sin espacios). Si ningún perfil
+# coincide, o si alguna región obligatoria sale vacía o ilegible, se usa el OCR de
+# página completa.
+LAYOUT_PROFILES = {
+    "sterling": {
+        "keywords": ("sterlinginternational", "petroleumdr", "27-3183164"),
+        "sender":    {"box": (0.00, 0.00, 0.55, 0.25), "psm": 6},
+        "regions": {
+            "header":    {"box": (0.45, 0.00, 1.00, 0.25), "psm": 6},
+            "addresses": {"box": (0.00, 0.20, 1.00, 0.45), "psm": 4},
+            "terms":     {"box": (0.00, 0.40, 1.00, 0.52), "psm": 6},
+            "products":  {"box": (0.00, 0.48, 1.00, 0.80), "psm": 6},
+            "totals":    {"box": (0.45, 0.70, 1.00, 1.00), "psm": 6},
+        },
+    },
+}
+DEFAULT_LAYOUT_PROFILE = "sterling"
+LAYOUT_SECTIONS = ("header", "addresses", "terms", "products", "totals")
+
+# Señal mínima de que el recorte de cada región obligatoria cayó sobre su bloque:
+# encabezado de la tabla más un valor (fecha o importe). Las regiones son cortas,
+# así que el .*? no tiene texto largo que recorrer.
+REQUIRED_REGIONS = {
+    "terms": re.compile(r"(?:Incoterm|lncoterm|lncotenn|Payment\s*Terms).*?\d{1,2}\s*/\s*\d{1,2}", re.I | re.S),
+    "products": re.compile(r"Product\s*No.*?\d[\d,]*\.\d{2}", re.I | re.S),
+    "totals": re.compile(r"(?:Subtotal|TOTAL)\s*[\d\s,\.]+\.\d{2}", re.I),
+}
+
+def ocr_region(pdf_path, page_index, region):
+    return extraer_texto_ocr_region(pdf_path, page_index + 1, region["box"], psm=region["psm"])
+
+def extract_invoice_regions(pdf_path, profile_name=None, min_text_length=50):
+    """
+    OCR por regiones para PDFs escaneados. Recorre las páginas sin capa de texto
+    (o con fuentes pero menos de min_text_length caracteres),
+    hace OCR solo del encabezado y, en la primera que tenga Invoice No, confirma el
+    remitente con la zona del membrete y hace OCR del resto de las regiones de su
+    perfil (profile_name fija el perfil; None prueba todos).
+
+    Returns:
+        tuple: (page_index, {region: texto}, perfil). (None, {}, None) si ninguna
+        página respondió, si el remitente no tiene perfil o si una región obligatoria
+        (REQUIRED_REGIONS) no se pudo leer; en esos casos se debe usar el OCR de
+        página completa.
+    """
+    profile_names = [profile_name] if profile_name else list(LAYOUT_PROFILES)
+
+    kinds = scan_page_kinds(pdf_path, min_text_length)
+    if kinds is not None:
+        candidates = [i for i, kind in enumerate(kinds) if kind == SCANNED_PAGE]
+    else:
+        with pdfplumber.open(pdf_path) as pdf:
+            candidates = [i for i, page in enumerate(pdf.pages) if len(page.chars) < min_text_length]
+
+    for i in candidates:
+        es_factura = False
+        for name in profile_names:
+            profile = LAYOUT_PROFILES[name]
+            header_text = ocr_region(pdf_path, i, profile["regions"]["header"])
+            if not INVOICE_NO_PATTERN.search(re.sub(r"[\r\n]+", " ", header_text)):
+                continue
+            es_factura = True
+            sender_text = ocr_region(pdf_path, i, profile["sender"])
+            compact = "".join(sender_text.lower().split())
+            if not any(keyword in compact for keyword in profile["keywords"]):
+                continue
+
+            regions = {"sender": sender_text, "header": header_text}
+            for region_name, region in profile["regions"].items():
+                if region_name != "header":
+                    regions[region_name] = ocr_region(pdf_path, i, region)
+
+            ilegibles = [r for r, pattern in REQUIRED_REGIONS.items() if not pattern.search(regions.get(r, ""))]
+            if ilegibles:
+                print(f"⚠️ OCR por regiones ({name}) sin datos en {', '.join(ilegibles)}: se usa el OCR de página completa.")
+                return None, {}, None
+            return i, regions, name
+
+        if es_factura:
+            # Es la página de la factura, pero de un remitente sin perfil
+            return None, {}, None
+
+    return None, {}, None
+
+def sections_from_regions(regions):
+    """
+    Arma el texto que recibe cada extractor a partir de las regiones. Algunos
+    extractores usan como ancla el inicio de la región siguiente (Bill To termina
+    en Incoterm, los términos en Product No, el producto en Subtotal), por eso
+    cada sección incluye la región que le sigue.
+    """
+    one = {k: re.sub(r"[\r\n]+", " ", regions.get(k, "")) for k in LAYOUT_SECTIONS}
+    return {
+        "header": one["header"],
+        "addresses": f"{one['addresses']} {one['terms']}",
+        "terms": f"{one['terms']} {one['products']}",
+        "products": f"{one['products']} {one['totals']}",
+        "totals": one["totals"],
+    }
+
+# ----------------------- PRESUPUESTO DE TIEMPO DE LOS EXTRACTORES -----------------------
+# Varios patrones combinan .*? con DOTALL y grupos opcionales; sobre basura de OCR larga
+# su peor caso es polinomial (minutos). Cada extractor corre con un presupuesto de
+# EXTRACTOR_TIME_BUDGET segundos y, si lo excede, devuelve "no encontrado". El corte usa
+# SIGALRM (el motor de re revisa señales durante el backtracking), así que solo aplica en
+# POSIX y en el hilo principal; en Windows quedan las ventanas acotadas de texto que usa
+# cada extractor (TERMS_WINDOW, PRODUCT_WINDOW, ADDRESS_WINDOW).
+EXTRACTOR_TIME_BUDGET = 0.5
+TERMS_WINDOW = 600  # caracteres desde el encabezado Incoterm/Payment Terms
+PRODUCT_WINDOW = 400  # caracteres del bloque de la línea de producto
+ADDRESS_WINDOW = 800  # caracteres máximos entre "Ship To:" y "Bill To:"
+
+class ExtractorTimeout(Exception):
+    pass
+
+def set_extractor_time_budget(seconds):
+    """Cambia el presupuesto por extractor (None o 0 lo desactiva)."""
+    global EXTRACTOR_TIME_BUDGET
+    EXTRACTOR_TIME_BUDGET = seconds
+
+def _raise_extractor_timeout(signum, frame):
+    raise ExtractorTimeout()
+
+def time_budgeted(not_found):
+    """
+    Decorador para extractores fn(text): si fn excede EXTRACTOR_TIME_BUDGET se
+    devuelve not_found() en lugar de seguir consumiendo CPU.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(text, *args, **kwargs):
+            if (not EXTRACTOR_TIME_BUDGET or not hasattr(signal, "setitimer")
+                    or threading.current_thread() is not threading.main_thread()
+                    or signal.getitimer(signal.ITIMER_REAL)[0]):
+                # Sin SIGALRM, fuera del hilo principal o con otro temporizador activo
+                return fn(text, *args, **kwargs)
+
+            previous = signal.signal(signal.SIGALRM, _raise_extractor_timeout)
+            signal.setitimer(signal.ITIMER_REAL, EXTRACTOR_TIME_BUDGET)
+            try:
+                return fn(text, *args, **kwargs)
+            except ExtractorTimeout:
+                print(f"⏱️ {fn.__name__} excedió {EXTRACTOR_TIME_BUDGET}s sobre {len(text)} caracteres: se da como no encontrado")
+                return not_found()
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, previous)
+        return wrapper
+    return decorator
 
 # PASO 1
+@time_budgeted(lambda: {"Invoice No": None, "Invoice Date": None, "S/O#": None})
 def extract_headers(text):
     # corregimos S/0# -> S/O#
     text = text.replace("S/0#", "S/O#")
+    invoiceNumber = invoiceDate = invoiceSO = None
     # patrones básicos
     m_inv = re.search(r"Invoice\s*No[:\s]*([A-Za-z0-9\-]+)", text, re.I)
     if m_inv:
@@ -240,6 +816,7 @@ def extract_headers(text):
     }
 
 # Obtiene el valor de el pedimento buscando en todas las hojas el pdf. El S/O# puede ser erroneo, por es se busca como opcion en todas las hojas.
+@time_budgeted(lambda: {"S/O NO": None})
 def extract_so_no(text):
     # La regex busca "S/O NO", seguida de ":", luego opcionalmente espacios,
     # y finalmente captura cualquier carácter (dígitos, letras, etc.) hasta
@@ -285,6 +862,7 @@ ARROW_MAGNOLIA_ALT = "28789 Hardin Store Rd. Suite 230\nMagnolia, TX 77354"
 EAGLE_PASS_ADDRESS = "c/o Villarreal & Medina Forwarding Inc.\n14404 Investment Ave.\nEagle Pass, TX 78852"
 LAREDO_ADDRESS = "c/o Medina Logistic Services, Inc.\n14402 Investment Ave.\nLaredo, TX 78045"
 
+@time_budgeted(lambda: {"Ship To": "Ship To Not Found", "Bill To": "Bill To Not Found"})
 def extract_shipto_billto(text):
     # --- Limpieza agresiva ---
     def aggressive_cleanup(t):
@@ -321,7 +899,7 @@ def extract_shipto_billto(text):
     medina_pattern = r"Medina\s*Logistic\s*Services"
 
     # --- Extraer bloques ---
-    shipto_block = re.search(r'Ship To:\s*(.*?)\s*Bill To:', text, flags=I | DOTALL)
+    shipto_block = re.search(r'Ship To:\s*(.{0,%d}?)\s*Bill To:' % ADDRESS_WINDOW, text, flags=I | DOTALL)
     shipto_text = shipto_block.group(1).strip() if shipto_block else ""
     billto_block = re.search(r'Bill To:\s*(.*?)(RFC:|Incoterm|Payment|Subtotal|TOTAL|Product No\.|$)', text, flags=I | DOTALL)
     billto_text = billto_block.group(1).strip() if billto_block else ""
@@ -410,6 +988,10 @@ def extract_shipto_billto(text):
     }
 
 # PASO 3
+@time_budgeted(lambda: {
+    "Incoterm": None, "Payment Terms": None, "Ship Date": None,
+    "Due Date": None, "Method of Shipment": None
+})
 def extract_shipping_terms(text):
     """
     Extrae los términos de envío (Incoterm, Payment Terms, Fechas y Método) 
@@ -432,6 +1014,12 @@ def extract_shipping_terms(text):
     re.IGNORECASE | re.DOTALL
     )
 
+    # Solo se busca en una ventana después del encabezado: el bloque real mide ~100
+    # caracteres y así el .*? no recorre todo el texto cuando falta "Product No"
+    header_match = re.search(r"(?:Incoterm|lncoterm|lncotenn)\s*Payment\s*Terms", text, re.I)
+    if header_match:
+        text = text[header_match.start():header_match.start() + TERMS_WINDOW]
+
     match = pattern.search(text)
     
     if match:
@@ -533,6 +1121,10 @@ def safe_float_conversion(value_str):
         return float(value_str.replace(',', ''))
     return None
         
+@time_budgeted(lambda: {
+    "Product No.": None, "Item Qty": None, "U/M": None, "Description": None,
+    "Transport No.": None, "Price Each": None, "Amount": None
+})
 def extract_product_detail(text):
     """
     Extrae los detalles de la línea de producto, manejando Product No. faltante, 
@@ -559,6 +1151,8 @@ def extract_product_detail(text):
         transport_match = re.search(r"((RAILCAR|TRUCK|VESSEL)\s*#\s*([A-Z0-9]+))", prod_data_block, re.I)
         transport_no = transport_match.group(1).strip() if transport_match else None
         clean_data_block = re.sub(r'(RAILCAR|TRUCK|VESSEL)\s*#\s*[A-Z0-9]+', '', prod_data_block, flags=re.I).strip()
+        # Una sola línea de producto: acotar el bloque evita el peor caso del patrón
+        clean_data_block = clean_data_block[:PRODUCT_WINDOW]
         
         # --- 5. Extracción de la Línea de Producto ---
         
@@ -650,6 +1244,7 @@ def extract_product_detail(text):
         "Transport No.": None, "Price Each": None, "Amount": None
     }
 
+@time_budgeted(lambda: None)
 def extract_raildcar_v1(text):
     # Definición de patrones base
     base_pattern = r"(RAILCAR|TRUCK|VESSEL)\s*#?\s*"
@@ -710,6 +1305,7 @@ def extract_raildcar_v1(text):
     return None
 
 # PASO 5
+@time_budgeted(lambda: {"Subtotal": None, "Total": None})
 def extract_totals(text):
     # Nueva Regex: permite que la parte entera tenga dígitos, espacios, puntos o comas
     # y termina con un punto y dos decimales.
@@ -818,84 +1414,628 @@ def extract_totals(text):
         
     return results
 
+# ----------------------- EXTRACCIÓN POR COORDENADAS (CAPA DE TEXTO) -----------------------
+# Para PDFs con capa de texto se leen las palabras con sus coordenadas, se ubican los
+# encabezados de columna y se toma el valor que está debajo de cada uno. Evita los
+# regex DOTALL no codiciosos sobre la página aplanada. Si algo no cuadra se devuelve
+# None y se usa el camino por regex (que también es el de OCR).
+TERMS_COLUMNS = ["Incoterm", "Payment Terms", "Ship Date", "Due Date", "Method of Shipment"]
+PRODUCT_COLUMNS = ["Product No.", "Item Qty", "U/M", "Description", "Price Each", "Amount"]
+# Columnas numéricas alineadas a la derecha: se asignan por el borde derecho
+RIGHT_ALIGNED_COLUMNS = {"Item Qty", "Price Each", "Amount"}
+DATE_VALUE_PATTERN = re.compile(r"^\d{1,2}/\d{1,2}/\d{2,4}$")
+
+def group_word_lines(words, tolerance=3):
+    """Agrupa las palabras de extract_words() en renglones según su coordenada top."""
+    lines = []
+    for word in sorted(words, key=lambda w: (w["top"], w["x0"])):
+        if lines and abs(lines[-1][0]["top"] - word["top"]) <= tolerance:
+            lines[-1].append(word)
+        else:
+            lines.append([word])
+    return [sorted(line, key=lambda w: w["x0"]) for line in lines]
+
+def _normalize_label(text):
+    return re.sub(r"[\s:.]", "", text.lower())
+
+def find_header_line(lines, labels):
+    """
+    Busca el primer renglón que contiene todos los encabezados en orden. Tolera
+    que un encabezado venga partido en varias palabras o pegado en una sola.
+
+    Returns:
+        tuple: (indice_renglon, [(label, x0, x1), ...]) o (None, None)
+    """
+    for line_index, line in enumerate(lines):
+        tokens = [_normalize_label(w["text"]) for w in line]
+        spans = []
+        start = 0
+        for label in labels:
+            target = _normalize_label(label)
+            found = None
+            for j in range(start, len(tokens)):
+                joined = ""
+                for k in range(j, len(tokens)):
+                    joined += tokens[k]
+                    if joined == target:
+                        found = (label, line[j]["x0"], line[k]["x1"], k + 1)
+                        break
+                    if not target.startswith(joined):
+                        break
+                if found:
+                    break
+            if not found:
+                break
+            spans.append(found[:3])
+            start = found[3]
+        else:
+            return line_index, spans
+    return None, None
+
+def assign_columns(line, spans, margin=2):
+    """
+    Reparte las palabras de un renglón entre las columnas del encabezado. Las
+    columnas numéricas (alineadas a la derecha) se asignan si la palabra se traslapa
+    con su encabezado; el resto por el borde izquierdo respecto al inicio de la
+    columna siguiente.
+    """
+    columns = {label: [] for label, _, _ in spans}
+    for word in line:
+        target = None
+        for label, x0, x1 in spans:
+            if label in RIGHT_ALIGNED_COLUMNS and min(word["x1"], x1) > max(word["x0"], x0):
+                target = label
+                break
+        if target is None:
+            target = spans[0][0]
+            for label, x0, _ in spans:
+                if label not in RIGHT_ALIGNED_COLUMNS and word["x0"] >= x0 - margin:
+                    target = label
+        columns[target].append(word["text"])
+    return {label: " ".join(texts).strip() for label, texts in columns.items()}
+
+def extract_layout_fields(pdf_path, page_index):
+    """
+    Extrae los términos de envío y la línea de producto por coordenadas.
+
+    Returns:
+        dict: {"terms": dict | None, "product": dict | None} con las mismas llaves
+        que extract_shipping_terms y extract_product_detail.
+    """
+    result = {"terms": None, "product": None}
+    try:
+        with pdfplumber.open(pdf_path) as pdf:
+            words = pdf.pages[page_index].extract_words()
+    except Exception as e:
+        print(f"⚠️ No se pudieron leer las palabras de la página {page_index}: {e}")
+        return result
+
+    lines = group_word_lines(words)
+
+    # --- Términos: un renglón de valores debajo del encabezado ---
+    header_index, spans = find_header_line(lines, TERMS_COLUMNS)
+    if header_index is not None and header_index + 1 < len(lines):
+        values = assign_columns(lines[header_index + 1], spans)
+        ship_date = values["Ship Date"].replace(" ", "")
+        due_date = values["Due Date"].replace(" ", "")
+        if values["Payment Terms"] and DATE_VALUE_PATTERN.match(ship_date):
+            result["terms"] = {
+                "Incoterm": values["Incoterm"].rstrip(":").strip() or None,
+                "Payment Terms": values["Payment Terms"],
+                "Ship Date": ship_date,
+                "Due Date": due_date if DATE_VALUE_PATTERN.match(due_date) else None,
+                "Method of Shipment": values["Method of Shipment"] or None,
+            }
+
+    # --- Producto: primer renglón debajo del encabezado (+ descripción en varios renglones) ---
+    header_index, spans = find_header_line(lines, PRODUCT_COLUMNS)
+    if header_index is not None and header_index + 1 < len(lines):
+        values = assign_columns(lines[header_index + 1], spans)
+        for line in lines[header_index + 2:]:
+            line_text = " ".join(w["text"] for w in line)
+            if re.match(r"(RAILCAR|TRUCK|VESSEL|Subtotal|TOTAL)", line_text, re.I):
+                break
+            extra = assign_columns(line, spans)
+            if any(extra[label] for label in PRODUCT_COLUMNS if label != "Description"):
+                break
+            values["Description"] = f"{values['Description']} {extra['Description']}".strip()
+
+        try:
+            item_qty = safe_float_conversion(values["Item Qty"].replace(" ", ""))
+            price_each = safe_float_conversion(values["Price Each"].replace(" ", ""))
+            amount = safe_float_conversion(values["Amount"].replace(" ", ""))
+        except ValueError:
+            item_qty = price_each = amount = None
+
+        if item_qty is not None and amount is not None:
+            result["product"] = {
+                "Product No.": values["Product No."] or None,
+                "Item Qty": item_qty,
+                "U/M": values["U/M"] or None,
+                "Description": values["Description"] or None,
+                "Transport No.": None,
+                "Price Each": price_each,
+                "Amount": amount,
+            }
+
+    return result
+
+# ----------------------- PLANTILLAS CONOCIDAS (FINGERPRINT) -----------------------
+# La mayoría de las facturas llegan de unos pocos remitentes con formato fijo. Antes
+# de la cascada genérica (regex tolerantes + correcciones de OCR + respaldos) se saca
+# una huella barata de la página: palabras clave del encabezado del remitente y la
+# posición relativa de las anclas (renglón sobre el total de renglones, o la región
+# del OCR por zonas donde apareció). Si la huella coincide con una plantilla
+# registrada, su extractor lee los campos con anclas precalculadas: renglón del
+# encabezado -> renglón de valores, con un patrón compilado por campo. Siempre hace
+# falta una palabra clave del remitente (nombre, dirección o el Federal ID
+# 27-3183164): en el OCR por zonas se buscan en las regiones del membrete y del
+# encabezado, nunca basta con que las regiones se hayan recortado con el perfil de la
+# plantilla. Lo que el extractor de la plantilla no resuelva (None) lo completa el
+# camino genérico, y una página desconocida va completa por el camino genérico.
+TEMPLATE_KEYWORD_CHARS = 600  # el encabezado del remitente está al inicio de la página
+
+# Anclas de la huella: patrón y, por plantilla, la banda relativa (renglón / total)
+# y la región del OCR por zonas donde se espera cada una
+FINGERPRINT_ANCHORS = {
+    "invoice_no": re.compile(r"Invoice\s*No", re.I),
+    "ship_to": re.compile(r"Ship\s*To", re.I),
+    "terms": re.compile(r"Payment\s*Terms\s*Ship\s*Date", re.I),
+    "product": re.compile(r"Product\s*No", re.I),
+    "subtotal": re.compile(r"Subtotal", re.I),
+}
+
+def layout_fingerprint(snapshot):
+    """
+    Huella de la página de la factura a partir del texto de collect_invoice_text.
+
+    Returns:
+        dict: {"keywords": set de palabras clave del encabezado encontradas,
+               "profile": perfil de LAYOUT_PROFILES de las regiones o None,
+               "anchors": {ancla: banda relativa 0-1 (None si no está) o
+               tupla de regiones donde aparece}}
+    """
+    page_text = snapshot["page_text"] or ""
+    if snapshot["regions"]:
+        # Solo membrete y encabezado: la dirección del remitente también puede
+        # aparecer en Ship To / Bill To de otra factura
+        head = snapshot["regions"].get("sender", "") + snapshot["regions"].get("header", "")
+    else:
+        head = page_text[:TEMPLATE_KEYWORD_CHARS]
+    head = "".join(head.lower().split())
+    keywords = {k for template in TEMPLATES.values() for k in template["keywords"] if k in head}
+    # Los snapshots guardados antes de elegir perfil se recortaban siempre con el predeterminado
+    profile = snapshot.get("profile") or (DEFAULT_LAYOUT_PROFILE if snapshot["regions"] else None)
+
+    anchors = {}
+    if snapshot["regions"] and keywords:
+        for name, pattern in FINGERPRINT_ANCHORS.items():
+            # Las zonas del perfil se traslapan: un ancla puede caer en dos regiones
+            anchors[name] = tuple(region for region, text in snapshot["regions"].items() if pattern.search(text))
+    elif keywords:
+        # Sin palabras clave ninguna plantilla puede coincidir: no se ubican las anclas
+        lines = [line for line in page_text.splitlines() if line.strip()]
+        for name, pattern in FINGERPRINT_ANCHORS.items():
+            index = next((i for i, line in enumerate(lines) if pattern.search(line)), None)
+            anchors[name] = index / len(lines) if index is not None else None
+    return {"keywords": keywords, "profile": profile, "anchors": anchors}
+
+def match_template(fingerprint):
+    """
+    Nombre de la plantilla cuya huella coincide, o None si la página es desconocida.
+    Exige una palabra clave del remitente; con regiones, además, el mismo perfil.
+    """
+    for name, template in TEMPLATES.items():
+        if not set(template["keywords"]) & fingerprint["keywords"]:
+            continue
+        if fingerprint["profile"] is not None and template["profile"] != fingerprint["profile"]:
+            continue
+        ok = True
+        for anchor, (low, high, region) in template["anchors"].items():
+            position = fingerprint["anchors"].get(anchor)
+            if isinstance(position, tuple):
+                ok = region in position
+            else:
+                ok = position is not None and low <= position <= high
+            if not ok:
+                break
+        if ok:
+            return name
+    return None
+
+def _template_amount(value):
+    """'83 248.00' / '114.371.50' -> float: todo antes de los decimales es separador de miles."""
+    value = value.strip()
+    if not re.fullmatch(r"[\d\s,\.]+\.\d{2}", value):
+        return None
+    return safe_float_conversion(re.sub(r"[\s,\.]", "", value[:-3]) + value[-3:])
+
+def _line_after(lines, pattern):
+    """Índice del renglón siguiente al primero que cumple pattern, o None."""
+    for i, line in enumerate(lines[:-1]):
+        if pattern.search(line):
+            return i + 1
+    return None
+
+# Anclas precalculadas de la plantilla Sterling International
+STERLING_HEADER = re.compile(
+    r"Invoice No:\s*([A-Za-z0-9\-]+).*?Invoice Date:\s*(\d{1,2}/\d{1,2}/\d{2,4}).*?S/[O0]#\s*([A-Z0-9]+)", re.S
+)
+STERLING_TERMS_VALUES = re.compile(
+    r"^(?P<incoterm>.+?):?\s+(?P<payment_terms>Net \d+ Days|Prepaid|Collect)\s+"
+    r"(?P<ship_date>\d{1,2}/\d{1,2}/\d{2,4})\s+(?P<due_date>\d{1,2}/\d{1,2}/\d{2,4})\s+(?P<method>\S.*)$"
+)
+STERLING_PRODUCT_VALUES = re.compile(
+    r"^(?P<product_no>[A-Z0-9\-]+)\s+(?P<qty>\d[\d,]*)\s*/?\s*(?P<um>[A-Za-z]+)\s+(?P<description>.+?)\s+"
+    r"(?P<price_each>\d[\d,]*\.\d+)\s+(?P<amount>\d[\d,]*\.\d{2})$"
+)
+STERLING_TRANSPORT = re.compile(r"^(RAILCAR|TRUCK|VESSEL)\s*#\s*([A-Z0-9]{4,})")
+STERLING_TOTALS = re.compile(r"^(Subtotal|TOTAL)\s+(.+)$")
+STERLING_CUSTOMERS = re.compile(
+    r"Plasticos Adheribles del Bajio|Grupo Industrial Reyma|Polietilenos del Centro|"
+    r"Reyma Del Noroeste|Termofilm Y Espumados Leon"
+)
+# Razón social tal como la deja la limpieza final de extract_shipto_billto
+STERLING_LEGAL_NAMES = {
+    "Plasticos Adheribles del Bajio": "Plasticos Adheribles del Bajio S.A. de C.V.",
+    "Polietilenos del Centro": "Polietilenos del Centro S.A. de C.V.",
+    "Grupo Industrial Reyma": "Grupo Industrial Reyma S.A. de C.V.",
+}
+STERLING_FORWARDERS = (
+    ("Medina Logistic Services", LAREDO_ADDRESS),
+    ("Villarreal & Medina Forwarding", EAGLE_PASS_ADDRESS),
+)
+
+def extract_sterling(snapshot):
+    """
+    Extractor de la plantilla Sterling: lee cada bloque en su renglón conocido.
+    Solo acepta el formato exacto; un campo que no cuadra queda en None y lo
+    resuelve el extractor genérico correspondiente.
+    """
+    fields = dict.fromkeys(("headers", "so_no", "addresses", "terms", "product", "transport", "totals"))
+    regions = snapshot["regions"] or {}
+    page_text = snapshot["page_text"] or ""
+
+    def lines_of(region):
+        text = regions.get(region, page_text) if regions else page_text
+        # Los separadores de columna que deja el OCR ("|", "_|") no son parte de ningún valor
+        return [" ".join(line.replace("|", " ").split()) for line in text.splitlines() if line.strip(" |_")]
+
+    header = STERLING_HEADER.search(regions.get("header", page_text) if regions else page_text)
+    if header:
+        fields["headers"] = {"Invoice No": header.group(1), "Invoice Date": header.group(2), "S/O#": header.group(3)}
+        fields["so_no"] = {"S/O NO": header.group(3)}
+
+    lines = lines_of("terms")
+    index = _line_after(lines, FINGERPRINT_ANCHORS["terms"])
+    match = STERLING_TERMS_VALUES.match(lines[index]) if index is not None else None
+    if match:
+        fields["terms"] = {
+            "Incoterm": match.group("incoterm"),
+            "Payment Terms": match.group("payment_terms"),
+            "Ship Date": match.group("ship_date"),
+            "Due Date": match.group("due_date"),
+            "Method of Shipment": match.group("method"),
+        }
+
+    lines = lines_of("products")
+    index = _line_after(lines, FINGERPRINT_ANCHORS["product"])
+    match = STERLING_PRODUCT_VALUES.match(lines[index]) if index is not None else None
+    if match:
+        fields["product"] = {
+            "Product No.": match.group("product_no"),
+            "Item Qty": safe_float_conversion(match.group("qty")),
+            "U/M": match.group("um"),
+            "Description": match.group("description"),
+            "Transport No.": None,
+            "Price Each": safe_float_conversion(match.group("price_each")),
+            "Amount": safe_float_conversion(match.group("amount")),
+        }
+        for line in lines[index + 1:]:
+            transport = STERLING_TRANSPORT.match(line)
+            if transport:
+                fields["transport"] = transport.group(2)
+                break
+
+    totals = {}
+    for line in lines_of("totals"):
+        match = STERLING_TOTALS.match(line)
+        if match and match.group(1) not in totals:
+            totals[match.group(1)] = _template_amount(match.group(2))
+    if totals.get("Subtotal") is not None and totals.get("TOTAL") is not None:
+        fields["totals"] = {"Subtotal": totals["Subtotal"], "Total": totals["TOTAL"]}
+
+    fields["addresses"] = _sterling_addresses(" ".join(lines_of("addresses")))
+    return fields
+
+def _sterling_addresses(text):
+    """Ship To / Bill To a partir de los clientes y agentes aduanales conocidos del remitente."""
+    customer = STERLING_CUSTOMERS.search(text)
+    if not customer:
+        return None
+    name = customer.group(0)
+    legal_name = STERLING_LEGAL_NAMES.get(name, f"{name} SA de CV")
+
+    bill_to_text = text.split("Bill To", 1)[1] if "Bill To" in text else ""
+    if "Arrow Trading LLC" in bill_to_text:
+        forwarder = next((address for key, address in STERLING_FORWARDERS if key in text), REYMA_US_SHIPTO_ADDRESS)
+        arrow_address = ARROW_MAGNOLIA_ALT if "77354" in bill_to_text else ARROW_MAGNOLIA_ADDRESS
+        return {"Ship To": f"{legal_name}\n{forwarder}", "Bill To": f"Arrow Trading LLC\n{arrow_address}"}
+    if "Arrow" in text:
+        # Arrow fuera del bloque Bill To: formato inesperado, mejor el camino genérico
+        return None
+    mexico_address = PLASTICOS_BAJIO_MEXICO_ADDRESS if name == "Plasticos Adheribles del Bajio" else REYMA_MEXICO_ADDRESS
+    return {"Ship To": f"{legal_name}\n{REYMA_US_SHIPTO_ADDRESS}", "Bill To": f"{legal_name}\n{mexico_address}"}
+
+# Plantillas registradas: palabras clave del encabezado (en minúsculas y sin espacios,
+# basta una), perfil de LAYOUT_PROFILES, anclas {nombre: (banda mínima, banda máxima,
+# región del OCR por zonas)} y extractor
+TEMPLATES = {
+    "sterling": {
+        "keywords": LAYOUT_PROFILES["sterling"]["keywords"],
+        "profile": "sterling",
+        "anchors": {
+            "invoice_no": (0.0, 0.35, "header"),
+            "ship_to": (0.2, 0.65, "addresses"),
+            "terms": (0.4, 0.9, "terms"),
+            "product": (0.45, 0.95, "products"),
+            "subtotal": (0.6, 1.0, "totals"),
+        },
+        "extractor": extract_sterling,
+    },
+}
+TEMPLATE_DISPATCH = True
+
+def set_template_dispatch(enabled):
+    """Activa/desactiva los extractores por plantilla (False = siempre el camino genérico)."""
+    global TEMPLATE_DISPATCH
+    TEMPLATE_DISPATCH = enabled
+
+def template_fields(snapshot):
+    """
+    Huella + extractor de la plantilla. Anota la plantilla en el snapshot (queda en
+    el texto guardado junto al PDF) y devuelve los campos que resolvió, o None.
+    """
+    snapshot["template"] = None
+    if not TEMPLATE_DISPATCH or not snapshot["page_text"]:
+        return None
+    name = match_template(layout_fingerprint(snapshot))
+    if name is None:
+        return None
+    snapshot["template"] = name
+    return TEMPLATES[name]["extractor"](snapshot)
+
+def collect_invoice_text(pdf_path):
+    """
+    Etapa de I/O de la extracción: ubica la página de la factura y devuelve el
+    texto que consumen los extractores (la parte cara cuando hay OCR).
+
+    Returns:
+        dict: {"invoice_page", "page_text", "regions", "text_layer", "full_text",
+        "pages", "profile", "template"} (pages es el texto de cada página por índice,
+        [{"text", "source"}, ...] con source PAGE_SOURCE_*; profile es el perfil de
+        LAYOUT_PROFILES con el que se recortaron las regiones; template lo llena
+        template_fields con la plantilla reconocida).
+        Es serializable a JSON, así que se guarda junto al PDF procesado y el
+        backfill puede volver a parsearlo (y volver a elegir la página de la
+        factura con refresh_invoice_page) sin repetir el OCR.
+    """
+    # Primero solo las páginas con capa de texto. Si ninguna es claramente la
+    # factura, se hace OCR de las regiones del layout y, si eso no responde,
+    # OCR de página completa. El texto completo del PDF se pide después
+    # únicamente si la página de la factura no basta.
+    pages = {}
+    invoice_page_index, page_text = find_invoice_page(pdf_path, allow_ocr=False, pages=pages)
+    snapshot = {
+        "invoice_page": invoice_page_index,
+        "page_text": page_text or "",
+        "regions": None,
+        "text_layer": False,
+        "full_text": None,
+        "pages": None,
+        "profile": None,
+        "template": None,
+    }
+
+    if score_invoice_page(page_text) >= INVOICE_PAGE_THRESHOLD:
+        # Página de capa de texto: términos y producto se leen por coordenadas
+        snapshot["text_layer"] = True
+    else:
+        roi_page_index, regions, profile = extract_invoice_regions(pdf_path)
+        if regions:
+            snapshot["invoice_page"] = roi_page_index
+            snapshot["page_text"] = "\n".join(regions.values())
+            snapshot["regions"] = regions
+            snapshot["profile"] = profile
+            pages[roi_page_index] = {"text": snapshot["page_text"], "source": PAGE_SOURCE_REGIONS}
+        else:
+            snapshot["invoice_page"], snapshot["page_text"] = find_invoice_page(pdf_path, pages=pages)
+            snapshot["page_text"] = snapshot["page_text"] or ""
+
+    snapshot["pages"] = [pages[i] for i in sorted(pages)]
+    return snapshot
+
+def snapshot_full_text(snapshot, pdf_path, allow_ocr=True):
+    """
+    Texto completo del PDF armado con snapshot["pages"]. Con allow_ocr se hace OCR
+    (repartido por ocr_pages) de las páginas pendientes y de la página leída por
+    regiones, y el resultado queda en snapshot["pages"]; sin OCR se une el texto que
+    ya haya. Los snapshots anteriores sin "pages" usan full_text o, si no existe,
+    get_pdf_text_with_ocr_fallback (o None sin OCR).
+    """
+    pages = snapshot.get("pages")
+    if pages is None:
+        if snapshot.get("full_text") is None and allow_ocr:
+            snapshot["full_text"], _ = get_pdf_text_with_ocr_fallback(pdf_path)
+        return snapshot.get("full_text")
+
+    if allow_ocr:
+        pendientes = [i for i, page in enumerate(pages) if page["source"] in (PAGE_SOURCE_PENDING, PAGE_SOURCE_REGIONS)]
+        ocr_texts = ocr_pages(pdf_path, [i + 1 for i in pendientes]) if pendientes else {}
+        for i in pendientes:
+            ocr_content = ocr_texts.get(i + 1) or ""
+            if len(ocr_content.strip()) > len(pages[i]["text"].strip()):
+                pages[i] = {"text": ocr_content, "source": PAGE_SOURCE_OCR}
+            else:
+                pages[i]["source"] = PAGE_SOURCE_OCR
+
+    return "\n".join(page["text"] for page in pages if page["text"].strip())
+
+def refresh_invoice_page(snapshot, pdf_path):
+    """
+    Vuelve a elegir la página de la factura con el texto guardado de cada página
+    (la misma regla de find_invoice_page: primero las de capa de texto y, si ninguna
+    alcanza el umbral, todas). Si cambia, el snapshot pasa a esa página: las de capa
+    de texto se releen con pdfplumber (sin OCR) y las demás usan el texto guardado.
+
+    Returns:
+        bool: True si la página cambió.
+    """
+    pages = snapshot.get("pages")
+    if not pages:
+        return False
+
+    scores = {i: score_invoice_page(page["text"]) for i, page in enumerate(pages) if page["text"].strip()}
+    text_scores = {i: score for i, score in scores.items() if pages[i]["source"] == PAGE_SOURCE_TEXT}
+    invoice_page = pick_invoice_page(text_scores)
+    if invoice_page is None or text_scores[invoice_page] < INVOICE_PAGE_THRESHOLD:
+        invoice_page = pick_invoice_page(scores)
+    if invoice_page is None or invoice_page == snapshot["invoice_page"]:
+        return False
+
+    page = pages[invoice_page]
+    text_layer = page["source"] == PAGE_SOURCE_TEXT
+    snapshot["invoice_page"] = invoice_page
+    snapshot["page_text"] = extract_page_layout_text(pdf_path, invoice_page) if text_layer else page["text"]
+    snapshot["text_layer"] = text_layer and scores[invoice_page] >= INVOICE_PAGE_THRESHOLD
+    snapshot["regions"] = None
+    snapshot["profile"] = None
+    snapshot["template"] = None
+    return True
+
 def extract_invoice_data(pdf_path):
-    # ... (Inicialización de data) ...
-    data = {
-        "File": os.path.basename(pdf_path), 
-        "File_path": pdf_path,
-        "Invoice No": None,
-        "Invoice Date": None, 
-        "S/O#": None,
-        "Incotenn": None, 
-        "Payment Terms": None, 
-        "Ship Date": None, 
-        "Due Date": None,
-        "Method of Shipment": None,
-        "Ship To": None, 
-        "Bill To": None, 
-        "Subtotal": None, 
-        "Total": None,
-        "Product Details": []
+    """
+    Extrae la factura del PDF y la devuelve como un registro Invoice (normalizado
+    y con su hash de identidad ya calculado). El texto usado queda en
+    invoice.source_text para guardarlo junto al PDF y el resumen de cómo se
+    extrajo en invoice.metadata.
+    """
+    OCR_TRACE.clear()
+    inicio = time.perf_counter()
+    snapshot = collect_invoice_text(pdf_path)
+    text_seconds = time.perf_counter() - inicio
+    invoice = extract_fields(snapshot, pdf_path)
+    invoice.source_text = snapshot
+    invoice.metadata = extraction_metadata(snapshot, text_seconds, time.perf_counter() - inicio - text_seconds)
+    return invoice
+
+def extraction_metadata(snapshot, text_seconds, parse_seconds):
+    """
+    Resumen de la extracción: modo de texto (capa de texto, OCR por regiones o de
+    página completa), confianza promedio y DPI máximo de los OCR hechos en este
+    proceso (el OCR por página repartido en otros procesos no reporta confianza).
+    """
+    if snapshot["text_layer"]:
+        mode = "texto"
+    elif snapshot["regions"]:
+        mode = "ocr_regiones"
+    else:
+        mode = "ocr_pagina"
+    confianzas = [conf for conf, _ in OCR_TRACE if conf is not None]
+    dpis = [dpi for _, dpi in OCR_TRACE if dpi]
+    return {
+        "template": snapshot.get("template"),
+        "text_mode": mode,
+        "ocr_calls": len(OCR_TRACE),
+        "ocr_confidence": round(sum(confianzas) / len(confianzas), 2) if confianzas else None,
+        "ocr_dpi": max(dpis) if dpis else None,
+        "text_seconds": round(text_seconds, 4),
+        "parse_seconds": round(parse_seconds, 4),
     }
-    # --- Lectura del texto (pdfplumber / OCR) ---
-    # CAMBIO: Recibe el texto completo y la lista de textos por página
-    full_text, pages_text = get_pdf_text_with_ocr_fallback(pdf_path)
-    # ----------------------------------------------------------------------
-    # PASO CLAVE: Identificar la página de la factura
-    # ----------------------------------------------------------------------
-    text_for_address_and_terms = find_invoice_page_text(pages_text)
-    # Normalización del texto completo (para headers, detalles y totales)
-    full_text_norm = re.sub(r"\r", "\n", text_for_address_and_terms)
-    full_text_one = re.sub(r"[\r\n]+", " ", full_text_norm)
+
+def extract_fields(snapshot, pdf_path, allow_full_text=True):
+    """
+    Campos de la factura a partir del snapshot: primero el extractor de la plantilla
+    si la huella coincide, después coordenadas (capa de texto) y la cascada genérica
+    para lo que falte. La usan extract_invoice_data y el backfill.
+    """
+    fields = template_fields(snapshot)
+    layout = None
+    if snapshot["text_layer"] and snapshot["invoice_page"] is not None and not (fields and fields["terms"] and fields["product"]):
+        # La plantilla ya leyó términos y producto: no hace falta extract_words
+        layout = extract_layout_fields(pdf_path, snapshot["invoice_page"])
+    return parse_invoice_text(snapshot, pdf_path, layout, allow_full_text, fields)
+
+def parse_invoice_text(snapshot, pdf_path, layout=None, allow_full_text=True, fields=None):
+    """
+    Etapa de parseo: arma el Invoice a partir del texto de collect_invoice_text.
+    No hace OCR salvo que haga falta el texto completo del PDF (S/O# o railcar
+    fuera de la página de la factura, ver snapshot_full_text); con
+    allow_full_text=False se usa el texto guardado de todas las páginas (o el
+    completo de snapshots anteriores) o, si no hay, solo la página de la factura.
+    layout es la salida de extract_layout_fields para páginas con capa de texto y
+    fields la del extractor de la plantilla (template_fields); cada bloque que
+    ninguno de los dos resolvió pasa por el extractor genérico.
+    """
+    layout = layout or {"terms": None, "product": None}
+    fields = fields or {}
+    invoice_page_index = snapshot["invoice_page"]
+    text_for_address_and_terms = snapshot["page_text"]
+    sections = sections_from_regions(snapshot["regions"]) if snapshot["regions"] else None
+
+    def get_full_text():
+        return snapshot_full_text(snapshot, pdf_path, allow_full_text) or text_for_address_and_terms
+
+    if sections is None:
+        # Normalización del texto completo (para headers, detalles y totales)
+        full_text_norm = re.sub(r"\r", "\n", text_for_address_and_terms)
+        full_text_one = re.sub(r"[\r\n]+", " ", full_text_norm)
+        sections = dict.fromkeys(LAYOUT_SECTIONS, full_text_one)
     # ----------------------------------------------------------------------
     # ---------- 1. HEADER (Invoice No, Invoice Date, S/O#) ----------
     # ----------------------------------------------------------------------
-    # print(full_text_one)
-    headers = extract_headers(full_text_one) 
-    soNo = extract_so_no(full_text)
-    
-    data["Invoice No"] = headers.get("Invoice No")
-    data["Invoice Date"] = headers.get("Invoice Date")
-    data["S/O#"] = soNo.get("S/O NO")
+    headers = fields.get("headers") or extract_headers(sections["header"])
+    soNo = fields.get("so_no") or extract_so_no(text_for_address_and_terms)
+    if not soNo.get("S/O NO"):
+        soNo = extract_so_no(get_full_text())
 
     # ----------------------------------------------------------------------
     # ---------- 2. EXTRAER Ship To / Bill To USANDO EL TEXTO DE LA PÁGINA DE LA FACTURA ----------
     # ----------------------------------------------------------------------
-    addresses = extract_shipto_billto(full_text_one)
-    data["Ship To"] = addresses.get("Ship To")
-    data["Bill To"] = addresses.get("Bill To")
+    addresses = fields.get("addresses") or extract_shipto_billto(sections["addresses"])
 
     # ----------------------------------------------------------------------
     # ---------- 3. EXTRAER INCOTERM, PAYMENT TERMS, FECHAS, METHOD USANDO EL TEXTO DE LA PÁGINA DE LA FACTURA ----------
     # ----------------------------------------------------------------------
-    results = extract_shipping_terms(full_text_one)
-    data["Incotenn"] = results.get("Incoterm")
-    data["Payment Terms"] = results.get("Payment Terms")
-    data["Ship Date"] = results.get("Ship Date").replace(" ", "") if results.get("Ship Date") else None
-    data["Due Date"] = results.get("Due Date").replace(" ", "") if results.get("Due Date") else None
-    data["Method of Shipment"] = results.get("Method of Shipment")
+    results = fields.get("terms") or layout["terms"] or extract_shipping_terms(sections["terms"])
 
     # ----------------------------------------------------------------------
     # ---------- 4. DETALLES DE PRODUCTO (Utiliza full_text) ----------
     # ----------------------------------------------------------------------
-    products = extract_product_detail(full_text_one)
-    railcar = extract_raildcar_v1(full_text)
+    products = fields.get("product") or layout["product"] or extract_product_detail(sections["products"])
+    railcar = (fields.get("transport") or extract_raildcar_v1(text_for_address_and_terms)
+               or extract_raildcar_v1(get_full_text()))
     products["Transport No."] = railcar
-    data['Product Details'] = [products]
     # ----------------------------------------------------------------------
     # ---------- 5. SUBTOTAL / TOTAL (Utiliza full_text) ----------
     # ----------------------------------------------------------------------
-    totals = extract_totals(full_text_one)
-    data["Subtotal"] = totals.get("Subtotal")
-    data["Total"] = totals.get("Total")
-
-    # Resultado final (ordenado)
-    output_keys = [
-        "File", "File_path", "Invoice No", "Invoice Date", "S/O#", "Incotenn",
-        "Payment Terms", "Ship Date", "Due Date", "Method of Shipment",
-        "Ship To", "Bill To", "Subtotal", "Total"
-    ]
-    output = {k: data.get(k) for k in output_keys}
-    output["Product Details"] = data["Product Details"] if data["Product Details"] else []
-
-    return output
\ No newline at end of file
+    totals = fields.get("totals") or extract_totals(sections["totals"])
+
+    return Invoice(
+        file=os.path.basename(pdf_path),
+        file_path=pdf_path,
+        invoice_no=headers.get("Invoice No"),
+        invoice_date=headers.get("Invoice Date"),
+        so_no=soNo.get("S/O NO"),
+        incoterm=results.get("Incoterm"),
+        payment_terms=results.get("Payment Terms"),
+        ship_date=results.get("Ship Date").replace(" ", "") if results.get("Ship Date") else None,
+        due_date=results.get("Due Date").replace(" ", "") if results.get("Due Date") else None,
+        method_of_shipment=results.get("Method of Shipment"),
+        ship_to=addresses.get("Ship To"),
+        bill_to=addresses.get("Bill To"),
+        subtotal=totals.get("Subtotal"),
+        total=totals.get("Total"),
+        invoice_page=invoice_page_index,
+        products=[ProductLine.from_fields(products)],
+    )
\ No newline at end of file
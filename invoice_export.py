@@ -0,0 +1,173 @@
+import os
+import csv
+import gzip
+import uuid
+import datetime
+from mysql_connector import invoice_columns
+
+try:
+    import pyarrow as pa  # opcional: sin pyarrow se exporta CSV comprimido
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# --------------------------- EXPORTACIÓN COLUMNAR ------------------------------------
+# Además del INSERT en 'invoices', cada corrida agrega sus facturas a archivos
+# columnares para análisis histórico sin consultar la base OLTP:
+#
+#   <export_folder>/invoices/fecha=AAAA-MM-DD/<corrida>-<n>.parquet   una fila por factura
+#   <export_folder>/products/fecha=.../...                           una fila por línea de producto
+#   <export_folder>/extraction/fecha=.../...                         plantilla, carril, OCR, tiempos
+#
+# Las carpetas fecha=... son particiones estilo Hive (pyarrow, Spark, DuckDB las leen
+# como columna). Cada corrida escribe archivos nuevos, nunca reescribe los anteriores.
+# Sin pyarrow se escribe el mismo contenido como .csv.gz. Las tablas se unen por Identity
+# (el hash de duplicados del registro Invoice).
+
+EXPORT_BATCH_ROWS = 5000  # facturas en memoria antes de escribir un archivo por tabla
+
+# Columnas de cada tabla con su tipo ("str", "float", "int"); el esquema fijo evita que
+# un lote con una columna toda en None quede con otro tipo que el resto
+INVOICE_EXPORT_COLUMNS = [
+    ("Identity", "str"), ("RunId", "str"), ("ExtractedAt", "str"), ("File", "str"),
+    ("Num", "str"), ("IssueDate", "str"), ("S0Num", "str"), ("lncotenn", "str"),
+    ("PaymentTerms", "str"), ("ShipDate", "str"), ("DueDate", "str"), ("MethodOfShipment", "str"),
+    ("ShipTo", "str"), ("BillTo", "str"), ("Subtotal", "float"), ("Total", "float"),
+    ("InvoicePage", "int"), ("needs_review", "int"), ("OriginalPDFPath", "str"), ("AttachmentsPDFPath", "str"),
+]
+PRODUCT_EXPORT_COLUMNS = [
+    ("Identity", "str"), ("RunId", "str"), ("Line", "int"), ("ProductNo", "str"), ("ItemQty", "float"),
+    ("UM", "str"), ("Description", "str"), ("TransportNo", "str"), ("PriceEach", "float"), ("Amount", "float"),
+]
+EXTRACTION_EXPORT_COLUMNS = [
+    ("Identity", "str"), ("RunId", "str"), ("Template", "str"), ("Lane", "str"), ("TextMode", "str"),
+    ("OcrCalls", "int"), ("OcrConfidence", "float"), ("OcrDpi", "int"),
+    ("TextSeconds", "float"), ("ParseSeconds", "float"),
+]
+EXPORT_TABLES = {
+    "invoices": INVOICE_EXPORT_COLUMNS,
+    "products": PRODUCT_EXPORT_COLUMNS,
+    "extraction": EXTRACTION_EXPORT_COLUMNS,
+}
+
+def export_rows(invoice, run_id, extracted_at):
+    """Filas de las tres tablas para un registro Invoice: {tabla: [fila, ...]}."""
+    columns = invoice_columns(invoice)
+    cabecera = {name: columns.get(name) for name, _ in INVOICE_EXPORT_COLUMNS if name in columns}
+    cabecera.update({
+        "Identity": invoice.identity, "RunId": run_id, "ExtractedAt": extracted_at,
+        "File": invoice.file, "InvoicePage": invoice.invoice_page,
+    })
+    productos = [{
+        "Identity": invoice.identity, "RunId": run_id, "Line": i + 1,
+        "ProductNo": p.product_no, "ItemQty": p.item_qty, "UM": p.um, "Description": p.description,
+        "TransportNo": p.transport_no, "PriceEach": p.price_each, "Amount": p.amount,
+    } for i, p in enumerate(invoice.products)]
+    meta = invoice.metadata or {}
+    extraccion = {
+        "Identity": invoice.identity, "RunId": run_id, "Template": meta.get("template"),
+        "Lane": meta.get("lane"), "TextMode": meta.get("text_mode"), "OcrCalls": meta.get("ocr_calls"),
+        "OcrConfidence": meta.get("ocr_confidence"), "OcrDpi": meta.get("ocr_dpi"),
+        "TextSeconds": meta.get("text_seconds"), "ParseSeconds": meta.get("parse_seconds"),
+    }
+    return {"invoices": [cabecera], "products": productos, "extraction": [extraccion]}
+
+def _typed(value, kind):
+    if value is None or value == "":
+        return None
+    try:
+        if kind == "float":
+            return float(value)
+        if kind == "int":
+            return int(value)
+    except (TypeError, ValueError):
+        return None
+    return str(value)
+
+class InvoiceExport:
+    """
+    Sink de exportación de una corrida: add(invoice) acumula filas y cada
+    EXPORT_BATCH_ROWS facturas (y al cerrar) escribe un archivo por tabla en la
+    partición del día. Se usa como context manager o llamando a close().
+    """
+
+    def __init__(self, folder, fmt="parquet", batch_rows=EXPORT_BATCH_ROWS):
+        if fmt == "parquet" and pa is None:
+            print("⚠️ pyarrow no está instalado: la exportación se escribe como CSV comprimido (.csv.gz).")
+            fmt = "csv"
+        self.folder = folder
+        self.fmt = fmt
+        self.batch_rows = batch_rows
+        self.run_id = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+        self.rows = {table: [] for table in EXPORT_TABLES}
+        self.pending = 0
+        self.parts = 0
+        self.exported = 0
+        self.files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, invoice):
+        extracted_at = datetime.datetime.now().isoformat(timespec="seconds")
+        for table, rows in export_rows(invoice, self.run_id, extracted_at).items():
+            self.rows[table].extend(rows)
+        self.pending += 1
+        if self.pending >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        partition = f"fecha={datetime.date.today().isoformat()}"
+        for table, columns in EXPORT_TABLES.items():
+            rows = [{name: _typed(row.get(name), kind) for name, kind in columns} for row in self.rows[table]]
+            if not rows:
+                continue
+            carpeta = os.path.join(self.folder, table, partition)
+            os.makedirs(carpeta, exist_ok=True)
+            base = os.path.join(carpeta, f"{self.run_id}-{self.parts}")
+            if self.fmt == "parquet":
+                path = self._write_parquet(base, columns, rows)
+            else:
+                path = self._write_csv(base, columns, rows)
+            self.files.append(path)
+        self.exported += self.pending
+        self.parts += 1
+        self.pending = 0
+        self.rows = {table: [] for table in EXPORT_TABLES}
+
+    def _write_parquet(self, base, columns, rows):
+        tipos = {"str": pa.string(), "float": pa.float64(), "int": pa.int64()}
+        schema = pa.schema([(name, tipos[kind]) for name, kind in columns])
+        path = base + ".parquet"
+        # Se escribe a un temporal y se renombra: un lector nunca ve un archivo a medias
+        pq.write_table(pa.Table.from_pylist(rows, schema=schema), path + ".tmp", compression="zstd")
+        os.replace(path + ".tmp", path)
+        return path
+
+    def _write_csv(self, base, columns, rows):
+        path = base + ".csv.gz"
+        with gzip.open(path + ".tmp", "wt", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=[name for name, _ in columns])
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(path + ".tmp", path)
+        return path
+
+    def close(self):
+        self.flush()
+        if self.exported:
+            print(f"🗃️ Exportación columnar ({self.fmt}): {self.exported} factura(s) en "
+                  f"{len(self.files)} archivo(s) bajo {self.folder} (corrida {self.run_id})")
+
+def open_export(cfg):
+    """InvoiceExport según la configuración, o None si export_folder no está definido."""
+    if not cfg.get("export_folder"):
+        return None
+    return InvoiceExport(cfg["export_folder"], cfg.get("export_format", "parquet"),
+                         cfg.get("export_batch_rows") or EXPORT_BATCH_ROWS)
@@ -0,0 +1,132 @@
+import json
+import hashlib
+from dataclasses import dataclass, field
+from typing import Optional
+
+# --------------------------- REGISTRO DE FACTURA ------------------------------------
+# Registro compacto (slots) que produce extract_invoice_data. La normalización de
+# textos se aplica una sola vez al construirlo y la identidad (hash de duplicados)
+# queda precalculada. to_dict() devuelve el diccionario con las etiquetas de
+# siempre ('Invoice No', 'S/O#', ...) para la plantilla HTML y los reportes.
+
+def normalize_text(value):
+    """Quita espacios de los extremos y colapsa espacios/saltos de línea internos."""
+    if isinstance(value, str):
+        # Equivale a re.sub(r"\s+", " ", value.strip()) sin pasar por el motor de regex
+        return " ".join(value.split())
+    return value
+
+# Atributo -> etiqueta original del diccionario
+PRODUCT_LABELS = {
+    "product_no": "Product No.",
+    "item_qty": "Item Qty",
+    "um": "U/M",
+    "description": "Description",
+    "transport_no": "Transport No.",
+    "price_each": "Price Each",
+    "amount": "Amount",
+}
+
+INVOICE_LABELS = {
+    "file": "File",
+    "file_path": "File_path",
+    "invoice_no": "Invoice No",
+    "invoice_date": "Invoice Date",
+    "so_no": "S/O#",
+    "incoterm": "Incotenn",
+    "payment_terms": "Payment Terms",
+    "ship_date": "Ship Date",
+    "due_date": "Due Date",
+    "method_of_shipment": "Method of Shipment",
+    "ship_to": "Ship To",
+    "bill_to": "Bill To",
+    "subtotal": "Subtotal",
+    "total": "Total",
+    "invoice_page": "Invoice Page",
+    "origin_path": "originPath",
+    "attachment_path": "attachmentPath",
+    "needs_review": "needs_review",
+}
+
+# Las rutas se guardan tal cual; el resto de los campos se normaliza al construir
+NORMALIZED_ATTRS = tuple(
+    attr for attr in INVOICE_LABELS if attr not in ("file", "file_path", "origin_path", "attachment_path")
+)
+
+# Campos que identifican a una factura para detectar duplicados entre corridas
+IDENTITY_FIELDS = (
+    "invoice_no", "invoice_date", "so_no", "incoterm", "payment_terms",
+    "ship_date", "due_date", "method_of_shipment", "subtotal", "total",
+)
+
+@dataclass(slots=True)
+class ProductLine:
+    product_no: Optional[str] = None
+    item_qty: Optional[float] = None
+    um: Optional[str] = None
+    description: Optional[str] = None
+    transport_no: Optional[str] = None
+    price_each: Optional[float] = None
+    amount: Optional[float] = None
+
+    def __post_init__(self):
+        for attr in PRODUCT_LABELS:
+            setattr(self, attr, normalize_text(getattr(self, attr)))
+
+    @classmethod
+    def from_fields(cls, values):
+        """Construye la línea desde el diccionario de los extractores ('Product No.', ...)."""
+        return cls(**{attr: values.get(label) for attr, label in PRODUCT_LABELS.items()})
+
+    def to_dict(self):
+        return {label: getattr(self, attr) for attr, label in PRODUCT_LABELS.items()}
+
+@dataclass(slots=True)
+class Invoice:
+    file: str
+    file_path: str
+    invoice_no: Optional[str] = None
+    invoice_date: Optional[str] = None
+    so_no: Optional[str] = None
+    incoterm: Optional[str] = None
+    payment_terms: Optional[str] = None
+    ship_date: Optional[str] = None
+    due_date: Optional[str] = None
+    method_of_shipment: Optional[str] = None
+    ship_to: Optional[str] = None
+    bill_to: Optional[str] = None
+    subtotal: Optional[float] = None
+    total: Optional[float] = None
+    invoice_page: Optional[int] = None
+    products: list = field(default_factory=list)
+    origin_path: Optional[str] = None
+    attachment_path: Optional[str] = None
+    needs_review: int = 0
+    identity: str = field(init=False, repr=False, compare=False)
+    # Texto que consumieron los extractores (collect_invoice_text); se guarda junto al PDF
+    source_text: Optional[dict] = field(default=None, repr=False, compare=False)
+    # Cómo se extrajo (plantilla, carril, OCR, confianza, tiempos) para la exportación
+    metadata: dict = field(default_factory=dict, repr=False, compare=False)
+
+    def __post_init__(self):
+        for attr in NORMALIZED_ATTRS:
+            setattr(self, attr, normalize_text(getattr(self, attr)))
+        self.identity = self._identity_hash()
+
+    def _identity_hash(self):
+        # Mismo JSON que se usaba antes para el hash, así processed_pdfs.json sigue siendo válido
+        clave_unica = json.dumps(
+            {INVOICE_LABELS[attr]: getattr(self, attr) for attr in IDENTITY_FIELDS},
+            sort_keys=True
+        )
+        return hashlib.sha256(clave_unica.encode()).hexdigest()
+
+    @property
+    def product(self):
+        """Primera línea de producto (las facturas traen una sola)."""
+        return self.products[0] if self.products else ProductLine()
+
+    def to_dict(self):
+        data = {label: getattr(self, attr) for attr, label in INVOICE_LABELS.items()}
+        data["Product Details"] = [p.to_dict() for p in self.products]
+        return data
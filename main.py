@@ -2,8 +2,14 @@ import pytesseract
 import imaplib
 from pathlib import Path
 from email_library import load_config, process_mailbox
-from mysql_connector import get_db_connection, insert_invoice_with_connection
+from attachment_store import AttachmentStore, default_store_root
+from imap_filter import report_download_share
+from mysql_connector import get_db_connection, insert_and_commit
+from invoice_export import open_export
 from pdf_library import read_pdfs_files
+from work_queue import run_queue_node
+from async_pipeline import run_async_pipeline
+from scheduler import adaptive_settings
 pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
 
 def main():
@@ -21,6 +27,12 @@ def main():
         print("ERROR: la contraseña viene vacía. Puedes setearla en config.json o en la variable de entorno PASSWORD.")
         return
 
+    if cfg.get("async_pipeline") and not cfg.get("work_queue"):
+        print("Pipeline asíncrono: descarga, extracción e inserción en paralelo...")
+        run_async_pipeline(cfg)
+        print("\n✅ Proceso finalizado correctamente.")
+        return
+
     print("Conectando al servidor IMAP...")
     try:
         imap = imaplib.IMAP4_SSL(cfg["imap_host"], cfg["imap_port"])
@@ -33,7 +45,7 @@ def main():
     print("Procesando correos...")
     print("#######################################################################################################")
     try:
-        process_mailbox(imap, cfg)
+        mail_stats = process_mailbox(imap, cfg)
     finally:
         try:
             imap.close()
@@ -48,39 +60,60 @@ def main():
 
     folder_path = cfg["download_folder"]
     print(f"Iniciando procesamiento de PDFs en: {folder_path}")
-    
-    # 1. Obtener la lista de objetos a insertar
-    invoices_to_insert = read_pdfs_files(folder_path)
-    
-    if not invoices_to_insert:
-        print("No se encontraron nuevas facturas para insertar.")
-        print("\n✅ Proceso finalizado correctamente.")
-        return
 
     print("#######################################################################################################")
     print("Conectando con la db...")
     print("#######################################################################################################")
-    # 2. Establecer la conexión a la base de datos
+    # 1. Establecer la conexión a la base de datos antes de extraer, para insertar
+    #    cada factura en cuanto sale de su carril (texto u OCR).
     try:
         conn = get_db_connection()
     except Exception as e:
         print(f"❌ ERROR: No se pudo conectar a la base de datos. {e}")
         return
 
-    # 3. Iterar e Insertar
-    print(f"\nIniciando inserción de {len(invoices_to_insert)} factura(s)...")
-    with conn: # Usa 'with' para asegurar que la conexión se cierre
-        for invoice in invoices_to_insert:
-            result = insert_invoice_with_connection(conn, invoice)
-            
-            if result['status'] == 'ok':
-                # Si la inserción fue exitosa, confirma los cambios.
-                conn.commit()
-            elif result['status'] == 'error':
-                # Opcional: Si ocurre un error, puedes hacer rollback para deshacer cualquier cambio pendiente.
-                conn.rollback()
-                print(f"Proceso detenido o en revisión por error en factura {result['num']}.")
+    # Las facturas insertadas también se agregan a la exportación columnar (si está configurada)
+    export = open_export(cfg)
+
+    # Devuelve False si el INSERT falló: el PDF queda pendiente para reintentar
+    def insert_invoice(invoice):
+        result = insert_and_commit(conn, invoice)
+        if export is not None and result["status"] == "ok":
+            export.add(invoice)
+        return result["status"] != "error"
+
+    # 2. Extraer e insertar a medida que cada factura queda lista
+    try:
+        with conn: # Usa 'with' para asegurar que la conexión se cierre
+            if cfg.get("work_queue"):
+                # Cola compartida: este equipo encola lo descargado y trabaja como un nodo más
+                invoices_processed = run_queue_node(cfg, on_invoice=insert_invoice)
+            else:
+                invoices_processed = read_pdfs_files(
+                    folder_path,
+                    on_invoice=insert_invoice,
+                    fast_workers=cfg.get("fast_lane_workers"),
+                    ocr_workers=cfg.get("ocr_lane_workers"),
+                    ocr_page_workers=cfg.get("ocr_page_workers"),
+                    doc_timeout=cfg.get("doc_timeout_seconds"),
+                    doc_memory_mb=cfg.get("doc_memory_mb"),
+                    storage_folder=cfg.get("storage_folder"),
+                    adaptive=adaptive_settings(cfg),
+                )
+    finally:
+        # Lo que ya quedó en la base también queda exportado aunque la corrida se interrumpa
+        if export is not None:
+            export.close()
+
+    if not invoices_processed:
+        print("No se encontraron nuevas facturas para insertar.")
+
+    # Qué parte de lo descargado del correo terminó como factura
+    with AttachmentStore(default_store_root(folder_path, cfg.get("storage_folder"))) as store:
+        report_download_share(mail_stats, store)
                 
     print("\n✅ Proceso finalizado correctamente.")
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    # Necesario para los pools de procesos (Windows arranca los workers con 'spawn')
+    main()
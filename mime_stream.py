@@ -0,0 +1,218 @@
+import os
+import binascii
+import hashlib
+import tempfile
+from email import policy
+from email.parser import BytesHeaderParser
+from commons import decode_mime_words
+
+# --------------------------- PARSEO MIME EN STREAMING --------------------------------
+# email.message_from_bytes (y el FeedParser de la librería estándar) guardan el mensaje
+# completo y cada adjunto en memoria; get_payload(decode=True) agrega otra copia ya
+# decodificada. Este parser recibe el correo por pedazos (feed), separa las partes por
+# sus delimitadores y decodifica el base64 de las partes PDF directo a
+# un archivo temporal en la carpeta de descargas, calculando su SHA-256 al vuelo.
+# La memoria por mensaje queda acotada al pedazo recibido más una línea.
+
+MAX_HEADER_BYTES = 256 * 1024  # encabezados de una parte más grandes se truncan
+MAX_LINE_BYTES = 64 * 1024  # líneas de cuerpo sin salto se vuelcan por pedazos
+
+def _split_eol(line):
+    if line.endswith(b"\r\n"):
+        return line[:-2], b"\r\n"
+    if line.endswith(b"\n"):
+        return line[:-1], b"\n"
+    return line, b""
+
+class PartSink:
+    """Cuerpo de una parte aceptada: decodifica incrementalmente hacia un archivo temporal."""
+
+    def __init__(self, folder, filename, content_type, encoding):
+        fd, self.tmp_path = tempfile.mkstemp(prefix=".incoming_", suffix=".part", dir=folder)
+        self.file = os.fdopen(fd, "wb")
+        self.filename = filename
+        self.content_type = content_type
+        self.encoding = encoding
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self._b64_rest = b""
+        self._pending_eol = b""
+
+    def _write(self, data):
+        if data:
+            self.file.write(data)
+            self.sha256.update(data)
+            self.size += len(data)
+
+    def write(self, line):
+        if self.encoding == "base64":
+            # Se decodifica de 4 en 4 caracteres; el resto espera a la siguiente línea
+            data = self._b64_rest + b"".join(line.split())
+            usable = len(data) - len(data) % 4
+            self._b64_rest = data[usable:]
+            self._write(binascii.a2b_base64(data[:usable]))
+        elif self.encoding == "quoted-printable":
+            # Igual que 7bit: el último salto espera por si es el del delimitador;
+            # tras un salto suave ("=" al final) no queda salto pendiente
+            body, eol = _split_eol(line)
+            self._write(self._pending_eol + binascii.a2b_qp(body))
+            self._pending_eol = b"" if body.endswith(b"=") else eol
+        else:
+            # 7bit/8bit/binary: el último salto de línea pertenece al delimitador
+            body, eol = _split_eol(line)
+            self._write(self._pending_eol + body)
+            self._pending_eol = eol
+
+    def close(self):
+        if self._b64_rest:
+            self._write(binascii.a2b_base64(self._b64_rest + b"=" * (-len(self._b64_rest) % 4)))
+        self.file.close()
+        return {
+            "filename": self.filename,
+            "content_type": self.content_type,
+            "tmp_path": self.tmp_path,
+            "sha256": self.sha256.hexdigest(),
+            "size": self.size,
+        }
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+class StreamingMimeParser:
+    """
+    Parser MIME incremental. accept_part(filename, content_type) decide qué partes
+    se guardan; el resto del cuerpo se descarta sin acumularse.
+
+    Uso:
+        parser = StreamingMimeParser(carpeta, accept_part)
+        for chunk in ...: parser.feed(chunk)
+        parser.close()
+        parser.headers  -> encabezados del mensaje (email.message.EmailMessage)
+        parser.saved    -> [{"filename", "content_type", "tmp_path", "sha256", "size"}]
+    """
+
+    def __init__(self, download_folder, accept_part):
+        self.download_folder = download_folder
+        self.accept_part = accept_part
+        self.headers = None
+        self.saved = []
+        self._buffer = b""
+        self._boundaries = []
+        self._in_headers = True
+        self._header_lines = []
+        self._header_size = 0
+        self._sink = None
+
+    def feed(self, data):
+        buf = self._buffer + data if self._buffer else data
+        start = 0
+        while start < len(buf):
+            if self._in_headers or buf.startswith(b"--", start):
+                # Encabezados y posibles delimitadores se procesan línea a línea
+                nl = buf.find(b"\n", start)
+                if nl < 0:
+                    break
+                self._line(buf[start:nl + 1])
+                start = nl + 1
+                continue
+            # Cuerpo: todo hasta la siguiente línea que empiece con "--" va de una vez
+            cut = buf.find(b"\n--", start)
+            if cut < 0:
+                last_nl = buf.rfind(b"\n", start)
+                if last_nl >= 0:
+                    self._body(buf[start:last_nl + 1])
+                    start = last_nl + 1
+                break
+            self._body(buf[start:cut + 1])
+            start = cut + 1
+        rest = buf[start:]
+        if len(rest) > MAX_LINE_BYTES and not self._in_headers:
+            self._body(rest)
+            rest = b""
+        self._buffer = rest
+
+    def close(self):
+        if self._buffer:
+            self._line(self._buffer)
+            self._buffer = b""
+        if self._in_headers and self._header_lines:
+            self._end_headers()
+        if self._sink is not None:
+            if self._boundaries:
+                # El mensaje terminó sin el delimitador final: la parte está incompleta
+                print(f"  ⚠️ Adjunto '{self._sink.filename}' incompleto (mensaje truncado), se descarta.")
+                self._sink.discard()
+                self._sink = None
+            else:
+                self._close_part()
+
+    def abort(self):
+        """Borra los temporales (parte en curso y partes ya guardadas)."""
+        if self._sink is not None:
+            self._sink.discard()
+            self._sink = None
+        for part in self.saved:
+            if os.path.exists(part["tmp_path"]):
+                os.remove(part["tmp_path"])
+        self.saved = []
+
+    def _line(self, line):
+        if self._in_headers:
+            if self._header_size < MAX_HEADER_BYTES:
+                self._header_lines.append(line)
+                self._header_size += len(line)
+            if line in (b"\r\n", b"\n"):
+                self._end_headers()
+            return
+
+        if self._boundaries and line.startswith(b"--"):
+            marker = line.rstrip()
+            for depth in range(len(self._boundaries) - 1, -1, -1):
+                boundary = self._boundaries[depth]
+                if marker == b"--" + boundary:
+                    # Empieza una parte nueva de este multipart
+                    self._close_part()
+                    del self._boundaries[depth + 1:]
+                    self._in_headers = True
+                    return
+                if marker == b"--" + boundary + b"--":
+                    # Fin del multipart: lo que sigue (epílogo) se descarta
+                    self._close_part()
+                    del self._boundaries[depth:]
+                    return
+
+        self._body(line)
+
+    def _body(self, data):
+        if self._sink is not None:
+            self._sink.write(data)
+
+    def _end_headers(self):
+        part = BytesHeaderParser(policy=policy.default).parsebytes(b"".join(self._header_lines))
+        self._header_lines = []
+        self._header_size = 0
+        self._in_headers = False
+        if self.headers is None:
+            self.headers = part
+
+        if part.get_content_maintype() == "multipart":
+            boundary = part.get_boundary()
+            if boundary:
+                self._boundaries.append(boundary.encode("ascii", "replace"))
+            return
+        if part.get_content_type() == "message/rfc822":
+            # Correo reenviado como adjunto: su cuerpo empieza con otros encabezados
+            self._in_headers = True
+            return
+
+        filename = decode_mime_words(part.get_filename() or "")
+        if filename and self.accept_part(filename, part.get_content_type()):
+            encoding = str(part.get("Content-Transfer-Encoding", "7bit")).strip().lower()
+            self._sink = PartSink(self.download_folder, filename, part.get_content_type(), encoding)
+
+    def _close_part(self):
+        if self._sink is not None:
+            self.saved.append(self._sink.close())
+            self._sink = None
@@ -2,6 +2,7 @@ import mysql.connector
 from mysql.connector import Error
 
 from commons import format_date_to_sql
+from invoice_record import Invoice
 
 # --- CONFIGURACIÓN DE LA BASE DE DATOS (al servidor 99) ---
 DB_CONFIG = {
@@ -11,10 +12,41 @@ DB_CONFIG = {
     'password': 'Kr3st0n', #Kr3st0n <--- contraseña mysql server 99
 }
 # --------------------------------------------------------
-def insert_invoice_with_connection(conn, invoice_data: dict):
+def invoice_columns(invoice: Invoice):
     """
-    Inserta los datos de una factura en la base de datos 'invoices'
-    usando una conexión MySQL abierta.
+    Valores de la fila de 'invoices' para un registro Invoice, en el orden de las
+    columnas de la tabla. Lo usan el INSERT y el backfill (diff/UPDATE).
+    """
+    product_item = invoice.product
+    return {
+        "Num": invoice.invoice_no,
+        "IssueDate": format_date_to_sql(invoice.invoice_date),
+        "S0Num": invoice.so_no,
+        "lncotenn": invoice.incoterm,
+        "PaymentTerms": invoice.payment_terms,
+        "ShipDate": format_date_to_sql(invoice.ship_date),
+        "DueDate": format_date_to_sql(invoice.due_date),
+        "MethodOfShipment": invoice.method_of_shipment,
+        "ShipTo": invoice.ship_to,
+        "BillTo": invoice.bill_to,
+        "ProductNo": product_item.product_no,
+        "Description": product_item.description,
+        "Amount": product_item.amount,
+        "UM": product_item.um,
+        "Notes": product_item.transport_no,  # Transport No.
+        "ItemQty": product_item.item_qty,
+        "PriceOriginal": product_item.price_each,
+        "Subtotal": invoice.subtotal,
+        "Total": invoice.total,
+        "OriginalPDFPath": invoice.origin_path,
+        "AttachmentsPDFPath": invoice.attachment_path,
+        "needs_review": invoice.needs_review,
+    }
+
+def insert_invoice_with_connection(conn, invoice: Invoice):
+    """
+    Inserta los datos de una factura (registro Invoice) en la base de datos
+    'invoices' usando una conexión MySQL abierta.
     """
 
     # def safe_str(value):
@@ -23,9 +55,9 @@ def insert_invoice_with_connection(conn, invoice_data: dict):
     try:
         cursor = conn.cursor()
 
-        invoice_num = invoice_data.get('Invoice No')
-        invoice_date = format_date_to_sql(invoice_data.get('Invoice Date'))
-        total = invoice_data.get('Total') 
+        invoice_num = invoice.invoice_no
+        invoice_date = format_date_to_sql(invoice.invoice_date)
+        total = invoice.total
 
         # --- 1. VALIDAR DUPLICADO ---
         check_duplicate_sql = """
@@ -44,49 +76,13 @@ def insert_invoice_with_connection(conn, invoice_data: dict):
             cursor.close()
             return {"status": "duplicate", "num": invoice_num}
 
-        # --- 2. EXTRAER DETALLES DE PRODUCTO ---
-        product_item = invoice_data.get('Product Details', [{}])[0]
-
-        invoice_header_sql = """
-        INSERT INTO invoices (
-            Num, IssueDate, S0Num, lncotenn, PaymentTerms, 
-            ShipDate, DueDate, MethodOfShipment, ShipTo, BillTo, 
-            ProductNo, Description, Amount, UM, Notes, 
-            ItemQty, PriceOriginal, Subtotal, Total, OriginalPDFPath, 
-            AttachmentsPDFPath, needs_review
-        ) VALUES (
-            %s, %s, %s, %s, %s,
-            %s, %s, %s, %s, %s,
-            %s, %s, %s, %s, %s, 
-            %s, %s, %s, %s, %s, 
-            %s, %s
-        )
+        # --- 2. INSERTAR ---
+        columns = invoice_columns(invoice)
+        invoice_header_sql = f"""
+        INSERT INTO invoices ({", ".join(columns)})
+        VALUES ({", ".join(["%s"] * len(columns))})
         """
-
-        invoice_values = (
-            invoice_num,
-            invoice_date,
-            invoice_data.get('S/O#'),
-            invoice_data.get('Incotenn'),
-            invoice_data.get('Payment Terms'),
-            format_date_to_sql(invoice_data.get('Ship Date')),
-            format_date_to_sql(invoice_data.get('Due Date')),
-            invoice_data.get('Method of Shipment'),
-            invoice_data.get('Ship To'),
-            invoice_data.get('Bill To'),
-            product_item.get("Product No."),
-            product_item.get("Description"),
-            product_item.get("Amount"),
-            product_item.get("U/M"),
-            product_item.get("Transport No."),  # mapped to Notes
-            product_item.get("Item Qty"),
-            product_item.get("Price Each"),
-            invoice_data.get('Subtotal'),
-            total,
-            invoice_data.get('originPath'),
-            invoice_data.get('attachmentPath'),
-            invoice_data.get('needs_review')
-        )
+        invoice_values = tuple(columns.values())
 
         cursor.execute(invoice_header_sql, invoice_values)
         invoice_id = cursor.lastrowid
@@ -95,12 +91,82 @@ def insert_invoice_with_connection(conn, invoice_data: dict):
         return {"status": "ok", "invoice_id": invoice_id, "num": invoice_num}
 
     except Exception as e:
-        print(f"❌ Error al insertar factura {invoice_data.get('Invoice No')}: {e}")
-        return {"status": "error", "num": invoice_data.get('Invoice No'), "error": str(e)}
+        print(f"❌ Error al insertar factura {invoice.invoice_no}: {e}")
+        return {"status": "error", "num": invoice.invoice_no, "error": str(e)}
 
     finally:
         if 'cursor' in locals() and cursor:
             cursor.close()
 
+def insert_and_commit(conn, invoice: Invoice):
+    """
+    Inserta la factura y confirma la transacción; si falla hace rollback para
+    deshacer cualquier cambio pendiente. Devuelve el resultado del INSERT.
+    """
+    result = insert_invoice_with_connection(conn, invoice)
+
+    if result['status'] == 'ok':
+        conn.commit()
+    elif result['status'] == 'error':
+        conn.rollback()
+        print(f"Proceso detenido o en revisión por error en factura {result['num']}.")
+    return result
+
+# Columnas que el backfill puede corregir (las rutas y needs_review no se tocan)
+BACKFILL_COLUMNS = [
+    "Num", "IssueDate", "S0Num", "lncotenn", "PaymentTerms", "ShipDate", "DueDate",
+    "MethodOfShipment", "ShipTo", "BillTo", "ProductNo", "Description", "Amount", "UM",
+    "Notes", "ItemQty", "PriceOriginal", "Subtotal", "Total",
+]
+
+def fetch_invoice_rows(conn, origin_paths, batch_size=500):
+    """
+    Lee de 'invoices' las filas de los PDFs dados, indexadas por OriginalPDFPath.
+    """
+    rows = {}
+    cursor = conn.cursor(dictionary=True)
+    try:
+        for i in range(0, len(origin_paths), batch_size):
+            lote = origin_paths[i:i + batch_size]
+            cursor.execute(
+                f"SELECT {', '.join(BACKFILL_COLUMNS)}, OriginalPDFPath FROM invoices "
+                f"WHERE OriginalPDFPath IN ({', '.join(['%s'] * len(lote))})",
+                tuple(lote)
+            )
+            for row in cursor.fetchall():
+                rows[row["OriginalPDFPath"]] = row
+    finally:
+        cursor.close()
+    return rows
+
+def bulk_update_invoices(conn, updates):
+    """
+    Aplica en una sola transacción una lista de (origin_path, {columna: valor}).
+    Las filas se agrupan por conjunto de columnas para usar executemany.
+
+    Returns:
+        int: filas actualizadas.
+    """
+    grupos = {}
+    for origin_path, cambios in updates:
+        columnas = tuple(sorted(cambios))
+        grupos.setdefault(columnas, []).append(
+            tuple(cambios[c] for c in columnas) + (origin_path,)
+        )
+
+    cursor = conn.cursor()
+    try:
+        for columnas, valores in grupos.items():
+            sql = (f"UPDATE invoices SET {', '.join(f'{c} = %s' for c in columnas)} "
+                   f"WHERE OriginalPDFPath = %s")
+            cursor.executemany(sql, valores)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    return len(updates)
+
 def get_db_connection():
     return mysql.connector.connect(**DB_CONFIG)
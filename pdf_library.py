@@ -8,10 +8,17 @@ import os
 import re
 import shutil
 import json
-import hashlib
-from commons import get_pdf_paths
+import time
+import datetime
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from attachment_store import AttachmentStore, default_store_root, STATE_PENDING, STATE_PROCESSED
+from attachment_store import STATE_DUPLICATE, STATE_QUARANTINE
 from invoice_data import extract_invoice_data
-from invoice_data import find_invoice_page_index, get_pdf_text_with_ocr_fallback
+from invoice_record import Invoice
+from invoice_data import find_invoice_page
+from commons import sanitize_filename, unique_path
+from scheduler import run_two_lanes, default_workers, PoisonDocumentError
 
 # --------------------------- CREAR PDF CON HTML -------------------------------------
 # Obtiene la ruta base del script (ruta de la carpeta actual)
@@ -31,66 +38,80 @@ def link_callback(uri, rel):
     # Devuelve la URI original si no se encuentra
     return uri 
 
+STYLESHEET_LINK = re.compile(r'<link[^>]*rel="stylesheet"[^>]*href="([^"]+)"[^>]*/?>', re.I)
+
+@lru_cache(maxsize=4)
+def load_invoice_template(template_path):
+    """
+    Lee la plantilla HTML una sola vez por proceso: el CSS enlazado se incrusta en
+    un <style> (xhtml2pdf ya no resuelve la hoja con link_callback en cada PDF) y
+    los espacios se colapsan aquí en lugar de sobre cada HTML generado.
+    """
+    with open(template_path, 'r', encoding='utf-8') as f:
+        html = f.read()
+
+    def inline_css(match):
+        href = match.group(1)
+        # Primero junto a la plantilla; si no, como lo resolvía link_callback
+        css_path = os.path.join(os.path.dirname(os.path.abspath(template_path)), href)
+        if not os.path.isfile(css_path):
+            css_path = link_callback(href, None)
+        if not os.path.isfile(css_path):
+            return match.group(0)
+        with open(css_path, 'r', encoding='utf-8') as css_file:
+            return f"<style>{css_file.read()}</style>"
+
+    html = STYLESHEET_LINK.sub(inline_css, html)
+    return Template(re.sub(r'\s+', ' ', html).strip())
+
+def _html_value(value):
+    """Valor para la plantilla, con espacios colapsados como en el HTML final."""
+    return " ".join(str(value).split()) if value is not None else ""
+
+def build_invoice_html(invoice_data, template):
+    """Llena la plantilla (string.Template ya cargada) con el diccionario de la factura."""
+    # Filas de la tabla de productos
+    product_rows = []
+    for item in invoice_data.get('Product Details', []):
+        product_rows.append(
+            f"<tr><td>{_html_value(item.get('Product No.', 'N/D'))}</td>"
+            f"<td>{_html_value(item.get('Description', 'N/D'))}</td>"
+            f"<td class=\"align-right\">{_html_value(item.get('Item Qty', '0'))} {_html_value(item.get('U/M', ''))}</td>"
+            f"<td class=\"align-right\">{_html_value(item.get('Price Each', '0'))}</td>"
+            f"<td class=\"align-right\">{_html_value(item.get('Amount', '0'))}</td></tr>"
+        )
+
+    # Reemplaza espacios por guiones bajos en las claves para string.Template
+    data_final = {k.replace(' ', '_'): _html_value(v) for k, v in invoice_data.items() if k != 'Product Details'}
+
+    # Bill To/Ship To multilínea
+    for key in ('Bill To', 'Ship To'):
+        lineas = str(invoice_data.get(key) or 'N/D').split('\n')
+        data_final[key.replace(' ', '_')] = '<br>'.join(_html_value(linea) for linea in lineas)
+
+    first_product = invoice_data.get('Product Details', [{}])
+    data_final['Product_U/M'] = first_product[0].get('U/M', 'N/D') if first_product and first_product[0] else 'N/D'
+    data_final['Product_Rows'] = "".join(product_rows)
+
+    return template.safe_substitute(data_final)
+
 def crear_pdf_factura_desde_archivo(nombre_archivo_pdf: str, invoice_data: dict, template_path: str) -> bool:
     """
-    Genera un PDF leyendo una plantilla HTML externa ($placeholders) usando string.Template.
+    Genera un PDF a partir de una plantilla HTML externa ($placeholders) usando string.Template.
+    Acepta el diccionario de la factura o directamente un registro Invoice.
     """
+    if isinstance(invoice_data, Invoice):
+        invoice_data = invoice_data.to_dict()
     try:
-        # 1. Leer la plantilla HTML
-        with open(template_path, 'r', encoding='utf-8') as f:
-            template = Template(f.read()) 
-
-        # 2. Generar las filas de la tabla de productos (HTML)
-        product_rows_html = ""
-        for item in invoice_data.get('Product Details', []):
-            qty = item.get('Item Qty', '0').replace('\n', ' ')
-            price = item.get('Price Each', '0').replace('\n', ' ')
-            amount = item.get('Amount', '0').replace('\n', ' ')
-            
-            # Nota: Los f-strings dentro de esta sección SÍ usan llaves {} y funcionan bien aquí.
-            product_rows_html += f"""
-            <tr>
-                <td>{item.get('Product No.', 'N/D')}</td>
-                <td>{item.get('Description', 'N/D')}</td>
-                <td class="align-right">{qty} {item.get('U/M', '')}</td>
-                <td class="align-right">{price}</td>
-                <td class="align-right">{amount}</td>
-            </tr>
-            """
-
-        # 3. Preparar el diccionario de reemplazos (Asegurarse de que no haya espacios en las claves)
-        data_final = {}
-        for k, v in invoice_data.items():
-             # Reemplaza espacios por guiones bajos para string.Template
-             data_final[k.replace(' ', '_')] = v
-
-        # Limpieza de multilínea para Bill To/Ship To
-        data_final['Bill_To'] = invoice_data.get('Bill To', 'N/D').replace('\n', '<br>')
-        data_final['Ship_To'] = invoice_data.get('Ship To', 'N/D').replace('\n', '<br>')
-        
-        # Obtener U/M
-        first_product = invoice_data.get('Product Details', [{}])
-        um = first_product[0].get('U/M', 'N/D') if first_product and first_product[0] else 'N/D'
-        
-        # Agregamos los elementos generados
-        data_final['Product_U/M'] = um
-        data_final['Product_Rows'] = product_rows_html
-        
-        # 4. Formatear la plantilla (USANDO STRING.TEMPLATE)
-        # Reemplaza $Placeholders con los valores del diccionario
-        print(data_final)
-        final_html = template.safe_substitute(data_final) 
+        final_html = build_invoice_html(invoice_data, load_invoice_template(template_path))
 
-        # 5. Limpiar el HTML formateado (para prevenir errores de parseo sutiles)
-        final_html_clean = re.sub(r'\s+', ' ', final_html).strip()
-        
-        # 6. Convertir el HTML a PDF
+        # Convertir el HTML a PDF (se escribe directo al archivo de salida)
         with open(nombre_archivo_pdf, "w+b") as result_file:
             pisa_status = pisa.CreatePDF(
-                final_html_clean, 
+                final_html,
                 dest=result_file,
-                # Usa la función para encontrar el archivo style.css
-                link_callback=link_callback 
+                # Solo para recursos que no quedaron incrustados en la plantilla
+                link_callback=link_callback
             )
 
         if pisa_status.err:
@@ -104,46 +125,158 @@ def crear_pdf_factura_desde_archivo(nombre_archivo_pdf: str, invoice_data: dict,
         print(f"❌ Error general al crear el PDF: {e}")
         return False
 
+# --------------------------- RENDER EN LOTE -------------------------------------------
 
-# --------------------------- FUNCIÓN PRINCIPAL ----------------------------------------
+def _render_worker_init(template_path):
+    # Cada worker carga la plantilla y el CSS una vez al arrancar
+    load_invoice_template(template_path)
 
-def normalize_invoice(invoice):
-    def normalize_value(v):
-        if isinstance(v, str):
-            v = re.sub(r'\s+', ' ', v.strip())  # quita espacios y saltos de línea extra
-        elif isinstance(v, list):
-            return [normalize_value(i) for i in v]
-        elif isinstance(v, dict):
-            return {k: normalize_value(vv) for k, vv in v.items()}
-        return v
+def _render_job(job):
+    nombre_archivo_pdf, invoice_dict, template_path = job
+    return nombre_archivo_pdf, crear_pdf_factura_desde_archivo(nombre_archivo_pdf, invoice_dict, template_path)
+
+def render_invoice_pdfs(invoices, template_path, output_folder, workers=None, max_pending=None):
+    """
+    Genera los PDFs de muchas facturas en un pool de procesos. Es un generador:
+    entrega (ruta_pdf, ok) conforme cada archivo queda escrito, con a lo más
+    max_pending trabajos en vuelo para no cargar todas las facturas en la cola.
+
+    invoices puede traer registros Invoice o diccionarios; el archivo de salida
+    se nombra con el Invoice No (o el nombre del PDF original si no lo hay), con
+    los caracteres fuera de [A-Za-z0-9_.-] cambiados por '_' y sin repetir nombres
+    dentro del lote.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or workers * 4
+
+    def jobs():
+        usados = set()
+        for invoice in invoices:
+            data = invoice.to_dict() if isinstance(invoice, Invoice) else invoice
+            nombre = data.get('Invoice No') or os.path.splitext(data.get('File') or 'factura')[0]
+            # El Invoice No viene del OCR: puede traer '/', '..' o espacios
+            nombre = re.sub(r'[^\w.-]', '_', str(nombre)).strip('.') or 'factura'
+            if nombre in usados:
+                # Dos facturas con el mismo número en el lote: se distingue con el hash
+                # de identidad (o un contador) en vez de sobrescribir la anterior
+                identity = getattr(invoice, 'identity', None) or data.get('Identity')
+                base = f"{nombre}_{identity[:8]}" if identity else nombre
+                candidato, n = base, 1
+                while candidato in usados:
+                    candidato, n = f"{base}_{n}", n + 1
+                print(f"⚠️ Nombre de salida repetido '{nombre}.pdf': se genera '{candidato}.pdf'.")
+                nombre = candidato
+            usados.add(nombre)
+            yield os.path.join(output_folder, f"{nombre}.pdf"), data, template_path
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_render_worker_init,
+                             initargs=(template_path,)) as executor:
+        pending = set()
+        for job in jobs():
+            pending.add(executor.submit(_render_job, job))
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in as_completed(pending):
+            yield future.result()
+
+# --------------------------- FUNCIÓN PRINCIPAL ----------------------------------------
 
-    return normalize_value(invoice)
+def _link_or_copy(pdf_path, output_path):
+    """Enlace duro al original (sin escribir bytes); copia si el sistema de archivos no lo permite."""
+    try:
+        os.link(pdf_path, output_path)
+        return "enlace"
+    except OSError:
+        shutil.copy2(pdf_path, output_path)
+        return "copia"
 
-def remove_invoice_page(pdf_path, output_path):
+def quarantine_pdf(pdf_path, quarantine_folder, reason, lane=None, original_name=None, sha256=None):
+    """
+    Deja una copia (enlace duro si se puede) del PDF problemático en la carpeta de
+    cuarentena junto a un archivo <nombre>.reason.txt con el motivo, para revisarlo
+    a mano sin frenar la corrida. El objeto del almacén no se mueve.
+    """
+    os.makedirs(quarantine_folder, exist_ok=True)
+    nombre = sanitize_filename(original_name or os.path.basename(pdf_path)) or os.path.basename(pdf_path)
+    destino = unique_path(os.path.join(quarantine_folder, nombre))
+    _link_or_copy(pdf_path, destino)
+
+    with open(os.path.splitext(destino)[0] + ".reason.txt", "w", encoding="utf-8") as f:
+        f.write(f"Archivo: {original_name or os.path.basename(pdf_path)}\n")
+        if sha256:
+            f.write(f"SHA-256: {sha256}\n")
+        f.write(f"Fecha: {datetime.datetime.now().isoformat(timespec='seconds')}\n")
+        if lane:
+            f.write(f"Carril: {lane}\n")
+        f.write(f"Motivo: {reason}\n")
+    return destino
+
+def remove_invoice_page(pdf_path, output_path, invoice_page=None):
     """
     Crea una copia del PDF sin la página que contiene los datos del invoice.
-    Usa OCR si es necesario.
+
+    invoice_page es el índice que ya encontró la extracción (Invoice.invoice_page);
+    con él no se vuelve a leer texto ni a hacer OCR. Si es None, se usa el que quedó
+    guardado con el documento (document_invoice_page).
+    Las páginas que quedan se copian como objetos, sin decodificar sus streams de
+    contenido. Si no hay página que quitar, la salida es un enlace duro al original.
+
+    Returns:
+        dict: {"pages": páginas del original, "seconds": tiempo total, "mode": "paginas" | "enlace" | "copia"}
     """
-    _, pages_text_list = get_pdf_text_with_ocr_fallback(pdf_path)
+    inicio = time.perf_counter()
 
-    if not pages_text_list:
-        print(f"⚠️ No se pudo extraer texto del PDF: {pdf_path}")
-        shutil.copy2(pdf_path, output_path)
-        return
+    # Una salida anterior puede ser un enlace duro al original: escribir sobre ella
+    # sobrescribiría también el original, así que siempre se desvincula primero.
+    if os.path.lexists(output_path):
+        os.remove(output_path)
 
-    # Detectar índice de la página del invoice
-    invoice_page_index = find_invoice_page_index(pages_text_list)
+    if invoice_page is None:
+        invoice_page = document_invoice_page(pdf_path)
 
     reader = PdfReader(pdf_path)
-    writer = PdfWriter()
+    total_pages = len(reader.pages)
+
+    if invoice_page is None or not 0 <= invoice_page < total_pages:
+        mode = _link_or_copy(pdf_path, output_path)
+        return {"pages": total_pages, "seconds": time.perf_counter() - inicio, "mode": mode}
 
+    writer = PdfWriter()
     for i, page in enumerate(reader.pages):
-        if i != invoice_page_index:  # omitimos la página de factura
+        if i != invoice_page:  # omitimos la página de factura
             writer.add_page(page)
 
     with open(output_path, "wb") as f:
         writer.write(f)
 
+    return {"pages": total_pages, "seconds": time.perf_counter() - inicio, "mode": "paginas"}
+
+def invoice_text_path(pdf_path):
+    """Ruta del texto de páginas guardado junto al PDF (<archivo>.pdf.text.json)."""
+    return pdf_path + ".text.json"
+
+def document_invoice_page(pdf_path):
+    """
+    Página de la factura guardada con el documento (el texto de la extracción junto
+    al PDF). Si el documento no tiene texto guardado se calcula con find_invoice_page,
+    la misma regla que usa la extracción.
+    """
+    if os.path.exists(invoice_text_path(pdf_path)):
+        return load_invoice_text(pdf_path)["invoice_page"]
+    return find_invoice_page(pdf_path)[0]
+
+def save_invoice_text(snapshot, pdf_path):
+    """Guarda el texto usado en la extracción para poder re-parsearlo sin OCR (backfill)."""
+    with open(invoice_text_path(pdf_path), "w", encoding="utf-8") as f:
+        json.dump(snapshot, f, ensure_ascii=False)
+
+def load_invoice_text(pdf_path):
+    with open(invoice_text_path(pdf_path), "r", encoding="utf-8") as f:
+        return json.load(f)
+
 def save_processed_pdfs(processed_set, file_path="temp/processed_pdfs.json"):
     """Guarda la lista de PDFs procesados en un archivo JSON y crea la carpeta temp si no existe."""
     
@@ -168,72 +301,228 @@ def load_processed_pdfs(file_path="temp/processed_pdfs.json"):
             return set(json.load(f))
     return set()
 
-def read_pdfs_files(folder_pdfs):
-    paths = get_pdf_paths(folder_pdfs)
+def read_pdfs_files(folder_pdfs, on_invoice=None, fast_workers=None, ocr_workers=None, ocr_page_workers=None,
+                    doc_timeout=None, doc_memory_mb=None, storage_folder=None, adaptive=None):
+    """
+    Extrae los datos de los PDFs pendientes del almacén usando el planificador de dos
+    carriles (texto / OCR). Si se pasa on_invoice, se llama con cada factura nueva
+    en cuanto queda lista, sin esperar a que termine el carril de OCR; si devuelve
+    False el PDF queda pendiente para la próxima corrida.
+
+    Los pendientes salen del índice del almacén (attachment_store), no de recorrer
+    carpetas; los PDFs sueltos en folder_pdfs se ingresan primero al almacén.
+
+    Cada documento corre con un presupuesto de doc_timeout segundos y doc_memory_mb
+    MB; los que lo exceden (o tumban a su worker) quedan en estado cuarentena con
+    el motivo en el índice. Con adaptive (scheduler.adaptive_settings) el número
+    de workers de cada carril se ajusta durante la corrida.
+    """
+    store = AttachmentStore(default_store_root(folder_pdfs, storage_folder))
+    try:
+        nuevos, repetidos = store.ingest_folder(folder_pdfs)
+        if nuevos or repetidos:
+            print(f"📥 PDFs sueltos en {folder_pdfs}: {nuevos} ingresados al almacén, {repetidos} repetidos descartados")
 
-    ######################### PATHS ########################
-    originPathPDF = os.path.join(folder_pdfs, "origin")
-    attachmentsPathPDF = os.path.join(folder_pdfs, "attachment")
+        pendientes = {row["sha256"]: row["original_name"] for row in store.by_state(STATE_PENDING)}
 
-    # Crear las carpetas si no existen
-    os.makedirs(originPathPDF, exist_ok=True)
-    os.makedirs(attachmentsPathPDF, exist_ok=True)
+        # ✅ Cargar PDFs ya procesados previamente
+        processed_hashes = load_processed_pdfs()
 
-    completos = 0
-    incompletos = 0
-    lista_objetos = []
-    # ✅ Cargar PDFs ya procesados previamente
-    processed_hashes = load_processed_pdfs()
-    print(f"Numero de archivos encontrados: {len(paths)}")
-    for indice, info_pdf in enumerate(paths[:len(paths)]):
-        pdf_path = info_pdf['ruta']
-        pdf_filename = os.path.basename(pdf_path)
-
-        invoice = extract_invoice_data(pdf_path)
-        invoice = normalize_invoice(invoice)
-        completos += 1
-
-        clave_unica = json.dumps({
-            'Invoice No': invoice.get('Invoice No'),
-            'Invoice Date': invoice.get('Invoice Date'),
-            'S/O#': invoice.get('S/O#'),
-            'Incotenn': invoice.get('Incotenn'),
-            'Payment Terms': invoice.get('Payment Terms'),
-            'Ship Date': invoice.get('Ship Date'),
-            'Due Date': invoice.get('Due Date'),
-            'Method of Shipment': invoice.get('Method of Shipment'),
-            'Subtotal': invoice.get('Subtotal'),
-            'Total': invoice.get('Total'),
-        }, sort_keys=True)
+        def is_duplicate(sha256, identity):
+            if identity in processed_hashes:
+                return True
+            # Agregamos al conjunto de únicos
+            processed_hashes.add(identity)
+            return False
 
-        
-        hash_obj = hashlib.sha256(clave_unica.encode()).hexdigest()
+        def release(sha256, identity):
+            processed_hashes.discard(identity)
 
-        if hash_obj in processed_hashes:
-            incompletos += 1
-            continue
+        lista_objetos = extract_documents(
+            store, pendientes, store.set_state, is_duplicate, on_invoice,
+            fast_workers, ocr_workers, ocr_page_workers, doc_timeout, doc_memory_mb, adaptive, release
+        )
 
-        # print(f"{indice}| Ship Date: {invoice['Ship Date']} | Due Date: {invoice['Due Date']} | {invoice['File']}")
-        print(f"{indice}| Procesando: Invoice No: {invoice['Invoice No']} | Invoice Date: {invoice['Invoice Date']} | {invoice['File']}")
-        # Agregamos al conjunto de únicos      
-        processed_hashes.add(hash_obj)
-        
-        destino_origin = os.path.join(originPathPDF, pdf_filename)
-        destino_attachment = os.path.join(attachmentsPathPDF, pdf_filename)
+        # ✅ Guardar el registro actualizado
+        save_processed_pdfs(processed_hashes)
+        return lista_objetos
+    finally:
+        store.close()
 
-        # Agregamos la ruta al objeto
-        invoice['originPath'] = destino_origin
-        invoice['attachmentPath'] = destino_attachment
-        es_arrow_ship_to = 1 if invoice['Ship To'].lower().startswith("arrow") else 0
-        invoice['needs_review'] = es_arrow_ship_to
+def quarantine_document(layout, sha256, pdf_filename, lane, reason, update_state, **fields):
+    """Registra el documento en cuarentena con update_state y deja su copia en quarantine/."""
+    pdf_path = layout.origin_path(sha256)
+    update_state(sha256, STATE_QUARANTINE, reason=f"carril {lane}: {reason}", **fields)
+    try:
+        destino = quarantine_pdf(pdf_path, layout.quarantine_folder, reason, lane, pdf_filename, sha256)
+    except OSError as e:
+        destino = f"{pdf_path} (no se pudo copiar a cuarentena: {e})"
+    print(f"☣️ {pdf_filename} en cuarentena (carril {lane}): {reason} -> {destino}")
+
+def settle_result(layout, sha256, pdf_filename, lane, invoice, error, update_state, is_duplicate):
+    """
+    Primer paso tras la extracción de un documento: registra cuarentena (estado y
+    copia en quarantine/ con su motivo), error o duplicado con update_state y
+    devuelve None; si la factura es nueva la completa (nombre diferido, rutas del
+    almacén, needs_review) y la devuelve.
+    """
+    pdf_path = layout.origin_path(sha256)
+
+    if isinstance(error, PoisonDocumentError):
+        quarantine_document(layout, sha256, pdf_filename, lane, error.reason, update_state)
+        return None
+
+    if error is not None:
+        # Sigue pendiente: se reintenta en la próxima corrida
+        update_state(sha256, STATE_PENDING, reason=f"carril {lane}: {error}")
+        print(f"❌ Error al extraer {pdf_filename} (carril {lane}): {error}")
+        return None
+
+    # La identidad ya viene precalculada en el registro (mismo hash que antes)
+    if is_duplicate(sha256, invoice.identity):
+        update_state(sha256, STATE_DUPLICATE, invoice_no=invoice.invoice_no)
+        return None
+
+    # Nombre diferido: si la sonda del correo no pudo leer el Invoice No,
+    # el prefijo se agrega ahora que la factura ya fue extraída.
+    invoice_number = invoice.invoice_no
+    if invoice_number and not pdf_filename.startswith(f"{invoice_number}_"):
+        pdf_filename = f"{invoice_number}_{pdf_filename}"
+    invoice.file = pdf_filename
+
+    # El original ya está en su ruta definitiva del almacén; no se mueve
+    invoice.origin_path = pdf_path
+    invoice.attachment_path = layout.attachment_path(sha256)
+    invoice.needs_review = 1 if (invoice.ship_to or "").lower().startswith("arrow") else 0
+    invoice.metadata["lane"] = lane
+    return invoice
+
+def save_invoice_artifacts(invoice):
+    """
+    Guarda el texto de páginas para el backfill y la copia sin página de factura.
+
+    Returns:
+        dict: el resultado de remove_invoice_page.
+    """
+    if invoice.source_text is not None:
+        save_invoice_text(invoice.source_text, invoice.origin_path)
+        invoice.source_text = None
+    return remove_invoice_page(invoice.origin_path, invoice.attachment_path, invoice.invoice_page)
+
+def report_split(split_pages, split_seconds):
+    if split_pages:
+        print(f"✂️ Separación de adjuntos: {split_pages} página(s) en {split_seconds:.2f} s "
+              f"({split_seconds / split_pages * 1000:.1f} ms/página)")
+
+def count_template(template_counts, invoice):
+    """Suma la factura a su plantilla (None = camino genérico) antes de descartar el texto."""
+    template = (invoice.source_text or {}).get("template")
+    template_counts[template] = template_counts.get(template, 0) + 1
+
+def report_templates(template_counts):
+    total = sum(template_counts.values())
+    if total:
+        detalle = ", ".join(
+            f"{name or 'genérico'} {n} ({n / total:.0%})"
+            for name, n in sorted(template_counts.items(), key=lambda kv: -kv[1])
+        )
+        print(f"🧩 Facturas por plantilla: {detalle}")
+
+def extract_documents(layout, documents, update_state, is_duplicate, on_invoice=None, fast_workers=None,
+                      ocr_workers=None, ocr_page_workers=None, doc_timeout=None, doc_memory_mb=None,
+                      adaptive=None, release=None, worker_fn=extract_invoice_data):
+    """
+    Extrae un lote de documentos del almacén y reporta el resultado de cada uno.
+    La usan read_pdfs_files (índice local) y los nodos de work_queue (tabla de trabajos).
+
+    Args:
+        layout: StoreLayout/AttachmentStore con las rutas del almacén.
+        documents: {sha256: nombre original}.
+        update_state: update_state(sha256, estado, **campos) registra el resultado
+            (campos: original_name, invoice_no, identity, reason).
+        is_duplicate: is_duplicate(sha256, identity) -> True si la factura ya se
+            extrajo antes; si no, la deja registrada como vista.
+        on_invoice: on_invoice(invoice) guarda la factura; si devuelve False (o
+            lanza una excepción) no quedó guardada: el documento vuelve a pendiente
+            con la identidad borrada para que el reintento no lo tome por duplicado.
+        release: release(sha256, identity) deshace lo que is_duplicate registró
+            cuando on_invoice falla (la identidad en la columna del documento ya se
+            borra con update_state).
+        worker_fn: extractor que corre en los carriles (extract_invoice_data).
+
+    Returns:
+        list: registros Invoice nuevos (guardados por on_invoice).
+    """
+    default_fast, default_ocr = default_workers()
+    fast_workers = fast_workers or default_fast
+    ocr_workers = ocr_workers or default_ocr
+
+    en_cuarentena = 0
+    no_guardadas = 0
+    split_pages = 0
+    split_seconds = 0.0
+    plantillas = {}
+    lista_objetos = []
+    print(f"Numero de archivos pendientes: {len(documents)}")
+    pdf_paths = [layout.origin_path(sha256) for sha256 in documents]
+    for indice, (pdf_path, lane, invoice, error) in enumerate(
+        run_two_lanes(pdf_paths, worker_fn, fast_workers, ocr_workers, ocr_page_workers,
+                      timeout=doc_timeout, memory_limit_mb=doc_memory_mb, adaptive=adaptive)
+    ):
+        sha256 = layout.sha_from_path(pdf_path)
+        if isinstance(error, PoisonDocumentError):
+            en_cuarentena += 1
+
+        invoice = settle_result(layout, sha256, documents[sha256], lane, invoice, error, update_state, is_duplicate)
+        if invoice is None:
+            continue
+
+        # print(f"{indice}| Ship Date: {invoice.ship_date} | Due Date: {invoice.due_date} | {invoice.file}")
+        print(f"{indice}| Procesando ({lane}): Invoice No: {invoice.invoice_no} | Invoice Date: {invoice.invoice_date} | {invoice.file}")
 
         ## print(invoice)
+        count_template(plantillas, invoice)
+        try:
+            split = save_invoice_artifacts(invoice)
+        except Exception as e:
+            # Un PDF que pypdf no puede reescribir no frena el lote: ese documento va a
+            # cuarentena y su identidad se libera (no quedó guardado en ningún lado)
+            en_cuarentena += 1
+            if release:
+                release(sha256, invoice.identity)
+            quarantine_document(layout, sha256, documents[sha256], lane, f"separación de adjuntos: {e}",
+                                update_state, identity=None)
+            continue
+        split_pages += split["pages"]
+        split_seconds += split["seconds"]
+
+        # Primero se guarda la factura y después se confirma el documento: si el
+        # proceso muere entre ambos, el documento se reintenta (el INSERT valida duplicados).
+        if on_invoice:
+            try:
+                guardada = on_invoice(invoice) is not False
+            except Exception as e:
+                print(f"❌ Error al guardar {invoice.file}: {e}")
+                guardada = False
+            if not guardada:
+                # La identidad ya quedó reclamada por is_duplicate: se libera para que
+                # el reintento no descarte la factura como duplicada de sí misma
+                no_guardadas += 1
+                if release:
+                    release(sha256, invoice.identity)
+                update_state(sha256, STATE_PENDING, identity=None,
+                             reason=f"carril {lane}: la factura {invoice.invoice_no} no se pudo guardar")
+                continue
         lista_objetos.append(invoice)
+        update_state(sha256, STATE_PROCESSED, original_name=invoice.file,
+                     invoice_no=invoice.invoice_no, identity=invoice.identity)
+
+    report_split(split_pages, split_seconds)
+    report_templates(plantillas)
+
+    if en_cuarentena:
+        print(f"☣️ {en_cuarentena} PDF(s) en estado '{STATE_QUARANTINE}', con su motivo en: {layout.quarantine_folder}")
+    if no_guardadas:
+        print(f"⚠️ {no_guardadas} factura(s) no se pudieron guardar; sus PDFs quedan en '{STATE_PENDING}' para reintentar")
 
-        ##Mover el original a origin
-        shutil.move(pdf_path, destino_origin)
-        remove_invoice_page(destino_origin, destino_attachment)
-    
-    # ✅ Guardar el registro actualizado
-    save_processed_pdfs(processed_hashes)
     return lista_objetos
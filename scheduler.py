@@ -0,0 +1,559 @@
+import os
+import time
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait
+from invoice_data import probe_pdf, set_ocr_page_workers
+
+try:
+    import psutil  # opcional: necesario para vigilar la memoria de cada worker
+except ImportError:
+    psutil = None
+
+# --------------------------- PLANIFICADOR DE DOS CARRILES ----------------------------
+# Carril rápido: PDFs con capa de texto (pdfplumber basta, segundos por documento).
+# Carril OCR: PDFs escaneados o con páginas sin texto (pueden tardar minutos).
+# Separarlos evita que un solo escaneo de muchas páginas bloquee a todas las
+# facturas con texto que vienen detrás en la cola.
+
+FAST_LANE = "texto"
+OCR_LANE = "ocr"
+# La sonda que elige el carril abre el PDF con pypdf (y extrae el texto de las páginas
+# con fuentes e imágenes), así que también corre en workers aislados con presupuesto.
+# Cada documento pasa a su carril en cuanto su sonda termina: las facturas de texto
+# no esperan a que se clasifique todo el backlog.
+PROBE_LANE = "sonda"
+PROBE_TIMEOUT_SECONDS = 60  # tope de la sonda aunque el presupuesto por documento sea mayor
+
+def classify_pdf(pdf_path):
+    """
+    Devuelve el carril al que debe ir el PDF según la sonda de páginas/texto.
+    """
+    probe = probe_pdf(pdf_path)
+    return OCR_LANE if probe["needs_ocr"] else FAST_LANE
+
+def probe_timeout(timeout):
+    """Presupuesto de tiempo de la sonda: el del documento, sin pasar de PROBE_TIMEOUT_SECONDS."""
+    return min(timeout, PROBE_TIMEOUT_SECONDS) if timeout else PROBE_TIMEOUT_SECONDS
+
+# --------------------------- WORKERS AISLADOS ----------------------------------------
+# Cada documento se procesa en un proceso worker propio con un límite de tiempo y de
+# memoria. Un PDF malformado o un Tesseract colgado solo mata a su worker (que se
+# reemplaza) y el documento se reporta como PoisonDocumentError para ponerlo en
+# cuarentena; el resto de la corrida sigue a velocidad normal.
+
+class PoisonDocumentError(Exception):
+    """El documento excedió su presupuesto (tiempo/memoria) o tumbó al worker."""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+def _isolated_worker(conn, worker_fn, initializer, initargs):
+    """Loop del proceso worker: recibe (task_id, arg) por el pipe y responde el resultado."""
+    if initializer:
+        initializer(*initargs)
+    # Aviso de listo (task_id None): el padre sabe que el initializer ya terminó
+    conn.send((None, None, None))
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        task_id, arg = message
+        try:
+            conn.send((task_id, worker_fn(arg), None))
+        except MemoryError:
+            conn.send((task_id, None, "memoria agotada (MemoryError)"))
+        except Exception as e:
+            conn.send((task_id, None, f"{type(e).__name__}: {e}\n{traceback.format_exc()}"))
+    conn.close()
+
+def _kill_process_tree(process, wait=True):
+    """
+    Termina el worker y, si psutil está disponible, también sus hijos (OCR, tesseract).
+    Con wait=False manda SIGKILL y regresa sin esperar (quien llama lo recoge después).
+    """
+    if psutil is not None:
+        try:
+            for child in psutil.Process(process.pid).children(recursive=True):
+                child.kill()
+        except psutil.Error:
+            pass
+    if not wait:
+        process.kill()
+        return
+    process.terminate()
+    process.join(5)
+    if process.is_alive():
+        process.kill()
+        process.join()
+
+def _process_tree_rss_mb(pid):
+    """Memoria residente (MB) del worker más sus hijos, o None sin psutil."""
+    if psutil is None:
+        return None
+    try:
+        proc = psutil.Process(pid)
+        rss = proc.memory_info().rss
+        for child in proc.children(recursive=True):
+            rss += child.memory_info().rss
+        return rss / (1024 * 1024)
+    except psutil.Error:
+        return None
+
+# Segundos que tiene un worker retirado para salir solo antes de matarlo
+RETIRE_GRACE_SECONDS = 5
+
+class IsolatedPool:
+    """
+    Pool de procesos con presupuesto por tarea. A diferencia de ProcessPoolExecutor,
+    cada tarea se asigna a un worker conocido, así se puede matar y reemplazar solo
+    al worker que se colgó o se excedió de memoria.
+    """
+
+    def __init__(self, worker_fn, max_workers, initializer=None, initargs=(),
+                 timeout=None, memory_limit_mb=None):
+        self.worker_fn = worker_fn
+        self.max_workers = max(1, max_workers)
+        self.initializer = initializer
+        self.initargs = initargs
+        self.timeout = timeout
+        self.memory_limit_mb = memory_limit_mb
+        self.queue = []
+        self.workers = []
+        # Workers retirados que todavía no terminan de salir (se recogen en poll)
+        self.retiring = []
+        self.next_task_id = 0
+
+        if memory_limit_mb and psutil is None:
+            print("⚠️ psutil no está instalado: no se vigilará el límite de memoria por documento.")
+
+    def _start_worker(self):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=_isolated_worker,
+            args=(child_conn, self.worker_fn, self.initializer, self.initargs)
+        )
+        process.start()
+        child_conn.close()
+        return {"process": process, "conn": parent_conn, "task": None, "ready": False}
+
+    def _replace_worker(self, worker):
+        _kill_process_tree(worker["process"])
+        worker["conn"].close()
+        self.workers.remove(worker)
+
+    def _retire_worker(self, worker):
+        """
+        Cierra un worker ocioso de forma ordenada (el pool se achicó) sin esperarlo:
+        se le manda el aviso de salida y _reap_retired lo recoge en un poll posterior.
+        """
+        try:
+            worker["conn"].send(None)
+        except OSError:
+            pass
+        worker["conn"].close()
+        worker["retire_by"] = time.monotonic() + RETIRE_GRACE_SECONDS
+        self.workers.remove(worker)
+        self.retiring.append(worker)
+
+    def _reap_retired(self):
+        """Recoge los workers retirados que ya salieron; al que pasó su plazo lo mata sin esperar."""
+        for worker in list(self.retiring):
+            process = worker["process"]
+            if not process.is_alive():
+                process.join()
+                self.retiring.remove(worker)
+            elif time.monotonic() > worker["retire_by"] and not worker.get("killed"):
+                _kill_process_tree(process, wait=False)
+                worker["killed"] = True
+
+    def resize(self, max_workers):
+        """
+        Cambia el tope de workers. Al crecer, los nuevos se arrancan cuando haya
+        tareas; al achicarse se cierran los ociosos de inmediato y los ocupados
+        al terminar su documento.
+        """
+        self.max_workers = max(1, max_workers)
+        self._reap_retired()
+        for worker in [w for w in self.workers if w["task"] is None]:
+            if len(self.workers) <= self.max_workers:
+                break
+            self._retire_worker(worker)
+
+    def busy(self):
+        return sum(1 for w in self.workers if w["task"])
+
+    def start(self, wait=False, timeout=300):
+        """
+        Arranca de una vez los workers que falten (pool caliente para un servicio de
+        larga vida). Con wait=True espera a que cada uno termine su initializer.
+        """
+        while len(self.workers) < self.max_workers:
+            self.workers.append(self._start_worker())
+        if not wait:
+            return
+        for worker in self.workers:
+            if not worker["ready"] and worker["task"] is None and worker["conn"].poll(timeout):
+                worker["conn"].recv()
+                worker["ready"] = True
+
+    def submit(self, arg):
+        self.queue.append((self.next_task_id, arg))
+        self.next_task_id += 1
+
+    def cancel(self, arg):
+        """Quita una tarea que todavía no se asignó a un worker. Devuelve True si estaba en cola."""
+        for i, (_, queued_arg) in enumerate(self.queue):
+            if queued_arg == arg:
+                del self.queue[i]
+                return True
+        return False
+
+    def pending(self):
+        return len(self.queue) + sum(1 for w in self.workers if w["task"])
+
+    def _dispatch(self):
+        while self.queue:
+            idle = next((w for w in self.workers if w["task"] is None), None)
+            if idle is None:
+                if len(self.workers) >= self.max_workers:
+                    return
+                idle = self._start_worker()
+                self.workers.append(idle)
+            task_id, arg = self.queue.pop(0)
+            try:
+                idle["conn"].send((task_id, arg))
+            except OSError:
+                # El worker ocioso murió (BrokenPipeError es un OSError): se reemplaza
+                # y la tarea vuelve al frente de la cola para el siguiente worker
+                self._replace_worker(idle)
+                self.queue.insert(0, (task_id, arg))
+                continue
+            idle["task"] = (task_id, arg, time.monotonic())
+
+    def poll(self, timeout=0.1):
+        """
+        Asigna tareas pendientes, espera hasta timeout segundos y devuelve las
+        terminadas como lista de (arg, result, error). error es None, una
+        Exception con el traceback del worker o un PoisonDocumentError.
+        """
+        self._reap_retired()
+        self._dispatch()
+        done = []
+        busy = [w for w in self.workers if w["task"]]
+        if not busy:
+            return done
+
+        ready = wait([w["conn"] for w in busy], timeout=timeout)
+        for worker in busy:
+            _, arg, started = worker["task"]
+
+            if worker["conn"] in ready:
+                try:
+                    task_id, result, error = worker["conn"].recv()
+                except (EOFError, OSError):
+                    # El worker murió sin responder (segfault, OOM del sistema, etc.)
+                    done.append((arg, None, PoisonDocumentError("el worker terminó inesperadamente")))
+                    self._replace_worker(worker)
+                    continue
+                if task_id is None:
+                    # Aviso de listo; la tarea sigue en curso
+                    worker["ready"] = True
+                    continue
+                worker["task"] = None
+                if len(self.workers) > self.max_workers:
+                    self._retire_worker(worker)
+                if error is None:
+                    done.append((arg, result, None))
+                elif error.startswith("memoria agotada"):
+                    done.append((arg, None, PoisonDocumentError(error)))
+                else:
+                    done.append((arg, None, Exception(error)))
+                continue
+
+            elapsed = time.monotonic() - started
+            if self.timeout and elapsed > self.timeout:
+                done.append((arg, None, PoisonDocumentError(f"tiempo excedido ({elapsed:.0f}s > {self.timeout}s)")))
+                self._replace_worker(worker)
+                continue
+
+            rss_mb = _process_tree_rss_mb(worker["process"].pid) if self.memory_limit_mb else None
+            if rss_mb is not None and rss_mb > self.memory_limit_mb:
+                done.append((arg, None, PoisonDocumentError(f"memoria excedida ({rss_mb:.0f} MB > {self.memory_limit_mb} MB)")))
+                self._replace_worker(worker)
+
+        return done
+
+    def shutdown(self):
+        for worker in list(self.workers):
+            if worker["task"] is None:
+                try:
+                    worker["conn"].send(None)
+                except OSError:
+                    pass
+                worker["process"].join(5)
+            if worker["process"].is_alive():
+                _kill_process_tree(worker["process"])
+            worker["conn"].close()
+        for worker in self.retiring:
+            worker["process"].join(5)
+            if worker["process"].is_alive():
+                _kill_process_tree(worker["process"])
+        self.workers = []
+        self.retiring = []
+        self.queue = []
+
+# --------------------------- WORKERS ADAPTATIVOS -------------------------------------
+# Con un número fijo de workers un lote de puro texto deja CPUs sin usar y varios OCR
+# a 300 DPI juntos pueden agotar la memoria. AdaptiveWorkers revisa cada `interval`
+# segundos la CPU, la memoria libre (y la RSS de los workers) y la cola de cada
+# carril, y cambia el tope de cada IsolatedPool dentro de [min_workers, max_workers]
+# (el total de ambos carriles no pasa de max_workers). Un ajuste por revisión:
+#
+#   1. Memoria libre bajo memory_reserve_mb      -> -1 en el carril con más RSS por worker
+#   2. CPU >= cpu_high y carga (load average)    -> -1 (primero el carril OCR, que además
+#      > overload x CPUs: procesos esperando CPU    reparte páginas en otros procesos)
+#   3. Carril sin cola con workers ociosos en    -> se achica a los ocupados
+#      idle_samples revisiones seguidas
+#   4. Cola > workers, CPU < cpu_low y memoria   -> +1 en el carril con más cola por worker
+#      para un worker más (RSS promedio)
+#
+# Una CPU al 100% sin procesos esperando es justo lo que se busca; por eso para achicar
+# también se pide carga por encima de los CPUs. Sin psutil la CPU se estima con
+# os.getloadavg (POSIX) y no se vigila la memoria; sin ninguna de las dos solo decide
+# la cola. Cada ajuste queda en `decisions` y en el
+# resumen de la corrida.
+
+class AdaptiveWorkers:
+    def __init__(self, pools, min_workers=1, max_workers=None, interval=5.0,
+                 cpu_high=90, cpu_low=70, memory_reserve_mb=1024, overload=1.5, idle_samples=3):
+        self.pools = pools
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers * len(pools), max_workers or os.cpu_count() or 1)
+        self.interval = interval
+        self.cpu_high = cpu_high
+        self.cpu_low = cpu_low
+        self.memory_reserve_mb = memory_reserve_mb
+        self.overload = overload
+        # Un hueco de un instante en la cola no achica el carril: hace falta verlo
+        # ocioso en idle_samples revisiones seguidas (idle_streak las cuenta)
+        self.idle_samples = max(1, idle_samples)
+        self.idle_streak = {lane: 0 for lane in pools}
+        self.started = time.monotonic()
+        self.last_check = self.started
+        self.decisions = []
+        self.peak = {lane: pool.max_workers for lane, pool in pools.items()}
+        if psutil is not None:
+            psutil.cpu_percent(None)  # la primera lectura solo fija el punto de partida
+
+    def sample(self):
+        """Lectura actual: {"cpu": %, "load": procesos por CPU, "available_mb": MB, lane: {...}} (None si no se puede medir)."""
+        cpus = os.cpu_count() or 1
+        load = None
+        if psutil is not None and hasattr(psutil, "getloadavg"):
+            load = psutil.getloadavg()[0] / cpus
+        elif hasattr(os, "getloadavg"):
+            load = os.getloadavg()[0] / cpus
+
+        if psutil is not None:
+            cpu = psutil.cpu_percent(None)
+            available_mb = psutil.virtual_memory().available / (1024 * 1024)
+        else:
+            cpu = min(100.0, load * 100) if load is not None else None
+            available_mb = None
+
+        muestra = {"cpu": cpu, "load": load, "available_mb": available_mb}
+        for lane, pool in self.pools.items():
+            rss = [_process_tree_rss_mb(w["process"].pid) for w in list(pool.workers) if w["process"].is_alive()]
+            rss = [r for r in rss if r is not None]
+            muestra[lane] = {
+                "workers": pool.max_workers,
+                "busy": pool.busy(),
+                "backlog": len(pool.queue),
+                "rss_mb": sum(rss) / len(rss) if rss else None,
+            }
+        return muestra
+
+    def tick(self):
+        """Revisa y ajusta si ya pasó el intervalo. Se llama desde el loop que atiende los pools."""
+        now = time.monotonic()
+        if now - self.last_check < self.interval:
+            return None
+        self.last_check = now
+        muestra = self.sample()
+        decision = self.decide(muestra)
+        if decision is None:
+            return None
+
+        lane, workers, reason = decision
+        pool = self.pools[lane]
+        anterior = pool.max_workers
+        pool.resize(workers)
+        self.peak[lane] = max(self.peak[lane], workers)
+        registro = {"seconds": now - self.started, "lane": lane, "from": anterior, "to": workers,
+                    "reason": reason, "sample": muestra}
+        self.decisions.append(registro)
+        print(f"🎛️ Carril {lane}: {anterior} -> {workers} worker(s) ({reason})")
+        return registro
+
+    def decide(self, muestra):
+        """(carril, nuevo tope, motivo) o None si no hay que cambiar nada."""
+        cpu = muestra["cpu"]
+        load = muestra["load"]
+        available_mb = muestra["available_mb"]
+        lanes = {lane: muestra[lane] for lane in self.pools}
+        total = sum(s["workers"] for s in lanes.values())
+        achicables = [lane for lane, s in lanes.items() if s["workers"] > self.min_workers]
+        for lane, s in lanes.items():
+            ocioso = not s["backlog"] and s["workers"] > max(self.min_workers, s["busy"])
+            self.idle_streak[lane] = self.idle_streak[lane] + 1 if ocioso else 0
+
+        def estado():
+            partes = []
+            if cpu is not None:
+                partes.append(f"CPU {cpu:.0f}%")
+            if load is not None:
+                partes.append(f"carga {load:.1f}/CPU")
+            if available_mb is not None:
+                partes.append(f"libre {available_mb:.0f} MB")
+            return ", ".join(partes + [f"cola {lane} {s['backlog']}" for lane, s in lanes.items()])
+
+        if available_mb is not None and available_mb < self.memory_reserve_mb and achicables:
+            lane = max(achicables, key=lambda l: lanes[l]["rss_mb"] or 0)
+            return lane, lanes[lane]["workers"] - 1, f"memoria libre bajo {self.memory_reserve_mb} MB: {estado()}"
+
+        if (cpu is not None and cpu >= self.cpu_high and (load is None or load > self.overload)
+                and achicables):
+            lane = OCR_LANE if OCR_LANE in achicables else achicables[0]
+            return lane, lanes[lane]["workers"] - 1, f"CPU saturada: {estado()}"
+
+        for lane, s in lanes.items():
+            if self.idle_streak[lane] >= self.idle_samples:
+                self.idle_streak[lane] = 0
+                return lane, max(self.min_workers, s["busy"]), f"sin cola en {self.idle_samples} revisiones: {estado()}"
+
+        if total >= self.max_workers or (cpu is not None and cpu >= self.cpu_low):
+            return None
+        con_cola = [lane for lane, s in lanes.items() if s["backlog"] > 0 and s["backlog"] + s["busy"] > s["workers"]]
+        if not con_cola:
+            return None
+        lane = max(con_cola, key=lambda l: lanes[l]["backlog"] / lanes[l]["workers"])
+        rss_mb = lanes[lane]["rss_mb"]
+        if available_mb is not None and rss_mb is not None and available_mb - rss_mb < self.memory_reserve_mb:
+            return None
+        return lane, lanes[lane]["workers"] + 1, f"cola pendiente: {estado()}"
+
+    def report(self):
+        """Resumen de la corrida: cada ajuste con su momento y motivo, y el máximo por carril."""
+        if not self.decisions:
+            print("🎛️ Workers adaptativos: sin ajustes (" +
+                  ", ".join(f"{lane} {pool.max_workers}" for lane, pool in self.pools.items()) + ")")
+            return
+        print(f"🎛️ Workers adaptativos: {len(self.decisions)} ajuste(s) | máximo " +
+              ", ".join(f"{lane} {n}" for lane, n in self.peak.items()) + " | final " +
+              ", ".join(f"{lane} {pool.max_workers}" for lane, pool in self.pools.items()))
+        for d in self.decisions:
+            print(f"   +{d['seconds']:7.1f} s  {d['lane']:<6} {d['from']} -> {d['to']}  {d['reason']}")
+
+def adaptive_settings(cfg):
+    """Parámetros de AdaptiveWorkers según la configuración, o None si está desactivado."""
+    if not cfg.get("adaptive_workers"):
+        return None
+    return {
+        "min_workers": cfg.get("adaptive_min_workers") or 1,
+        "max_workers": cfg.get("adaptive_max_workers"),
+        "interval": cfg.get("adaptive_interval_seconds") or 5.0,
+        "cpu_high": cfg.get("adaptive_cpu_high") or 90,
+        "cpu_low": cfg.get("adaptive_cpu_low") or 70,
+        "memory_reserve_mb": cfg.get("adaptive_memory_reserve_mb") or 1024,
+        "overload": cfg.get("adaptive_overload") or 1.5,
+        "idle_samples": cfg.get("adaptive_idle_samples") or 3,
+    }
+
+def run_two_lanes(pdf_paths, worker_fn, fast_workers=2, ocr_workers=1, ocr_page_workers=None,
+                  timeout=None, memory_limit_mb=None, adaptive=None):
+    """
+    Ejecuta worker_fn(pdf_path) sobre cada PDF en dos pools independientes:
+    uno de baja latencia para PDFs de texto y otro acotado para PDFs con OCR.
+
+    Es un generador: entrega (pdf_path, lane, result, error) a medida que cada
+    documento termina, de modo que las facturas de texto se pueden insertar
+    mientras el carril de OCR sigue trabajando. El carril de cada documento lo
+    decide classify_pdf en un pool aislado (PROBE_LANE) y el documento entra a su
+    carril en cuanto se clasifica; si la sonda excede su presupuesto se entrega
+    con lane PROBE_LANE y un PoisonDocumentError.
+
+    ocr_page_workers es el tope de procesos para el OCR por página dentro de cada
+    documento del carril OCR; si es None se calcula con ocr_page_budget.
+    timeout (segundos) y memory_limit_mb son el presupuesto por documento; quien
+    lo excede se entrega con un PoisonDocumentError.
+    adaptive son los parámetros de AdaptiveWorkers (adaptive_settings); con None
+    cada carril conserva su número de workers.
+    """
+    if ocr_page_workers is None:
+        ocr_page_workers = ocr_page_budget(fast_workers, ocr_workers)
+
+    # El carril rápido no reparte páginas: sus documentos casi no necesitan OCR
+    lanes = {
+        FAST_LANE: IsolatedPool(worker_fn, fast_workers, set_ocr_page_workers, (1,), timeout, memory_limit_mb),
+        OCR_LANE: IsolatedPool(worker_fn, ocr_workers, set_ocr_page_workers, (ocr_page_workers,), timeout, memory_limit_mb),
+    }
+    controller = AdaptiveWorkers(lanes, **adaptive) if adaptive else None
+    probe = IsolatedPool(classify_pdf, fast_workers, timeout=probe_timeout(timeout), memory_limit_mb=memory_limit_mb)
+    clasificados = {FAST_LANE: 0, OCR_LANE: 0}
+
+    try:
+        for pdf_path in pdf_paths:
+            probe.submit(pdf_path)
+
+        while probe.pending() or any(pool.pending() for pool in lanes.values()):
+            if probe.pending():
+                # Con documentos en los carriles solo se recoge lo que la sonda ya terminó
+                extrayendo = any(pool.pending() for pool in lanes.values())
+                for pdf_path, lane, error in probe.poll(timeout=0 if extrayendo else 0.05):
+                    if isinstance(error, PoisonDocumentError):
+                        yield pdf_path, PROBE_LANE, None, error
+                        continue
+                    if error is not None:
+                        # La sonda falló sin exceder su presupuesto: el carril OCR sirve para todo
+                        print(f"⚠️ Sonda de carril fallida para {os.path.basename(pdf_path)}: {str(error).splitlines()[0]}")
+                        lane = OCR_LANE
+                    clasificados[lane] += 1
+                    lanes[lane].submit(pdf_path)
+                if not probe.pending():
+                    print(f"🚦 Carril texto: {clasificados[FAST_LANE]} PDF(s) | Carril OCR: {clasificados[OCR_LANE]} PDF(s)")
+            for lane, pool in lanes.items():
+                if not pool.pending():
+                    continue
+                for pdf_path, result, error in pool.poll(timeout=0.05):
+                    yield pdf_path, lane, result, error
+            if controller is not None:
+                controller.tick()
+    finally:
+        if controller is not None:
+            controller.report()
+        probe.shutdown()
+        for pool in lanes.values():
+            pool.shutdown()
+
+def default_workers():
+    """
+    Reparto por defecto de CPUs entre los dos carriles. Cada carril recibe una
+    cuarta parte; el resto queda para el OCR por página del carril OCR.
+    """
+    cpus = os.cpu_count() or 1
+    fast_workers = max(1, cpus // 4)
+    ocr_workers = max(1, cpus // 4)
+    return fast_workers, ocr_workers
+
+def ocr_page_budget(fast_workers, ocr_workers):
+    """
+    Tope de procesos de OCR por página para cada documento del carril OCR, de modo
+    que fast_workers + ocr_workers * tope no supere el número de CPUs.
+    """
+    cpus = os.cpu_count() or 1
+    return max(1, (cpus - fast_workers) // max(1, ocr_workers))
@@ -0,0 +1,100 @@
+import unittest
+from imap_filter import join_fetch_response, parse_imap_list, parse_fetch_line, bodystructure_has_pdf, prefilter_messages
+
+# ------------------------- PRUEBA DEL FILTRO POR BODYSTRUCTURE -----------------------
+# Respuestas de FETCH (RFC822.SIZE BODYSTRUCTURE) tal como las entrega imaplib.fetch:
+# las líneas llegan como bytes y cada literal {n} como una tupla (línea hasta el
+# literal, bytes del literal). Las estructuras son las que devuelven Dovecot y Gmail
+# para los casos que se escapan con facilidad: nombres en literal, nombres RFC 2231,
+# PDFs dentro de un correo reenviado y PDFs enviados como application/octet-stream.
+#
+# Uso: python -m unittest test_imap_filter -v
+
+TEXTO = b'("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 312 9 NIL NIL NIL NIL)'
+HTML = b'("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 1204 30 NIL NIL NIL NIL)'
+
+FETCH = [
+    # 1: nombre del PDF en un literal (tiene comillas y acentos)
+    (b'1 (RFC822.SIZE 48211 BODYSTRUCTURE ((' + TEXTO[1:] + b'("APPLICATION" "PDF" ("NAME" {22}',
+     'Factura "Nº 1001".pdf'.encode("utf-8")),
+    (b') NIL NIL "BASE64" 46120 NIL ("ATTACHMENT" ("FILENAME" {22}', 'Factura "Nº 1001".pdf'.encode("utf-8")),
+    b')) NIL NIL) "MIXED" ("BOUNDARY" "----=_Part_1") NIL NIL NIL))',
+    # 2: RFC 2231 con continuaciones y percent-encoding (Dovecot no las decodifica)
+    b'2 (RFC822.SIZE 51877 BODYSTRUCTURE ((' + HTML[1:] + b'("APPLICATION" "OCTET-STREAM" NIL NIL NIL "BASE64" 50002 NIL '
+    b'("ATTACHMENT" ("FILENAME*0*" "utf-8\'\'factura%20proveedor" "FILENAME*1*" "%20octubre.p" "FILENAME*2" "df")) '
+    b'NIL NIL) "MIXED" ("BOUNDARY" "b2") NIL NIL NIL))',
+    # 3: correo reenviado (message/rfc822) con el PDF adentro
+    b'3 (RFC822.SIZE 90144 BODYSTRUCTURE (' + TEXTO + b'("MESSAGE" "RFC822" NIL NIL NIL "7BIT" 88012 '
+    b'("Mon, 6 Oct 2025 10:00:00 -0500" "Fwd: factura" (("Proveedor" NIL "ventas" "example.com")) '
+    b'(("Proveedor" NIL "ventas" "example.com")) (("Proveedor" NIL "ventas" "example.com")) '
+    b'((NIL NIL "cuentas" "example.org")) NIL NIL NIL "<abc@example.com>") '
+    b'((' + TEXTO[1:] + b'("APPLICATION" "PDF" ("NAME" "INV-2044.pdf") NIL NIL "BASE64" 86000 NIL '
+    b'("ATTACHMENT" ("FILENAME" "INV-2044.pdf")) NIL NIL) "MIXED" ("BOUNDARY" "interno") NIL NIL NIL) 1190 NIL '
+    b'("ATTACHMENT" ("FILENAME" "factura.eml")) NIL NIL) "MIXED" ("BOUNDARY" "externo") NIL NIL NIL))',
+    # 4: application/octet-stream con nombre en mayúsculas
+    b'4 (RFC822.SIZE 30551 BODYSTRUCTURE (' + TEXTO + b'("APPLICATION" "OCTET-STREAM" ("NAME" "ESTADO_CUENTA.PDF") '
+    b'NIL NIL "BASE64" 29100 NIL ("ATTACHMENT" ("FILENAME" "ESTADO_CUENTA.PDF")) NIL NIL) "MIXED" ("BOUNDARY" "b4") '
+    b'NIL NIL NIL))',
+    # 5: boletín con imágenes, sin PDF
+    b'5 (RFC822.SIZE 2400310 BODYSTRUCTURE ((' + HTML[1:] + b'("IMAGE" "PNG" ("NAME" "banner.png") "<img1>" NIL '
+    b'"BASE64" 2390000 NIL ("INLINE" ("FILENAME" "banner.png")) NIL NIL) "RELATED" ("BOUNDARY" "b5") NIL NIL NIL))',
+    # 6: reenviado sin PDF; el sobre trae "filename" y "x.pdf" como buzón y dominio
+    b'6 (RFC822.SIZE 8120 BODYSTRUCTURE ("MESSAGE" "RFC822" NIL NIL NIL "7BIT" 8000 '
+    b'("Mon, 6 Oct 2025 10:00:00 -0500" "ver factura.pdf" ((NIL NIL "filename" "x.pdf")) NIL NIL NIL NIL NIL NIL NIL) '
+    + TEXTO + b' 120 NIL NIL NIL NIL))',
+]
+
+class ImapFilterTest(unittest.TestCase):
+
+    def lines(self):
+        return {num: campos for num, campos in map(parse_fetch_line, join_fetch_response(FETCH))}
+
+    def test_join_fetch_response_quotes_literals(self):
+        lineas = join_fetch_response(FETCH)
+        self.assertEqual(len(lineas), 6)
+        self.assertTrue(lineas[0].startswith("1 (RFC822.SIZE 48211"))
+        self.assertIn('"Factura \\"Nº 1001\\".pdf"', lineas[0])
+        self.assertTrue(lineas[0].endswith("NIL NIL NIL))"))
+
+    def test_parse_imap_list(self):
+        self.assertEqual(parse_imap_list('(a "b c" (d NIL "e \\"f\\"") ())'), [["a", "b c", ["d", None, 'e "f"'], []]])
+        # Respuesta truncada: se cierra lo que quedó abierto
+        self.assertEqual(parse_imap_list('(a (b "c"'), [["a", ["b", "c"]]])
+
+    def test_literal_filename(self):
+        campos = self.lines()["1"]
+        self.assertEqual(campos["RFC822.SIZE"], "48211")
+        self.assertEqual(campos["BODYSTRUCTURE"][1][2], ["NAME", 'Factura "Nº 1001".pdf'])
+        self.assertTrue(bodystructure_has_pdf(campos["BODYSTRUCTURE"]))
+
+    def test_rfc2231_filename(self):
+        self.assertTrue(bodystructure_has_pdf(self.lines()["2"]["BODYSTRUCTURE"]))
+        sin_pdf = parse_imap_list('("APPLICATION" "OCTET-STREAM" NIL NIL NIL "BASE64" 10 NIL '
+                                  '("ATTACHMENT" ("FILENAME*" "utf-8\'\'notas%2Etxt")) NIL NIL)')[0]
+        self.assertFalse(bodystructure_has_pdf(sin_pdf))
+        codificado = parse_imap_list('("APPLICATION" "OCTET-STREAM" NIL NIL NIL "BASE64" 10 NIL '
+                                     '("ATTACHMENT" ("FILENAME*" "utf-8\'\'factura%2Epdf")) NIL NIL)')[0]
+        self.assertTrue(bodystructure_has_pdf(codificado))
+
+    def test_forwarded_message(self):
+        lineas = self.lines()
+        self.assertTrue(bodystructure_has_pdf(lineas["3"]["BODYSTRUCTURE"]))
+        self.assertFalse(bodystructure_has_pdf(lineas["6"]["BODYSTRUCTURE"]))
+
+    def test_octet_stream_named_pdf(self):
+        self.assertTrue(bodystructure_has_pdf(self.lines()["4"]["BODYSTRUCTURE"]))
+        self.assertFalse(bodystructure_has_pdf(self.lines()["5"]["BODYSTRUCTURE"]))
+
+    def test_prefilter_messages(self):
+        class FakeImap:
+            def fetch(self, nums, query):
+                return "OK", FETCH
+
+        candidatos, sizes, descartados = prefilter_messages(FakeImap(), [b"1", b"2", b"3", b"4", b"5", b"6", b"7"])
+        # 7 no vino en la respuesta: se conserva
+        self.assertEqual(candidatos, [b"1", b"2", b"3", b"4", b"7"])
+        self.assertEqual(descartados, [b"5", b"6"])
+        self.assertEqual(sizes[b"3"], 90144)
+
+if __name__ == "__main__":
+    unittest.main()
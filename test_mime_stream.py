@@ -0,0 +1,132 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from email import policy
+from email.message import EmailMessage
+from email.parser import BytesParser
+from mime_stream import StreamingMimeParser, MAX_LINE_BYTES
+
+# ----------------------------- PRUEBA DEL PARSER MIME --------------------------------
+# Ida y vuelta con correos aleatorios: se arman con email.message (multipart anidados,
+# correos reenviados, adjuntos base64, quoted-printable y 7bit con líneas que empiezan
+# con "--"), se serializan con LF o CRLF y se entregan a StreamingMimeParser en pedazos
+# de 1 byte a 70 KB. Cada adjunto guardado debe coincidir con lo que decodifica la
+# librería estándar con el mensaje completo en memoria.
+#
+# Uso: python -m unittest test_mime_stream -v
+
+SEMILLA = 20251019
+CORRIDAS = 40
+TAMANOS_PEDAZO = (1, 2, 3, 7, 64, 1000, 4096, 65536, MAX_LINE_BYTES + 4096)
+
+def random_text(rng):
+    """Texto con líneas '--', signos '=' (escape en quoted-printable) y alguna línea larga."""
+    lineas = []
+    for _ in range(rng.randint(1, 40)):
+        tipo = rng.random()
+        if tipo < 0.15:
+            lineas.append(rng.choice(["--", "-- ", "--firma", "---- corte ----", "--=_no_es_delimitador"]))
+        elif tipo < 0.25:
+            lineas.append("total=100 " * rng.randint(10, 30))
+        else:
+            lineas.append("".join(rng.choice("abc xyz=-.01") for _ in range(rng.randint(0, 90))))
+    return "\n".join(lineas) + "\n"
+
+def add_random_attachment(rng, msg, n):
+    tipo = rng.choice(["pdf", "pdf", "binario", "qp", "7bit"])
+    if tipo == "pdf":
+        data = b"%PDF-1.4\n" + rng.randbytes(rng.randint(0, 150 * 1024))
+        msg.add_attachment(data, maintype="application", subtype="pdf", filename=f"factura_{n}.pdf")
+    elif tipo == "binario":
+        msg.add_attachment(rng.randbytes(rng.randint(1, 5000)), maintype="application",
+                           subtype="octet-stream", filename=f"datos_{n}.bin")
+    elif tipo == "qp":
+        msg.add_attachment(random_text(rng), subtype="plain", filename=f"nota_{n}.txt", cte="quoted-printable")
+    else:
+        texto = "\n".join(linea[:200] for linea in random_text(rng).splitlines()) + "\n"
+        msg.add_attachment(texto, subtype="plain", filename=f"texto_{n}.txt", cte="7bit")
+
+def random_message(rng):
+    """Correo multipart/mixed; a veces con multipart/alternative y un correo reenviado adentro."""
+    msg = EmailMessage()
+    msg["From"] = "proveedor@example.com"
+    msg["Subject"] = "Factura"
+    msg.set_content(random_text(rng))
+    if rng.random() < 0.5:
+        msg.add_alternative("<p>Factura adjunta</p>\n", subtype="html")
+    n = 0
+    for _ in range(rng.randint(1, 4)):
+        add_random_attachment(rng, msg, n)
+        n += 1
+    if rng.random() < 0.4:
+        reenviado = EmailMessage()
+        reenviado["From"] = "otro@example.com"
+        reenviado["Subject"] = "Fwd"
+        reenviado.set_content(random_text(rng))
+        for _ in range(rng.randint(1, 2)):
+            add_random_attachment(rng, reenviado, n)
+            n += 1
+        msg.add_attachment(reenviado)
+    return msg
+
+def expected_attachments(raw):
+    """Referencia: {nombre: bytes} según la librería estándar."""
+    msg = BytesParser(policy=policy.default).parsebytes(raw)
+    return {part.get_filename(): part.get_payload(decode=True)
+            for part in msg.walk() if part.get_filename()}
+
+class MimeStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="mime_stream_")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def parse(self, raw, chunk_size):
+        parser = StreamingMimeParser(self.tmp, lambda filename, content_type: True)
+        for i in range(0, len(raw), chunk_size):
+            parser.feed(raw[i:i + chunk_size])
+        parser.close()
+        guardados = {}
+        for part in parser.saved:
+            with open(part["tmp_path"], "rb") as f:
+                guardados[part["filename"]] = f.read()
+            os.remove(part["tmp_path"])
+        return parser, guardados
+
+    def test_random_round_trip(self):
+        rng = random.Random(SEMILLA)
+        for corrida in range(CORRIDAS):
+            msg = random_message(rng)
+            linesep = rng.choice(["\n", "\r\n"])
+            raw = msg.as_bytes(policy=policy.default.clone(linesep=linesep))
+            chunk_size = rng.choice(TAMANOS_PEDAZO)
+            with self.subTest(corrida=corrida, linesep=repr(linesep), chunk_size=chunk_size):
+                parser, guardados = self.parse(raw, chunk_size)
+                self.assertEqual(parser.headers["Subject"], "Factura")
+                self.assertEqual(guardados, expected_attachments(raw))
+                self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_truncated_message_discards_last_part(self):
+        rng = random.Random(SEMILLA)
+        msg = EmailMessage()
+        msg["Subject"] = "Factura"
+        msg.set_content("Adjuntos\n")
+        primero = rng.randbytes(20000)
+        msg.add_attachment(primero, maintype="application", subtype="pdf", filename="completo.pdf")
+        msg.add_attachment(rng.randbytes(20000), maintype="application", subtype="pdf", filename="cortado.pdf")
+        raw = msg.as_bytes(policy=policy.default.clone(linesep="\r\n"))
+        # Se corta a la mitad del segundo adjunto
+        raw = raw[:raw.index(b'filename="cortado.pdf"') + 10000]
+
+        for chunk_size in (1, 4096, MAX_LINE_BYTES + 4096):
+            with self.subTest(chunk_size=chunk_size):
+                _, guardados = self.parse(raw, chunk_size)
+                self.assertEqual(guardados, {"completo.pdf": primero})
+                self.assertEqual(os.listdir(self.tmp), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,203 @@
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import multiprocessing
+from pypdf import PdfReader, PdfWriter
+from attachment_store import StoreLayout, AttachmentStore, file_sha256, STATE_PENDING, STATE_PROCESSED, STATE_DUPLICATE
+from invoice_record import Invoice
+from pdf_library import extract_documents
+from work_queue import JobQueue, run_worker
+
+# --------------------------- PRUEBA DE LA COLA COMPARTIDA ----------------------------
+# Cola SQLite con dos nodos en procesos separados y un nodo caído (toma un documento
+# y nunca lo termina). Los PDFs son páginas en blanco con el Invoice No en el título
+# y fake_extractor arma la factura desde ahí, así no hace falta Tesseract ni MySQL.
+# La tabla 'invoices' es un SQLite y la primera inserción de FALLA_UNA_VEZ falla.
+#
+# Uso: python -m unittest test_work_queue -v
+
+FALLA_UNA_VEZ = "1003"
+
+def fake_extractor(pdf_path):
+    """Extractor de prueba: la factura sale del título del PDF (sin OCR)."""
+    invoice_no = PdfReader(pdf_path).metadata.title
+    return Invoice(file=os.path.basename(pdf_path), file_path=pdf_path, invoice_no=invoice_no,
+                   invoice_date="9/30/25", total=100.0, invoice_page=1)
+
+def write_pdf(path, invoice_no, copia):
+    """Dos páginas en blanco; copia cambia el contenido (y el SHA-256) sin cambiar la factura."""
+    writer = PdfWriter()
+    writer.add_blank_page(612, 792)
+    writer.add_blank_page(612, 792)
+    writer.add_metadata({"/Title": invoice_no, "/Subject": f"copia {copia}"})
+    with open(path, "wb") as f:
+        writer.write(f)
+
+def sqlite_queue(path, **kwargs):
+    def connect():
+        conn = sqlite3.connect(path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+    return JobQueue(connect, "sqlite", **kwargs)
+
+def insert_invoice(db_path, marker, invoice):
+    """on_invoice de prueba: INSERT en SQLite; False la primera vez para FALLA_UNA_VEZ."""
+    if invoice.invoice_no == FALLA_UNA_VEZ and not os.path.exists(marker):
+        open(marker, "w").close()
+        return False
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        conn.execute("INSERT INTO invoices (identity, num, file) VALUES (?, ?, ?)",
+                     (invoice.identity, invoice.invoice_no, invoice.file))
+        conn.commit()
+    finally:
+        conn.close()
+    return True
+
+def run_node(queue_path, store_root, db_path, marker, owner):
+    queue = sqlite_queue(queue_path, lease_seconds=30, max_attempts=3, owner=owner)
+    try:
+        run_worker(queue, StoreLayout(store_root),
+                   on_invoice=lambda invoice: insert_invoice(db_path, marker, invoice),
+                   batch_size=2, fast_workers=1, ocr_workers=1, ocr_page_workers=1,
+                   worker_fn=fake_extractor)
+    finally:
+        queue.close()
+
+class WorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="work_queue_")
+        self.layout = StoreLayout(os.path.join(self.tmp, "store"))
+        self.queue_path = os.path.join(self.tmp, "queue.sqlite")
+        self.db_path = os.path.join(self.tmp, "invoices.sqlite")
+        self.marker = os.path.join(self.tmp, "fallo_insertado")
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("CREATE TABLE invoices (identity TEXT PRIMARY KEY, num TEXT, file TEXT)")
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def add_document(self, name, invoice_no, copia=0):
+        """Escribe el PDF directo en su ruta del almacén; devuelve su SHA-256."""
+        tmp_path = os.path.join(self.tmp, name)
+        write_pdf(tmp_path, invoice_no, copia)
+        sha256 = file_sha256(tmp_path)
+        destino = self.layout.origin_path(sha256)
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        os.replace(tmp_path, destino)
+        return sha256
+
+    def jobs(self):
+        conn = sqlite3.connect(self.queue_path)
+        try:
+            filas = conn.execute("SELECT sha256, state, attempts, identity, lease_token FROM parse_jobs").fetchall()
+        finally:
+            conn.close()
+        return {sha256: (state, attempts, identity, token) for sha256, state, attempts, identity, token in filas}
+
+    def inserted(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return sorted(num for (num,) in conn.execute("SELECT num FROM invoices"))
+        finally:
+            conn.close()
+
+    def test_two_nodes_and_dead_node(self):
+        a = self.add_document("a.pdf", "1001")
+        b = self.add_document("b.pdf", "1002")
+        c = self.add_document("c.pdf", "1001", copia=1)  # misma factura que a.pdf
+        d = self.add_document("d.pdf", FALLA_UNA_VEZ)
+
+        queue = sqlite_queue(self.queue_path, lease_seconds=30, max_attempts=3)
+        queue.ensure_schema()
+        queue.enqueue([(a, "a.pdf")])
+
+        # Nodo caído: toma a.pdf con un lease de 1 s y nunca lo termina
+        caido = sqlite_queue(self.queue_path, lease_seconds=1, max_attempts=3, owner="nodo-caido")
+        self.assertEqual(caido.claim(1), {a: "a.pdf"})
+        caido.close()
+        queue.enqueue([(b, "b.pdf"), (c, "c.pdf"), (d, "d.pdf")])
+        queue.close()
+        time.sleep(1.5)
+
+        nodos = [
+            multiprocessing.Process(target=run_node, args=(self.queue_path, self.layout.root, self.db_path,
+                                                           self.marker, f"nodo-{n}"))
+            for n in (1, 2)
+        ]
+        for nodo in nodos:
+            nodo.start()
+        for nodo in nodos:
+            nodo.join(120)
+            self.assertEqual(nodo.exitcode, 0)
+
+        jobs = self.jobs()
+        # Cada factura queda insertada una sola vez
+        self.assertEqual(self.inserted(), ["1001", "1002", FALLA_UNA_VEZ])
+        # a.pdf (retomado del nodo caído) y c.pdf traen la misma factura: una gana, la otra es duplicado
+        self.assertEqual(sorted([jobs[a][0], jobs[c][0]]), sorted([STATE_PROCESSED, STATE_DUPLICATE]))
+        self.assertEqual(jobs[a][1], 2)
+        self.assertEqual(jobs[b][0], STATE_PROCESSED)
+        # El INSERT fallido liberó la identidad: el reintento no se tomó por duplicado
+        self.assertEqual(jobs[d][:2], (STATE_PROCESSED, 2))
+        self.assertIsNotNone(jobs[d][2])
+        self.assertTrue(all(token is None for _, _, _, token in jobs.values()))
+
+    def test_claim_identity_with_lost_lease(self):
+        a = self.add_document("a.pdf", "1001")
+        queue = sqlite_queue(self.queue_path, lease_seconds=30, max_attempts=3)
+        try:
+            queue.ensure_schema()
+            queue.enqueue([(a, "a.pdf")])
+            self.assertEqual(queue.claim(1), {a: "a.pdf"})
+            self.assertTrue(queue.claim_identity(a, "factura-1001"))
+            # Misma identidad otra vez (documento retomado): sigue siendo el dueño
+            self.assertTrue(queue.claim_identity(a, "factura-1001"))
+
+            # Otro nodo retoma el documento: el UPDATE no encuentra el lease
+            conn = sqlite3.connect(self.queue_path)
+            conn.execute("UPDATE parse_jobs SET lease_token = 'otro-nodo', identity = NULL WHERE sha256 = ?", (a,))
+            conn.commit()
+            conn.close()
+            self.assertFalse(queue.claim_identity(a, "factura-1001"))
+            self.assertIsNone(self.jobs()[a][2])
+        finally:
+            queue.close()
+
+    def test_local_store_failed_insert_stays_pending(self):
+        with AttachmentStore(self.layout.root) as store:
+            tmp_path = os.path.join(self.tmp, "d.pdf")
+            write_pdf(tmp_path, FALLA_UNA_VEZ, 0)
+            destino, _ = store.put_file(tmp_path, "d.pdf")
+            d = store.sha_from_path(destino)
+            vistos = set()
+
+            def is_duplicate(sha256, identity):
+                if identity in vistos:
+                    return True
+                vistos.add(identity)
+                return False
+
+            def run():
+                return extract_documents(
+                    store, {d: "d.pdf"}, store.set_state, is_duplicate,
+                    lambda invoice: insert_invoice(self.db_path, self.marker, invoice),
+                    fast_workers=1, ocr_workers=1, ocr_page_workers=1,
+                    release=lambda sha256, identity: vistos.discard(identity), worker_fn=fake_extractor)
+
+            self.assertEqual(run(), [])
+            self.assertEqual([row["sha256"] for row in store.by_state(STATE_PENDING)], [d])
+            self.assertEqual(vistos, set())
+
+            self.assertEqual(len(run()), 1)
+            self.assertEqual([row["sha256"] for row in store.by_state(STATE_PROCESSED)], [d])
+        self.assertEqual(self.inserted(), [FALLA_UNA_VEZ])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,520 @@
+import os
+import time
+import uuid
+import socket
+import sqlite3
+import argparse
+import threading
+import pytesseract
+from attachment_store import StoreLayout, AttachmentStore, default_store_root
+from attachment_store import STATE_PENDING, STATE_QUEUED, STATE_QUARANTINE
+from pdf_library import extract_documents
+from invoice_data import extract_invoice_data
+from scheduler import default_workers, adaptive_settings
+pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
+
+# --------------------------- COLA DE TRABAJO COMPARTIDA ------------------------------
+# Varios equipos reparten el backlog de extracción a través de una tabla de trabajos
+# (parse_jobs) en la base 'atc' de MySQL, o en un SQLite local para pruebas.
+# Cada nodo toma un lote con un lease (token + vencimiento), lo renueva con un
+# latido mientras trabaja y al terminar confirma el resultado solo si el lease sigue
+# siendo suyo. Si un nodo se cae, su lease vence y otro nodo retoma el documento;
+# tras queue_max_attempts intentos el documento queda en cuarentena.
+#
+# Los PDFs se leen del almacén por SHA-256 (attachment_store), que los nodos ven en
+# la misma carpeta compartida (storage_folder del config).
+#
+# Uso: python work_queue.py [--config config.json] {enqueue | worker [--wait S] | status}
+
+JOB_LEASED = "en_proceso"
+JOB_FAILED = "error"  # falló queue_max_attempts veces con error de extracción
+
+# Hora del servidor de base de datos (segundos epoch): todos los nodos usan el mismo reloj
+NOW_SQL = {
+    "mysql": "UNIX_TIMESTAMP(NOW(6))",
+    "sqlite": "((julianday('now') - 2440587.5) * 86400.0)",
+}
+
+SCHEMA = {
+    "mysql": """
+CREATE TABLE IF NOT EXISTS parse_jobs (
+    sha256 CHAR(64) NOT NULL PRIMARY KEY,
+    original_name VARCHAR(255) NOT NULL,
+    state VARCHAR(16) NOT NULL,
+    attempts INT NOT NULL DEFAULT 0,
+    lease_owner VARCHAR(128) NULL,
+    lease_token CHAR(32) NULL,
+    lease_expires DOUBLE NULL,
+    invoice_no VARCHAR(64) NULL,
+    identity CHAR(64) NULL,
+    last_error TEXT NULL,
+    created_at DOUBLE NOT NULL,
+    updated_at DOUBLE NOT NULL,
+    UNIQUE KEY uq_parse_jobs_identity (identity),
+    KEY idx_parse_jobs_state (state, lease_expires)
+)""",
+    "sqlite": """
+CREATE TABLE IF NOT EXISTS parse_jobs (
+    sha256 TEXT NOT NULL PRIMARY KEY,
+    original_name TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_token TEXT,
+    lease_expires REAL,
+    invoice_no TEXT,
+    identity TEXT,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS uq_parse_jobs_identity ON parse_jobs (identity);
+CREATE INDEX IF NOT EXISTS idx_parse_jobs_state ON parse_jobs (state, lease_expires)""",
+}
+
+INSERT_IGNORE = {"mysql": "INSERT IGNORE", "sqlite": "INSERT OR IGNORE"}
+
+# Documentos que un nodo puede tomar: pendientes o con el lease vencido
+CLAIMABLE = f"(state = '{STATE_PENDING}' OR (state = '{JOB_LEASED}' AND lease_expires < {{now}})) AND attempts < ?"
+
+FINISH_FIELDS = {"original_name": "original_name", "invoice_no": "invoice_no",
+                 "identity": "identity", "reason": "last_error"}
+
+def node_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+class JobQueue:
+    """
+    Tabla parse_jobs sobre una conexión DB-API (mysql.connector o sqlite3).
+    connect() debe devolver una conexión nueva del mismo tipo: el latido corre en
+    su propio hilo y no comparte la conexión.
+    """
+
+    def __init__(self, connect, dialect, lease_seconds=120, max_attempts=3, owner=None):
+        self.connect = connect
+        self.dialect = dialect
+        self.conn = connect()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.owner = owner or node_name()
+        # sha256 -> token de los leases que tiene este nodo (compartido con el latido)
+        self.held = {}
+        self.lock = threading.Lock()
+
+        if dialect == "mysql":
+            from mysql.connector import IntegrityError
+        else:
+            IntegrityError = sqlite3.IntegrityError
+        self.integrity_error = IntegrityError
+
+    @classmethod
+    def from_config(cls, cfg):
+        """Cola según cfg['work_queue']: 'mysql' (base atc) o 'sqlite' (cfg['work_queue_sqlite'])."""
+        kwargs = {"lease_seconds": cfg.get("queue_lease_seconds", 120),
+                  "max_attempts": cfg.get("queue_max_attempts", 3)}
+        if cfg.get("work_queue") == "mysql":
+            from mysql_connector import get_db_connection
+            return cls(get_db_connection, "mysql", **kwargs)
+
+        path = cfg.get("work_queue_sqlite") or "temp/work_queue.sqlite"
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        def connect():
+            conn = sqlite3.connect(path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            return conn
+        return cls(connect, "sqlite", **kwargs)
+
+    def clone(self):
+        """Misma cola con otra conexión y los mismos leases (para el hilo del latido)."""
+        other = JobQueue.__new__(JobQueue)
+        other.__dict__.update(self.__dict__)
+        other.conn = self.connect()
+        return other
+
+    def close(self):
+        self.conn.close()
+
+    # ---------- SQL ----------
+    def _sql(self, sql):
+        sql = sql.replace("{now}", NOW_SQL[self.dialect])
+        return sql.replace("?", "%s") if self.dialect == "mysql" else sql
+
+    def _execute(self, sql, params=(), many=False):
+        """Ejecuta y confirma; devuelve las filas afectadas."""
+        cursor = self.conn.cursor()
+        try:
+            if many:
+                cursor.executemany(self._sql(sql), params)
+            else:
+                cursor.execute(self._sql(sql), params)
+            self.conn.commit()
+            return cursor.rowcount
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def _query(self, sql, params=()):
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(self._sql(sql), params)
+            rows = cursor.fetchall()
+            # Cierra la transacción de lectura: en MySQL (REPEATABLE READ) la siguiente
+            # consulta vería la misma foto de la tabla y no los cambios de otros nodos
+            self.conn.commit()
+            return rows
+        finally:
+            cursor.close()
+
+    def ensure_schema(self):
+        cursor = self.conn.cursor()
+        try:
+            for statement in SCHEMA[self.dialect].split(";"):
+                if statement.strip():
+                    cursor.execute(statement)
+            self.conn.commit()
+        finally:
+            cursor.close()
+
+    # ---------- productor ----------
+    def enqueue(self, documents):
+        """Agrega [(sha256, nombre original)]; los que ya estaban en la tabla se ignoran."""
+        if not documents:
+            return 0
+        return self._execute(
+            f"{INSERT_IGNORE[self.dialect]} INTO parse_jobs "
+            f"(sha256, original_name, state, attempts, created_at, updated_at) "
+            f"VALUES (?, ?, '{STATE_PENDING}', 0, {{now}}, {{now}})",
+            list(documents), many=True
+        )
+
+    # ---------- nodos ----------
+    def claim(self, limit):
+        """
+        Toma hasta limit documentos con un lease propio. La toma es un UPDATE
+        condicional por documento (compare-and-set): si otro nodo lo tomó primero,
+        no afecta filas y se pasa al siguiente.
+
+        Returns:
+            dict: {sha256: nombre original}
+        """
+        candidatos = self._query(
+            f"SELECT sha256, original_name FROM parse_jobs WHERE {CLAIMABLE} ORDER BY created_at LIMIT ?",
+            (self.max_attempts, limit * 2)
+        )
+        tomados = {}
+        for sha256, original_name in candidatos:
+            if len(tomados) >= limit:
+                break
+            token = uuid.uuid4().hex
+            ganado = self._execute(
+                f"UPDATE parse_jobs SET state = '{JOB_LEASED}', lease_owner = ?, lease_token = ?, "
+                f"lease_expires = {{now}} + ?, attempts = attempts + 1, updated_at = {{now}} "
+                f"WHERE sha256 = ? AND {CLAIMABLE}",
+                (self.owner, token, self.lease_seconds, sha256, self.max_attempts)
+            )
+            if ganado == 1:
+                tomados[sha256] = original_name
+                with self.lock:
+                    self.held[sha256] = token
+        return tomados
+
+    def heartbeat(self):
+        """Renueva los leases que tiene el nodo. Devuelve cuántos siguen siendo suyos."""
+        with self.lock:
+            tokens = list(self.held.values())
+        if not tokens:
+            return 0
+        renovados = self._execute(
+            f"UPDATE parse_jobs SET lease_expires = {{now}} + ? "
+            f"WHERE state = '{JOB_LEASED}' AND lease_token IN ({', '.join(['?'] * len(tokens))})",
+            [self.lease_seconds] + tokens
+        )
+        if renovados < len(tokens):
+            print(f"⚠️ {self.owner}: {len(tokens) - renovados} lease(s) vencidos y tomados por otro nodo")
+        return renovados
+
+    def claim_identity(self, sha256, identity):
+        """
+        Registra la identidad de la factura en el documento. La columna es única, así
+        que si otro documento (en cualquier nodo) ya la tiene, es un duplicado.
+
+        Returns:
+            bool: True si este documento es el dueño de la factura. False también si
+            el lease se perdió (otro nodo retomó el documento): no se guarda nada.
+        """
+        token = self.held.get(sha256)
+        try:
+            actualizadas = self._execute("UPDATE parse_jobs SET identity = ? WHERE sha256 = ? AND lease_token = ?",
+                                         (identity, sha256, token))
+        except self.integrity_error:
+            return False
+        # MySQL cuenta las filas cambiadas, no las encontradas: 0 también es un
+        # documento retomado que ya tenía esta identidad (la reclamó el nodo caído)
+        if actualizadas != 1 and not self._query("SELECT 1 FROM parse_jobs WHERE sha256 = ? AND lease_token = ?",
+                                                 (sha256, token)):
+            print(f"⚠️ {self.owner}: el lease de {sha256[:12]} ya no es de este nodo; se omite sin guardar")
+            return False
+        return True
+
+    def finish(self, sha256, state, **fields):
+        """
+        Confirma el resultado de un documento si el lease sigue siendo de este nodo.
+        state pendiente (error de extracción) lo libera para reintentar, o lo deja
+        en 'error' si ya agotó sus intentos.
+
+        Returns:
+            bool: False si el lease se perdió (otro nodo retomó el documento).
+        """
+        with self.lock:
+            token = self.held.pop(sha256, None)
+        columnas = {FINISH_FIELDS[k]: v for k, v in fields.items()}
+        sets = "".join(f", {c} = ?" for c in columnas)
+        if state == STATE_PENDING:
+            estado_sql, params = f"CASE WHEN attempts >= ? THEN '{JOB_FAILED}' ELSE '{STATE_PENDING}' END", [self.max_attempts]
+        else:
+            estado_sql, params = "?", [state]
+
+        confirmado = self._execute(
+            f"UPDATE parse_jobs SET state = {estado_sql}, lease_owner = NULL, lease_token = NULL, "
+            f"lease_expires = NULL, updated_at = {{now}}{sets} WHERE sha256 = ? AND lease_token = ?",
+            params + list(columnas.values()) + [sha256, token]
+        ) == 1
+        if not confirmado:
+            print(f"⚠️ {self.owner}: el lease de {sha256[:12]} ya no es de este nodo; resultado descartado")
+        return confirmado
+
+    def release_all(self):
+        """Devuelve a pendiente los leases sin terminar (el nodo se detiene)."""
+        with self.lock:
+            tokens = list(self.held.values())
+            self.held.clear()
+        if tokens:
+            self._execute(
+                f"UPDATE parse_jobs SET state = '{STATE_PENDING}', lease_owner = NULL, lease_token = NULL, "
+                f"lease_expires = NULL, updated_at = {{now}} "
+                f"WHERE lease_token IN ({', '.join(['?'] * len(tokens))})",
+                tokens
+            )
+
+    def reclaim_expired(self):
+        """
+        Leases vencidos (nodo caído): los que ya agotaron sus intentos pasan a
+        cuarentena; el resto vuelve a pendiente.
+
+        Returns:
+            tuple: (reintentables, en cuarentena)
+        """
+        cuarentena = self._execute(
+            f"UPDATE parse_jobs SET state = '{STATE_QUARANTINE}', lease_owner = NULL, lease_token = NULL, "
+            f"last_error = 'lease vencido en todos los intentos (el nodo se cayó o se colgó)', "
+            f"updated_at = {{now}} WHERE state = '{JOB_LEASED}' AND lease_expires < {{now}} AND attempts >= ?",
+            (self.max_attempts,)
+        )
+        reintentables = self._execute(
+            f"UPDATE parse_jobs SET state = '{STATE_PENDING}', lease_owner = NULL, lease_token = NULL, "
+            f"lease_expires = NULL, updated_at = {{now}} "
+            f"WHERE state = '{JOB_LEASED}' AND lease_expires < {{now}}"
+        )
+        if reintentables or cuarentena:
+            print(f"♻️ Leases vencidos: {reintentables} documento(s) vuelven a la cola, {cuarentena} a cuarentena")
+        return reintentables, cuarentena
+
+    def finished(self, sha256_list, batch_size=500):
+        """Resultado de los documentos ya terminados entre los dados: [(sha256, state, invoice_no, identity, last_error)]."""
+        filas = []
+        for i in range(0, len(sha256_list), batch_size):
+            lote = sha256_list[i:i + batch_size]
+            filas += self._query(
+                f"SELECT sha256, state, invoice_no, identity, last_error FROM parse_jobs "
+                f"WHERE state NOT IN ('{STATE_PENDING}', '{JOB_LEASED}') "
+                f"AND sha256 IN ({', '.join(['?'] * len(lote))})",
+                lote
+            )
+        return filas
+
+    def counts(self):
+        return dict(self._query("SELECT state, COUNT(*) FROM parse_jobs GROUP BY state"))
+
+class LeaseKeeper(threading.Thread):
+    """Hilo de latido: renueva los leases del nodo cada lease_seconds / 3."""
+
+    def __init__(self, queue):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.stopped = threading.Event()
+
+    def run(self):
+        queue = self.queue.clone()
+        try:
+            while not self.stopped.wait(max(1.0, self.queue.lease_seconds / 3)):
+                try:
+                    queue.heartbeat()
+                except Exception as e:
+                    print(f"⚠️ Latido fallido ({e}); se reintenta en el siguiente ciclo.")
+        finally:
+            queue.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def enqueue_pending(store, queue):
+    """Pasa a la cola los documentos pendientes del índice local del almacén."""
+    pendientes = [(row["sha256"], row["original_name"]) for row in store.by_state(STATE_PENDING)]
+    queue.enqueue(pendientes)
+    store.set_states([sha256 for sha256, _ in pendientes], STATE_QUEUED)
+    if pendientes:
+        print(f"📤 {len(pendientes)} documento(s) enviados a la cola compartida")
+    return len(pendientes)
+
+def sync_finished(store, queue):
+    """
+    Copia al índice local del almacén el resultado de los documentos que la cola ya
+    terminó (para el backfill y las consultas de attachment_store). Los que agotaron
+    sus intentos con error quedan en cuarentena con el último error como motivo.
+    """
+    en_cola = [row["sha256"] for row in store.by_state(STATE_QUEUED)]
+    terminados = queue.finished(en_cola)
+    for sha256, state, invoice_no, identity, last_error in terminados:
+        store.set_state(sha256, STATE_QUARANTINE if state == JOB_FAILED else state,
+                        invoice_no=invoice_no, identity=identity, reason=last_error)
+    return len(terminados)
+
+def run_worker(queue, layout, on_invoice=None, batch_size=None, wait_seconds=None, fast_workers=None,
+               ocr_workers=None, ocr_page_workers=None, doc_timeout=None, doc_memory_mb=None, adaptive=None,
+               worker_fn=extract_invoice_data):
+    """
+    Nodo de extracción: toma lotes de la cola y los procesa con extract_documents
+    hasta vaciarla. Con wait_seconds no termina: al quedar vacía espera y vuelve a
+    consultar (nodo permanente). Si on_invoice devuelve False, el documento vuelve
+    a la cola con la identidad liberada (cuenta como un intento).
+
+    Returns:
+        list: registros Invoice nuevos extraídos por este nodo.
+    """
+    default_fast, default_ocr = default_workers()
+    fast_workers = fast_workers or default_fast
+    ocr_workers = ocr_workers or default_ocr
+    # Un lote alcanza para llenar ambos carriles dos veces
+    batch_size = batch_size or 2 * (fast_workers + ocr_workers)
+
+    def is_duplicate(sha256, identity):
+        # Con el lease perdido también es True: el documento se omite sin INSERT
+        # (finish descarta después su resultado)
+        return not queue.claim_identity(sha256, identity)
+
+    keeper = LeaseKeeper(queue)
+    keeper.start()
+    lista_objetos = []
+    try:
+        while True:
+            queue.reclaim_expired()
+            jobs = queue.claim(batch_size)
+            if not jobs:
+                if wait_seconds is None:
+                    break
+                time.sleep(wait_seconds)
+                continue
+            print(f"📦 {queue.owner}: {len(jobs)} documento(s) tomados de la cola")
+            lista_objetos += extract_documents(
+                layout, jobs, queue.finish, is_duplicate, on_invoice,
+                fast_workers, ocr_workers, ocr_page_workers, doc_timeout, doc_memory_mb, adaptive,
+                worker_fn=worker_fn
+            )
+    finally:
+        keeper.stop()
+        queue.release_all()
+    return lista_objetos
+
+def run_queue_node(cfg, on_invoice=None, enqueue=True, wait_seconds=None):
+    """
+    Corrida con la cola compartida según el config. Con enqueue=True (equipo que
+    descarga el correo) primero ingresa los PDFs sueltos y envía los pendientes
+    del almacén a la cola; después trabaja como cualquier otro nodo.
+    """
+    root = default_store_root(cfg["download_folder"], cfg.get("storage_folder"))
+    queue = JobQueue.from_config(cfg)
+    try:
+        queue.ensure_schema()
+        if enqueue:
+            with AttachmentStore(root) as store:
+                store.ingest_folder(cfg["download_folder"])
+                enqueue_pending(store, queue)
+
+        invoices = run_worker(
+            queue, StoreLayout(root), on_invoice,
+            batch_size=cfg.get("queue_batch"),
+            wait_seconds=wait_seconds,
+            fast_workers=cfg.get("fast_lane_workers"),
+            ocr_workers=cfg.get("ocr_lane_workers"),
+            ocr_page_workers=cfg.get("ocr_page_workers"),
+            doc_timeout=cfg.get("doc_timeout_seconds"),
+            doc_memory_mb=cfg.get("doc_memory_mb"),
+            adaptive=adaptive_settings(cfg),
+        )
+
+        if enqueue:
+            with AttachmentStore(root) as store:
+                sync_finished(store, queue)
+        return invoices
+    finally:
+        queue.close()
+
+def main():
+    from email_library import load_config
+    from mysql_connector import get_db_connection, insert_and_commit
+    from invoice_export import open_export
+
+    parser = argparse.ArgumentParser(description="Cola de extracción compartida entre varios equipos")
+    parser.add_argument("--config", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json"))
+    parser.add_argument("--sqlite", help="Usar un SQLite local como cola (pruebas) en lugar de MySQL")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("enqueue", help="Enviar a la cola los pendientes del almacén")
+    p = sub.add_parser("worker", help="Procesar documentos de la cola")
+    p.add_argument("--wait", type=float, help="Segundos entre consultas cuando la cola está vacía (nodo permanente)")
+    sub.add_parser("status", help="Documentos por estado")
+    args = parser.parse_args()
+
+    cfg = load_config(args.config)
+    if args.sqlite:
+        cfg["work_queue"], cfg["work_queue_sqlite"] = "sqlite", args.sqlite
+    cfg["work_queue"] = cfg.get("work_queue") or "mysql"
+
+    if args.command == "worker":
+        conn = get_db_connection()
+        export = open_export(cfg)
+
+        def insert_invoice(invoice):
+            result = insert_and_commit(conn, invoice)
+            if export is not None and result["status"] == "ok":
+                export.add(invoice)
+            return result["status"] != "error"
+
+        try:
+            invoices = run_queue_node(cfg, on_invoice=insert_invoice, enqueue=False, wait_seconds=args.wait)
+            print(f"✅ {len(invoices)} factura(s) extraídas en este nodo.")
+        finally:
+            conn.close()
+            if export is not None:
+                export.close()
+        return
+
+    queue = JobQueue.from_config(cfg)
+    try:
+        queue.ensure_schema()
+        if args.command == "enqueue":
+            with AttachmentStore(default_store_root(cfg["download_folder"], cfg.get("storage_folder"))) as store:
+                sync_finished(store, queue)
+                enqueue_pending(store, queue)
+        for state, total in sorted(queue.counts().items()):
+            print(f"  {state:<12} {total}")
+    finally:
+        queue.close()
+
+if __name__ == "__main__":
+    main()